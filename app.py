@@ -1,31 +1,109 @@
 import os
-import base64
-from flask import Flask, render_template, request, redirect, url_for, session, flash, abort
+import sys
+import atexit
+import signal
+import secrets
+import hashlib
+import re
+import json
+import time
+import threading
+import logging
+import contextvars
+import sqlite3
+import zlib
+import click
+from collections import OrderedDict, deque, namedtuple
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, jsonify, send_from_directory, g, has_app_context, has_request_context, Response
 from flask_socketio import SocketIO, join_room, leave_room, emit
+import socketio as python_socketio
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+from markupsafe import Markup, escape
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import or_, and_, func, inspect, text, create_engine, Select
+from sqlalchemy.exc import IntegrityError, OperationalError
 from datetime import datetime
 from math import ceil
-from functools import wraps
+from functools import wraps, lru_cache
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import NotFound
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: images are served at original size only
+    Image = None
+
+import eventlet.semaphore
+from eventlet import tpool
+
+try:
+    import redis
+except ImportError:  # Only needed for redis:// shared stores
+    redis = None
+
+try:
+    import msgpack
+except ImportError:  # Only needed for the msgpack wire format
+    msgpack = None
 from datetime import timezone, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
 
 # PyChat server: Flask routes for pages, Socket.IO for realtime chat, SQLite via SQLAlchemy for storage.
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'BestProjectOfAllTime'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///chat.db'
+app.config['SECRET_KEY'] = os.environ.get('PYCHAT_SECRET_KEY', 'BestProjectOfAllTime')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('PYCHAT_DATABASE_URL', 'sqlite:///chat.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Optional read replica for page renders; SQLite gets read-only connections to the same file.
+app.config['SQLALCHEMY_READ_DATABASE_URI'] = os.environ.get('PYCHAT_DATABASE_READ_URL')
+app.config['SQLITE_PROFILE'] = os.environ.get('PYCHAT_SQLITE_PROFILE', 'production')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('PYCHAT_DB_POOL_SIZE', 10))
+# Times are stored in UTC and shown in each user's timezone; this one is used until they pick one.
+app.config['DEFAULT_TIMEZONE'] = os.environ.get('PYCHAT_TIMEZONE', 'Europe/Bucharest')
+# Messages older than this many days move to compressed archive chunks (0 = keep them live).
+app.config['RETENTION_DAYS'] = {
+    'global': int(os.environ.get('PYCHAT_RETAIN_GLOBAL_DAYS', 30)),
+    'dm': int(os.environ.get('PYCHAT_RETAIN_DM_DAYS', 365)),
+}
+# Seconds between background maintenance runs (0 = only via "flask maintenance").
+app.config['MAINTENANCE_INTERVAL'] = int(os.environ.get('PYCHAT_MAINTENANCE_INTERVAL', 0))
+
+# --- Deployment Configuration ---
+# One process by default. To run N workers behind a load balancer, give every worker the
+# same message queue (cross-process emits) and shared store (cooldowns, ids and other state);
+# a queue without a shared store refuses to start:
+#   PYCHAT_MESSAGE_QUEUE=redis://redis:6379/0 PYCHAT_SHARED_STORE=redis://redis:6379/1
+# "local://" wires servers inside one process together (tests); see README for sticky sessions.
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('PYCHAT_MESSAGE_QUEUE')
+app.config['SHARED_STORE_URL'] = os.environ.get('PYCHAT_SHARED_STORE', 'memory://')
+app.config['PORT'] = int(os.environ.get('PYCHAT_PORT', 5000))
+# Instrumentation: requests slower than this are logged with their SQL (unset = off),
+# and /metrics requires "Authorization: Bearer <token>" when a token is set.
+app.config['SLOW_REQUEST_SECONDS'] = float(os.environ['PYCHAT_SLOW_REQUEST_MS']) / 1000 \
+    if os.environ.get('PYCHAT_SLOW_REQUEST_MS') else None
+app.config['METRICS_TOKEN'] = os.environ.get('PYCHAT_METRICS_TOKEN')
+# Room broadcasts within this window are sent as one 'batch' frame (0 = send each at once).
+app.config['FANOUT_WINDOW_SECONDS'] = float(os.environ.get('PYCHAT_FANOUT_WINDOW_MS', 0)) / 1000
+# Wire format: 'msgpack' sends binary Socket.IO packets, compact payloads shorten the keys of
+# room broadcasts, and deflate=0 stops websockets from negotiating permessage-deflate.
+app.config['SOCKETIO_SERIALIZER'] = os.environ.get('PYCHAT_SOCKETIO_SERIALIZER', 'json')
+app.config['COMPACT_PAYLOADS'] = os.environ.get('PYCHAT_COMPACT_PAYLOADS', '0') == '1'
+app.config['WEBSOCKET_DEFLATE'] = os.environ.get('PYCHAT_WEBSOCKET_DEFLATE', '1') == '1'
 
 # --- Upload Configuration ---
 # Profile pics live in UPLOAD_FOLDER; chat images in CHAT_UPLOAD_FOLDER.
 UPLOAD_FOLDER = os.path.join('static', 'profile_pics')
 CHAT_UPLOAD_FOLDER = os.path.join('static', 'chat_uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+MAX_CHAT_UPLOAD_BYTES = 8 * 1024 * 1024  # Hard cap per chat image
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Chat uploads are streamed to disk in chunks of this size
+UPLOAD_TOKEN_MAX_AGE = 10 * 60  # Seconds an upload token stays valid before it must be sent
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['CHAT_UPLOAD_FOLDER'] = CHAT_UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['CHAT_UPLOAD_FOLDER'], exist_ok=True)
@@ -36,36 +114,823 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-db = SQLAlchemy(app)
-socketio = SocketIO(app, cors_allowed_origins='*')
+# Magic bytes for the image types we accept; the client's filename is not trusted.
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+def sniff_image_type(head):
+    """Return the image extension implied by the first bytes, or None."""
+    for signature, kind in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    return None
+
+class UploadRejected(Exception):
+    # Raised while streaming an upload; carries the HTTP status to answer with.
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# Chat uploads are content-addressed: stored once as "<sha256>.<ext>" however many
+# messages post them. They stream in as "<random>.pending" and are moved into place
+# when a message claims them, so each upload token can only be used once.
+def _append_chunk(f, digest, chunk):
+    digest.update(chunk)
+    f.write(chunk)
+
+def save_chat_upload(stream, file_name):
+    """Stream an image body to CHAT_UPLOAD_FOLDER; returns (pending name, sha256 hex, extension)."""
+    safe_name = secure_filename(file_name or '')
+    if not safe_name or not allowed_file(safe_name):
+        raise UploadRejected('Invalid file type. Allowed: png, jpg, jpeg, gif')
+
+    pending_name = f"{secrets.token_hex(16)}.pending"
+    pending_path = os.path.join(app.config['CHAT_UPLOAD_FOLDER'], pending_name)
+
+    size = 0
+    kind = None
+    digest = hashlib.sha256()
+    try:
+        with open(pending_path, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if size == 0:
+                    kind = sniff_image_type(chunk)
+                    if not kind:
+                        raise UploadRejected('File is not a png, jpg or gif image.')
+                size += len(chunk)
+                if size > MAX_CHAT_UPLOAD_BYTES:
+                    raise UploadRejected('Image is too large.', status=413)
+                # Reading yields to the loop already; hashing and the disk write run in the io pool.
+                io_pool.run(_append_chunk, f, digest, chunk)
+        if size == 0:
+            raise UploadRejected('Empty upload.')
+    except Exception:
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+        raise
+    return pending_name, digest.hexdigest(), kind
+
+# --- Image Variants ---
+# Downscaled copies written next to each upload in <folder>/<variant>/<filename>:
+# thumb for avatars, preview for chat bubbles, display as the EXIF-stripped,
+# recompressed full view. Work runs in the image worker pool, never on the event loop.
+IMAGE_VARIANTS = {'thumb': 256, 'preview': 640, 'display': 2048}
+IMAGE_WORKERS = 2
+IMAGE_QUEUE = 64  # Images allowed to wait; past this new uploads are served at original size
+JPEG_QUALITY = 82
+MEDIA_FOLDERS = {'chat': 'CHAT_UPLOAD_FOLDER', 'avatar': 'UPLOAD_FOLDER'}
+
+def _save_variant(image, path):
+    # Write to a temp file first so a half-written variant is never served.
+    tmp_path = path + '.tmp'
+    fmt = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF'}[path.rsplit('.', 1)[1].lower()]
+    if fmt == 'JPEG':
+        image.convert('RGB').save(tmp_path, fmt, quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(tmp_path, fmt, optimize=True)
+    os.replace(tmp_path, path)
+
+def build_image_variants(folder, filename):
+    """Write every size in IMAGE_VARIANTS for one stored image (runs in image_pool)."""
+    try:
+        with Image.open(os.path.join(folder, filename)) as original:
+            # Animated images keep their original file; a single frame would lose the animation.
+            if getattr(original, 'n_frames', 1) > 1:
+                return
+            # Apply the EXIF rotation, then drop all metadata by working on a fresh copy.
+            image = ImageOps.exif_transpose(original)
+            for variant, size in IMAGE_VARIANTS.items():
+                variant_dir = os.path.join(folder, variant)
+                os.makedirs(variant_dir, exist_ok=True)
+                resized = image.copy()
+                resized.thumbnail((size, size))
+                _save_variant(resized, os.path.join(variant_dir, filename))
+    except Exception as e:
+        log.error("Error building image variants for %s: %s", filename, e)
+
+def schedule_image_variants(folder, filename):
+    """Queue variant generation for a freshly stored upload."""
+    if Image is None or not filename:
+        return
+    try:
+        image_pool.submit(build_image_variants, folder, filename)
+    except PoolBusy:
+        # /media falls back to the original file when a variant is missing.
+        log.warning("Image pool full; serving %s without resized variants", filename)
+
+def remove_image_variants(folder, filename):
+    for variant in IMAGE_VARIANTS:
+        path = os.path.join(folder, variant, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+def remove_chat_image(filename):
+    """Delete a chat image and its variants (the last message using it is gone).
+
+    A message may have claimed the same bytes again since the caller released them;
+    its reference is checked just before unlinking so its file is left in place.
+    """
+    reclaimed = db.session.execute(
+        db.select(StoredImage.filename).where(StoredImage.filename == filename)
+    ).first()
+    if reclaimed:
+        return
+    folder = app.config['CHAT_UPLOAD_FOLDER']
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        os.remove(path)
+    remove_image_variants(folder, filename)
+
+upload_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='chat-upload')
+HASHED_UPLOAD_RE = re.compile(r'^[0-9a-f]{64}\.(png|jpg|gif)$')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # Content-hashed files never change under the same URL
+
+def claim_chat_upload(token, username):
+    """Validate an upload token for username and store its file; returns the filename or None.
+
+    Adds a reference to the stored image in the current DB session; the caller commits
+    it before queueing the message that uses the image.
+    """
+    try:
+        payload = upload_tokens.loads(token, max_age=UPLOAD_TOKEN_MAX_AGE)
+    except (BadSignature, TypeError):
+        return None
+    if payload.get('user') != username:
+        return None
+
+    folder = app.config['CHAT_UPLOAD_FOLDER']
+    pending_path = os.path.join(folder, secure_filename(payload.get('pending', '')))
+    filename = f"{payload.get('sha256')}.{payload.get('ext')}"
+    if not HASHED_UPLOAD_RE.match(filename) or not os.path.exists(pending_path):
+        # Bad payload, or the token was already claimed.
+        return None
+
+    is_new = retain_image(filename)
+    # Same bytes give the same name, so replacing an existing copy is harmless.
+    os.replace(pending_path, os.path.join(folder, filename))
+    if is_new:
+        schedule_image_variants(folder, filename)
+    return filename
+
+# --- Instrumentation ---
+# Latency histograms per route and per Socket.IO event, SQL counts/time per request,
+# rendered in the Prometheus text format at /metrics. Values are per process.
+log = logging.getLogger('pychat')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+class Metrics:
+    """Minimal Prometheus-style registry of counters and histograms keyed by label values."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, label names, buckets)
+        self._values = {}  # name -> {label values: float, or [bucket counts, sum, count]}
+
+    def counter(self, name, help_text, labels=()):
+        self._meta[name] = ('counter', help_text, labels, None)
+        self._values[name] = {}
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, labels, buckets)
+        self._values[name] = {}
+
+    def inc(self, name, *label_values, amount=1):
+        with self._lock:
+            values = self._values[name]
+            values[label_values] = values.get(label_values, 0) + amount
+
+    def observe(self, name, value, *label_values):
+        buckets = self._meta[name][3]
+        with self._lock:
+            series = self._values[name].setdefault(label_values, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ''
+        def quote(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{key}="{quote(value)}"' for key, value in pairs) + '}'
+
+    def render(self, gauges=()):
+        """Text exposition of every metric, plus gauges given as (name, help, [(labels, value)])."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, label_names, buckets) in self._meta.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for label_values, value in sorted(self._values[name].items()):
+                    labels = list(zip(label_names, label_values))
+                    if kind == 'counter':
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+                        continue
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{name}_bucket{self._labels(labels + [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(labels + [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, help_text, samples in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for labels, value in samples:
+                lines.append(f"{name}{self._labels(list(labels.items()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('pychat_http_request_duration_seconds', 'HTTP request latency by route.', ('endpoint', 'method'))
+metrics.counter('pychat_http_requests_total', 'HTTP responses by route and status.', ('endpoint', 'method', 'status'))
+metrics.histogram('pychat_http_request_sql_queries', 'SQL statements run per HTTP request.', ('endpoint',), QUERY_COUNT_BUCKETS)
+metrics.histogram('pychat_http_request_sql_seconds', 'Time in SQL per HTTP request.', ('endpoint',))
+metrics.histogram('pychat_socketio_event_duration_seconds', 'Socket.IO handler latency by event.', ('event',))
+metrics.counter('pychat_socketio_event_errors_total', 'Socket.IO handlers that raised, by event.', ('event',))
+metrics.histogram('pychat_socketio_event_sql_queries', 'SQL statements run per Socket.IO event.', ('event',), QUERY_COUNT_BUCKETS)
+metrics.histogram('pychat_sql_query_duration_seconds', 'Latency of individual SQL statements by engine.', ('engine',))
+
+# SQL hooks: every statement is timed; inside a request or event it is also tallied in g.
+# The start time rides on the execution context, so a statement that fails leaves nothing behind.
+def instrument_engine(engine, name):
+    @db.event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.pychat_started = time.perf_counter()
+
+    @db.event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'pychat_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        metrics.observe('pychat_sql_query_duration_seconds', elapsed, name)
+        if has_app_context() and 'sql_stats' in g:
+            g.sql_stats[0] += 1
+            g.sql_stats[1] += elapsed
+            if g.sql_log is not None:
+                g.sql_log.append((elapsed, statement))
+
+def _start_timing():
+    g.started = time.perf_counter()
+    g.sql_stats = [0, 0.0]  # statements, seconds
+    g.sql_log = [] if app.config['SLOW_REQUEST_SECONDS'] is not None else None
+
+def _log_if_slow(kind, name, elapsed):
+    threshold = app.config['SLOW_REQUEST_SECONDS']
+    if threshold is None or elapsed < threshold:
+        return
+    queries = '\n'.join(f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())[:300]}"
+                        for seconds, statement in g.sql_log)
+    log.warning("Slow %s %s: %.1f ms, %d queries (%.1f ms)\n%s", kind, name, elapsed * 1000,
+                g.sql_stats[0], g.sql_stats[1] * 1000, queries)
+
+@app.before_request
+def start_request_timer():
+    _start_timing()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'started' not in g:
+        return response
+    elapsed = time.perf_counter() - g.pop('started')
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('pychat_http_request_duration_seconds', elapsed, endpoint, request.method)
+    metrics.inc('pychat_http_requests_total', endpoint, request.method, str(response.status_code))
+    metrics.observe('pychat_http_request_sql_queries', g.sql_stats[0], endpoint)
+    metrics.observe('pychat_http_request_sql_seconds', g.sql_stats[1], endpoint)
+    _log_if_slow('request', f"{request.method} {request.path}", elapsed)
+    return response
+
+# Wraps a Socket.IO handler (below @socketio.on) to time it and count its SQL.
+def instrumented_event(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        event = request.event['message'] if getattr(request, 'event', None) else f.__name__
+        _start_timing()
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            metrics.inc('pychat_socketio_event_errors_total', event)
+            raise
+        finally:
+            elapsed = time.perf_counter() - g.pop('started')
+            metrics.observe('pychat_socketio_event_duration_seconds', elapsed, event)
+            metrics.observe('pychat_socketio_event_sql_queries', g.sql_stats[0], event)
+            _log_if_slow('event', event, elapsed)
+    return decorated_function
+
+# --- Database Tuning ---
+# Pragmas applied to every new SQLite connection, by profile. "production" switches to WAL
+# so page renders read a snapshot instead of waiting on commits from the socket handlers.
+SQLITE_PROFILES = {
+    'production': {
+        'auto_vacuum': 'INCREMENTAL',  # Takes effect on new databases; see "flask maintenance --full-vacuum"
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # Safe with WAL; only the last commits can be lost on power failure
+        'cache_size': -32000,  # KiB (negative) of page cache per connection
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,  # ms to wait for a lock instead of failing with "database is locked"
+    },
+    'default': {
+        'busy_timeout': 5000,
+    },
+}
+
+def is_sqlite_file(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+def apply_sqlite_pragmas(engine, read_only=False):
+    """Run the configured profile's pragmas on each connection the engine opens."""
+    pragmas = dict(SQLITE_PROFILES[app.config['SQLITE_PROFILE']])
+    if read_only:
+        # The journal mode belongs to the database file; the writer sets it.
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('auto_vacuum', None)
+        pragmas['query_only'] = 'ON'
+
+    @db.event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+# The server is not monkey-patched, so every green thread shares one OS thread. A pool
+# checkout that has to wait would block the whole event loop while the connection it waits
+# for can never be returned, so the pool may always grow (max_overflow=-1); only
+# DB_POOL_SIZE idle connections are kept.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': app.config['DB_POOL_SIZE'],
+    'max_overflow': -1,
+    'pool_pre_ping': not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'),
+}
+
+read_engine = None  # Set up below once the primary engine exists
+
+# SELECTs inside @read_only_db views go to read_engine; everything else to the primary.
+class RoutingSession(FlaskSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if read_engine is not None and not self._flushing and g.get('db_read_only') \
+                and isinstance(clause, Select):
+            return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+with app.app_context():
+    if is_sqlite_file(db.engine.url):
+        apply_sqlite_pragmas(db.engine)
+    read_url = app.config['SQLALCHEMY_READ_DATABASE_URI']
+    if read_url:
+        read_engine = create_engine(read_url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    elif is_sqlite_file(db.engine.url):
+        read_engine = create_engine(db.engine.url, pool_size=app.config['DB_POOL_SIZE'], max_overflow=-1)
+    if read_engine is not None and is_sqlite_file(read_engine.url):
+        apply_sqlite_pragmas(read_engine, read_only=True)
+    instrument_engine(db.engine, 'primary')
+    if read_engine is not None:
+        instrument_engine(read_engine, 'read')
+
+# Mark a view as read-only so its queries use the read engine (page renders).
+def read_only_db(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+# --- Multi-Worker Support ---
+
+# In-process stand-in for a Redis/Kombu queue: every manager in this process shares one
+# bus, so several Socket.IO servers can be wired together without external services.
+class LocalPubSubManager(python_socketio.PubSubManager):
+    name = 'local'
+    _bus = {}  # channel -> subscriber queues
+
+    def initialize(self):
+        self._queue = self.server.eio.create_queue()
+        self._bus.setdefault(self.channel, []).append(self._queue)
+        super().initialize()
+
+    def _publish(self, data):
+        # Serialize like a real queue so no host shares mutable payloads with another.
+        message = self.json.dumps(data)
+        for queue in self._bus.get(self.channel, []):
+            queue.put(message)
+
+    def _listen(self):
+        while True:
+            yield self._queue.get()
+
+    def unsubscribe(self):
+        """Stop receiving from the bus (for servers started only for a while)."""
+        queues = self._bus.get(self.channel, [])
+        if self._queue in queues:
+            queues.remove(self._queue)
+
+# Small key/value store for state every worker must agree on (cooldowns, rate limits).
+class MemoryStore:
+    """Process-local store with per-key expiry; the default for single-process runs."""
+    PURGE_EVERY = 1000  # Writes between sweeps of expired keys
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item and item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def _purge(self, now):
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            for key in [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]:
+                del self._data[key]
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            return item[0] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._data[key] = (value, now + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it is absent; returns True when it was set."""
+        with self._lock:
+            now = time.monotonic()
+            if self._live(key, now):
+                return False
+            self._purge(now)
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def ttl(self, key):
+        """Seconds until key expires (0 when missing or without expiry)."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._live(key, now)
+            if not item or item[1] is None:
+                return 0
+            return item[1] - now
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1):
+        """Add amount to an integer key (missing counts as 0); returns the new value."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._live(key, now)
+            value = (int(item[0]) if item else 0) + amount
+            self._data[key] = (value, item[1] if item else None)
+            return value
+
+    def take_token(self, key, capacity, rate, cost=1):
+        """Token bucket: spend cost tokens if available; returns seconds to wait (0 = allowed)."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._live(key, now)
+            tokens, last = item[0] if item else (capacity, now)
+            tokens = min(capacity, tokens + (now - last) * rate)
+            retry_after = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            # A bucket that would be full again is indistinguishable from a fresh one, so let it expire.
+            self._purge(now)
+            self._data[key] = ((tokens, now), now + (capacity - tokens) / rate)
+            return retry_after
+
+    def __len__(self):
+        return len(self._data)
+
+class RedisStore:
+    """Same interface as MemoryStore, shared by every worker through Redis."""
+    # Atomic token bucket kept in a hash; uses the Redis clock so workers agree on time.
+    TOKEN_BUCKET_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local last = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - last) * rate)
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        retry_after = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.max(1, math.ceil((capacity - tokens) / rate * 1000)))
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('redis:// shared store requires the redis package')
+        self._redis = redis.Redis.from_url(url)
+        self._take_token = self._redis.register_script(self.TOKEN_BUCKET_SCRIPT)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._redis.set(key, json.dumps(value), nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def ttl(self, key):
+        remaining = self._redis.pttl(key)
+        return remaining / 1000 if remaining > 0 else 0
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def incr(self, key, amount=1):
+        return self._redis.incrby(key, amount)
+
+    def take_token(self, key, capacity, rate, cost=1):
+        return float(self._take_token(keys=[key], args=[capacity, rate, cost]))
+
+def create_shared_store(url):
+    """Build the shared store named by SHARED_STORE_URL (memory:// or redis://)."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    if url.startswith('memory://'):
+        return MemoryStore()
+    raise ValueError(f"Unsupported shared store URL: {url}")
+
+def create_client_manager(url, channel='flask-socketio'):
+    """Pub/sub manager for a message queue URL, chosen the way Flask-SocketIO does."""
+    if url.startswith('local://'):
+        return LocalPubSubManager(channel=channel)
+    if url.startswith(('redis://', 'rediss://')):
+        return python_socketio.RedisManager(url, channel=channel)
+    if url.startswith('kafka://'):
+        return python_socketio.KafkaManager(url, channel=channel)
+    if url.startswith('zmq'):
+        return python_socketio.ZmqManager(url, channel=channel)
+    return python_socketio.KombuManager(url, channel=channel)
+
+def create_socketio(app):
+    """Socket.IO server; emits fan out through SOCKETIO_MESSAGE_QUEUE when one is set."""
+    serializer = app.config['SOCKETIO_SERIALIZER']
+    if serializer not in ('json', 'msgpack'):
+        raise ValueError(f"Unsupported Socket.IO serializer: {serializer}")
+    if serializer == 'msgpack' and msgpack is None:
+        raise RuntimeError('the msgpack wire format requires the msgpack package')
+    options = {'cors_allowed_origins': '*', 'serializer': 'msgpack' if serializer == 'msgpack' else 'default'}
+    message_queue = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if message_queue:
+        options['client_manager'] = create_client_manager(message_queue)
+    return SocketIO(app, **options)
+
+socketio = create_socketio(app)
+
+def probe_message_queue(timeout=5.0):
+    """Start a second Socket.IO server on the message queue and emit to it from this one.
+
+    The peer has one pretend client in a private room. Returns the seconds the last emit
+    took to reach it, or None after timeout. Works with local:// too, where both servers live
+    in this process, which is how tests check cross-worker delivery.
+    """
+    url = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if not url:
+        raise RuntimeError('no message queue configured (PYCHAT_MESSAGE_QUEUE)')
+    peer = python_socketio.Server(async_mode=socketio.async_mode, client_manager=create_client_manager(url))
+    delivered = []
+    # Room emits are handed to the transport here, as Flask-SocketIO's test client also hooks it.
+    peer._send_eio_packet = lambda eio_sid, pkt: delivered.append(eio_sid)
+    room = f"queue-probe-{secrets.token_hex(4)}"
+    peer.manager.enter_room(peer.manager.connect('queue-probe', '/'), '/', room)
+    peer.manager.initialize()
+    try:
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            # Repeat until the peer's subscription is live; earlier publishes are lost.
+            sent = time.monotonic()
+            socketio.emit('queue_probe', {}, to=room)
+            while time.monotonic() - sent < 0.1:
+                socketio.sleep(0.005)
+                if delivered:
+                    return time.monotonic() - sent
+        return None
+    finally:
+        if isinstance(peer.manager, LocalPubSubManager):
+            peer.manager.unsubscribe()
+
+@app.cli.command('check-message-queue')
+@click.option('--timeout', default=5.0, show_default=True, help='Seconds to wait for the emit to arrive.')
+# Confirm workers can reach each other before scaling out: flask --app app check-message-queue
+def check_message_queue_command(timeout):
+    """Emit through PYCHAT_MESSAGE_QUEUE and wait for a second server to receive it."""
+    if not app.config['SOCKETIO_MESSAGE_QUEUE']:
+        raise click.ClickException('PYCHAT_MESSAGE_QUEUE is not set; a single worker needs no queue')
+    elapsed = probe_message_queue(timeout)
+    if elapsed is None:
+        raise click.ClickException(f"No delivery through {app.config['SOCKETIO_MESSAGE_QUEUE']} within {timeout:g}s")
+    click.echo(f"Delivered through {app.config['SOCKETIO_MESSAGE_QUEUE']} in {elapsed * 1000:.1f} ms")
+
+
+shared_store = create_shared_store(app.config['SHARED_STORE_URL'])
+
+# Other workers can't update this process's caches, so in-memory caches are off when scaled out.
+MULTI_WORKER = bool(app.config['SOCKETIO_MESSAGE_QUEUE'])
+
+# Rate limits, friend-list versions and message ids come from the shared store, so separate
+# worker processes each counting in their own memory would hand out the same ids.
+if MULTI_WORKER and isinstance(shared_store, MemoryStore) \
+        and not app.config['SOCKETIO_MESSAGE_QUEUE'].startswith('local://'):
+    raise RuntimeError('PYCHAT_MESSAGE_QUEUE requires a shared store every worker can reach, '
+                       'e.g. PYCHAT_SHARED_STORE=redis://localhost:6379/1')
 
 COOLDOWN_SECONDS = 10  # Per-user throttle for global chat posts
-_last_global_message_at = {}
+
+# Per-event token buckets: (burst capacity, tokens refilled per second).
+# 'send' covers global chat text and images and matches the client's COOLDOWN_SECONDS.
+app.config['RATE_LIMITS'] = {
+    'send': (1, 1 / COOLDOWN_SECONDS),
+    'dm': (10, 1),
+    'upload': (5, 1 / 10),
+    'react': (10, 2),
+    'edit': (5, 1 / 2),
+    'read': (10, 1),
+    'typing': (5, 1),
+}
+
+HISTORY_PAGE_SIZE = 50  # Messages per history page (initial render and each scroll-back)
+HISTORY_CACHE_ROOMS = 0 if MULTI_WORKER else 500  # Rooms kept in the recent-history cache (0 disables it)
+HISTORY_CACHE_PER_ROOM = 200  # Newest messages buffered per cached room
+FRIEND_CACHE_USERS = 10000  # Users whose accepted-friend sets are kept in memory
+IDENTITY_CACHE_USERS = 10000  # Logged-in users whose identity rows are kept in memory
+IDENTITY_CACHE_TTL = 60  # Seconds before a cached identity is re-read (bounds staleness across workers)
+ARCHIVE_CHUNK_CACHE = 64  # Decoded archive chunks kept for scroll-back into archived history
+PAYLOAD_CACHE_SIZE = 20000  # Serialized (message, timezone) payloads memoized for history renders
+REACTION_SYNC_LIMIT = 200  # Most messages one sync_reactions request may cover
+EVENT_LOG_ROOMS = 0 if MULTI_WORKER else 500  # Rooms whose recent broadcasts are kept for reconnect replay
+EVENT_LOG_PER_ROOM = 200  # Broadcasts kept per room
+RESUME_MESSAGE_LIMIT = HISTORY_PAGE_SIZE  # Most messages a DB catch-up sends before the client reloads
+PRESENCE_TICK = 1  # Seconds between presence/typing diff flushes
+PRESENCE_TTL = 70  # Seconds without a heartbeat before a socket stops counting as present
+TYPING_TTL = 6  # Seconds a typing indicator lasts unless refreshed
+PRESENCE_SNAPSHOT_LIMIT = 200  # Most usernames sent in one room snapshot
+
+# Deterministic dm_userA-userB room name so both sides land in the same room.
+def dm_room_name(user_a, user_b):
+    return f"dm_{'-'.join(sorted([user_a, user_b]))}"
 
 # Figure out which room (global vs dm_user-user) a message belongs to.
 def _message_room(message):
     if not message:
         return 'global_chat'
     if message.recipient_username:
-        participants = sorted([message.sender_username, message.recipient_username])
-        return f"dm_{'-'.join(participants)}"
+        return dm_room_name(message.sender_username, message.recipient_username)
     return 'global_chat'
 
-# Enforce per-user cooldown for global chat; returns remaining seconds.
-def check_global_cooldown(username):
-    """Return remaining cooldown seconds for global chat; 0 when allowed."""
-    if not username:
-        return 0
-
-    now = datetime.now(timezone.utc)
-    last_sent = _last_global_message_at.get(username)
-    if last_sent:
-        remaining = COOLDOWN_SECONDS - (now - last_sent).total_seconds()
-        if remaining > 0:
-            return remaining
+# --- Rate Limiting ---
+# Token buckets keyed by event and user, kept in the shared store so every worker
+# enforces the same limits. Buckets expire once refilled, so idle users cost nothing.
+class RateLimiter:
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def hit(self, event, identity):
+        """Spend one token for identity on event; returns seconds to wait (0 when allowed)."""
+        if event not in self.limits:
+            return 0
+        capacity, rate = self.limits[event]
+        return self.store.take_token(f"ratelimit:{event}:{identity}", capacity, rate)
+
+rate_limiter = RateLimiter(shared_store, app.config['RATE_LIMITS'])
+
+# Socket handlers call this first; tells the client how long to wait when over the limit.
+def throttled(event, username):
+    """Return True (and emit rate_limited to the caller) when username is over the limit."""
+    retry_after = rate_limiter.hit(event, username)
+    if retry_after > 0:
+        emit('rate_limited', {'remaining': ceil(retry_after), 'event': event}, to=request.sid)
+        return True
+    return False
+
+# --- Worker Pools ---
+# The event loop runs every socket on one OS thread, so a CPU-heavy or blocking call stalls
+# realtime delivery for all clients. Password hashing, upload file writes, file removals,
+# handler commits and the message-writer flushes a handler waits for run in native threads
+# instead (eventlet.tpool), and the calling greenlet yields until they finish. Image variants
+# are submitted without waiting. Each pool caps how many calls run at once and how many may
+# wait. Past the wait limit, run() and submit() raise PoolBusy. Routes answer that with a 503,
+# commits fall back to running inline and images skip their variants. The pools share
+# eventlet's 20 native threads, so their sizes stay below that together.
+CPU_POOL_WORKERS = min(os.cpu_count() or 2, 8)  # Concurrent password hashes
+CPU_POOL_QUEUE = 64  # Hashes allowed to wait before logins get a 503
+IO_POOL_WORKERS = 8  # Concurrent file writes/removals and commits
+IO_POOL_QUEUE = 256  # Calls allowed to wait before callers are turned away
+
+class PoolBusy(Exception):
+    """Raised when a worker pool already has its maximum number of calls waiting."""
+
+metrics.counter('pychat_pool_calls_total', 'Calls run in a worker pool.', ('pool',))
+metrics.counter('pychat_pool_rejected_total', 'Calls turned away because the pool queue was full.', ('pool',))
+metrics.histogram('pychat_pool_wait_seconds', 'Time a call waited for a worker.', ('pool',))
+metrics.histogram('pychat_pool_run_seconds', 'Time a call ran in a worker.', ('pool',))
+
+class WorkerPool:
+    def __init__(self, name, workers, max_pending):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pending = 0  # Calls running or waiting for a worker
+        self._lock = threading.Lock()
+        # Greenlets wait for a slot cooperatively; other async modes already run requests in threads.
+        self._green = socketio.async_mode == 'eventlet'
+        self._slots = eventlet.semaphore.Semaphore(workers) if self._green else threading.BoundedSemaphore(workers)
+
+    def _reserve(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.inc('pychat_pool_rejected_total', self.name)
+                raise PoolBusy(self.name)
+            self._pending += 1
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn in a native thread and return its result, yielding the event loop meanwhile."""
+        self._reserve()
+        return self._run_reserved(fn, args, kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn without waiting for it; errors are logged."""
+        self._reserve()
+        socketio.start_background_task(contextvars.copy_context().run, self._run_detached, fn, args, kwargs)
+
+    def _run_detached(self, fn, args, kwargs):
+        try:
+            self._run_reserved(fn, args, kwargs)
+        except Exception:
+            log.exception("%s pool task %s failed", self.name, getattr(fn, '__name__', fn))
 
-    _last_global_message_at[username] = now
-    return 0
+    def _run_reserved(self, fn, args, kwargs):
+        queued = time.perf_counter()
+        try:
+            with self._slots:
+                started = time.perf_counter()
+                metrics.observe('pychat_pool_wait_seconds', started - queued, self.name)
+                try:
+                    # Background threads (writer, maintenance) are off the loop already.
+                    if not self._green or threading.current_thread() is not threading.main_thread():
+                        return fn(*args, **kwargs)
+                    # The worker sees the caller's app/request context, so db.session and g still apply.
+                    return tpool.execute(contextvars.copy_context().run, fn, *args, **kwargs)
+                finally:
+                    metrics.observe('pychat_pool_run_seconds', time.perf_counter() - started, self.name)
+                    metrics.inc('pychat_pool_calls_total', self.name)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        return {'workers': self.workers, 'pending': self._pending, 'max_pending': self.max_pending}
+
+cpu_pool = WorkerPool('cpu', CPU_POOL_WORKERS, CPU_POOL_QUEUE)
+io_pool = WorkerPool('io', IO_POOL_WORKERS, IO_POOL_QUEUE)
+image_pool = WorkerPool('image', IMAGE_WORKERS, IMAGE_QUEUE)
+
+@app.errorhandler(PoolBusy)
+# Overloaded pool: ask the client to retry instead of queueing without bound.
+def pool_busy(error):
+    return 'The server is busy. Please try again in a moment.', 503, {'Retry-After': '1'}
+
+# Commit the handler's session from the io pool; under overload it commits inline as before.
+def commit_session():
+    try:
+        io_pool.run(db.session.commit)
+    except PoolBusy:
+        db.session.commit()
 
 # --- Models ---
 class User(db.Model):
@@ -76,6 +941,7 @@ class User(db.Model):
     email = db.Column(db.String(120), nullable=False) 
     bio = db.Column(db.String(200), nullable=True) 
     profile_pic = db.Column(db.String(150), nullable=True) 
+    timezone = db.Column(db.String(64), nullable=True)  # IANA name; None means DEFAULT_TIMEZONE
 
 class Friendship(db.Model):
     # One row per request; status moves from pending to accepted or is removed.
@@ -83,18 +949,39 @@ class Friendship(db.Model):
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     status = db.Column(db.String(20), default='pending')
+    # Ordered pair key (smaller user id first): one row per pair, whoever asked first.
+    low_id = db.Column(db.Integer, nullable=True)
+    high_id = db.Column(db.Integer, nullable=True)
     
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_requests')
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref='received_requests')
 
+    __table_args__ = (
+        db.Index('ux_friendship_pair', 'low_id', 'high_id', unique=True),
+        db.Index('ix_friendship_high_id', 'high_id'),
+        db.Index('ix_friendship_receiver_status', 'receiver_id', 'status'),
+    )
+
+def friendship_pair(user_a_id, user_b_id):
+    """The (low_id, high_id) key for two users, in either order."""
+    return (user_a_id, user_b_id) if user_a_id < user_b_id else (user_b_id, user_a_id)
+
 class Message(db.Model):
     # recipient_username is null for global chat; otherwise it is a DM.
+    # conversation_key is the room name ('global_chat' or dm_userA-userB) so a whole
+    # thread, in either direction, is one indexed range.
     id = db.Column(db.Integer, primary_key=True)
     sender_username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
     recipient_username = db.Column(db.String(80), nullable=True)
     content = db.Column(db.String(500), nullable=True)
     image_filename = db.Column(db.String(200), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    conversation_key = db.Column(db.String(170), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_message_conversation_timestamp', 'conversation_key', 'timestamp', 'id'),
+        db.Index('ix_message_sender_username', 'sender_username'),
+    )
 
 class MessageReaction(db.Model):
     # Tracks who reacted and with what emoji for each message.
@@ -103,160 +990,1619 @@ class MessageReaction(db.Model):
     user_username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
     emoji = db.Column(db.String(10), nullable=False)
 
+    # Serves the toggle lookup, per-message tallies and the grouped page summary.
+    __table_args__ = (
+        db.Index('ux_message_reaction_toggle', 'message_id', 'emoji', 'user_username', unique=True),
+    )
+
+class MessageReactionCount(db.Model):
+    # Running total per (message, emoji) so toggles and page loads never re-count reactions.
+    # The id follows first-reacted order, which is the order the pills are shown in.
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
+    emoji = db.Column(db.String(10), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ux_message_reaction_count', 'message_id', 'emoji', unique=True),
+    )
+
+class MessageArchive(db.Model):
+    # Old messages of one conversation and month, moved out of the message table by
+    # maintenance. payload is zlib-compressed JSON rows, oldest first; chunks never change.
+    id = db.Column(db.Integer, primary_key=True)
+    conversation_key = db.Column(db.String(170), nullable=False)
+    period = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    first_id = db.Column(db.Integer, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    last_id = db.Column(db.Integer, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_message_archive_conversation', 'conversation_key', 'last_timestamp', 'last_id'),
+    )
+
+class ConversationState(db.Model):
+    # One user's summary of one DM thread, kept current as messages are written so the
+    # sidebar never counts messages: read cursor, unread counter and the latest message.
+    id = db.Column(db.Integer, primary_key=True)
+    user_username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
+    conversation_key = db.Column(db.String(170), nullable=False)
+    last_read_id = db.Column(db.Integer, nullable=False, default=0)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_sender = db.Column(db.String(80), nullable=True)
+    last_preview = db.Column(db.String(80), nullable=True)  # None for image messages
+    last_message_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ux_conversation_state', 'user_username', 'conversation_key', unique=True),
+    )
+
+class StoredImage(db.Model):
+    # One row per file in CHAT_UPLOAD_FOLDER; ref_count is how many messages use it.
+    filename = db.Column(db.String(200), primary_key=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+# Reference counting for stored chat images (changes join the caller's transaction).
+def retain_image(filename):
+    """Add a reference to a stored image; returns True when this is its first one."""
+    updated = db.session.execute(
+        db.update(StoredImage)
+        .where(StoredImage.filename == filename)
+        .values(ref_count=StoredImage.ref_count + 1)
+    ).rowcount
+    if updated:
+        return False
+    db.session.add(StoredImage(filename=filename, ref_count=1))
+    return True
+
+def release_image(filename):
+    """Drop a reference; returns True when nothing references the file any more."""
+    updated = db.session.execute(
+        db.update(StoredImage)
+        .where(StoredImage.filename == filename)
+        .values(ref_count=StoredImage.ref_count - 1)
+    ).rowcount
+    if not updated:
+        # Untracked file: the deleted message was its only user.
+        return True
+    removed = db.session.execute(
+        db.delete(StoredImage)
+        .where(StoredImage.filename == filename, StoredImage.ref_count <= 0)
+    ).rowcount
+    return removed > 0
+
+# Reaction totals move by one per toggle (changes join the caller's transaction).
+def adjust_reaction_count(message_id, emoji, delta):
+    """Add delta to a message's emoji total; returns the new total (rows at 0 are removed)."""
+    match = (MessageReactionCount.message_id == message_id, MessageReactionCount.emoji == emoji)
+    updated = db.session.execute(
+        db.update(MessageReactionCount)
+        .where(*match)
+        .values(count=MessageReactionCount.count + delta)
+    ).rowcount
+    if not updated:
+        if delta <= 0:
+            return 0
+        db.session.add(MessageReactionCount(message_id=message_id, emoji=emoji, count=delta))
+        return delta
+
+    count = db.session.execute(db.select(MessageReactionCount.count).where(*match)).scalar()
+    if count <= 0:
+        db.session.execute(db.delete(MessageReactionCount).where(*match))
+        return 0
+    return count
+
+# Stamp the conversation key on every new message so history queries hit the index.
+@db.event.listens_for(Message, 'before_insert')
+def _set_conversation_key(mapper, connection, message):
+    message.conversation_key = _message_room(message)
+
+# Likewise the pair key on every new friendship row.
+@db.event.listens_for(Friendship, 'before_insert')
+def _set_friendship_pair(mapper, connection, friendship):
+    friendship.low_id, friendship.high_id = friendship_pair(friendship.sender_id, friendship.receiver_id)
+
+# --- Schema Migrations ---
+# db.create_all() only creates missing tables, so changes to existing tables go here.
+# Each migration runs once per database (tracked in schema_migrations) and must be
+# safe on a fresh database where create_all already built the current schema. Tables a
+# migration fills are created first, so it also runs against an older schema on its own.
+MIGRATIONS = []
+
+def migration(version):
+    """Register a schema migration under an increasing version number."""
+    def register(f):
+        MIGRATIONS.append((version, f))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return f
+    return register
+
+def _create_model_tables(connection, *models):
+    for model in models:
+        model.__table__.create(bind=connection, checkfirst=True)
+
+def _create_model_indexes(connection, model):
+    for index in model.__table__.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+@migration(1)
+# Add and backfill Message.conversation_key, then build the message indexes.
+def add_message_conversation_key(connection):
+    columns = {c['name'] for c in inspect(connection).get_columns('message')}
+    if 'conversation_key' not in columns:
+        connection.execute(text("ALTER TABLE message ADD COLUMN conversation_key VARCHAR(170)"))
+
+    connection.execute(text(
+        "UPDATE message SET conversation_key = 'global_chat' "
+        "WHERE conversation_key IS NULL AND recipient_username IS NULL"
+    ))
+    # Same ordering as dm_room_name(): the smaller username goes first.
+    connection.execute(text(
+        "UPDATE message SET conversation_key = 'dm_' || CASE "
+        "WHEN sender_username < recipient_username THEN sender_username || '-' || recipient_username "
+        "ELSE recipient_username || '-' || sender_username END "
+        "WHERE conversation_key IS NULL AND recipient_username IS NOT NULL"
+    ))
+    _create_model_indexes(connection, Message)
+
+@migration(2)
+# Drop duplicate reactions (possible before the unique index), then index reactions.
+def add_message_reaction_indexes(connection):
+    connection.execute(text(
+        "DELETE FROM message_reaction WHERE id NOT IN ("
+        "SELECT MIN(id) FROM message_reaction GROUP BY message_id, emoji, user_username)"
+    ))
+    _create_model_indexes(connection, MessageReaction)
+
+@migration(3)
+# Start reference counts for chat images uploaded before content-addressed storage.
+def backfill_stored_images(connection):
+    _create_model_tables(connection, StoredImage)
+    connection.execute(text(
+        "INSERT INTO stored_image (filename, ref_count) "
+        "SELECT image_filename, COUNT(*) FROM message WHERE image_filename IS NOT NULL "
+        "AND image_filename NOT IN (SELECT filename FROM stored_image) "
+        "GROUP BY image_filename"
+    ))
+
+# External-content FTS5 tables: the text lives in message/user, the index is kept in step by
+# triggers, so inserts from the message writer, edits and deletes need no extra code.
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "content, content='message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content ON message BEGIN "
+    "INSERT INTO message_fts (message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO message_fts (rowid, content) VALUES (new.id, new.content); END",
+    # Trigram tokens make substring matches on usernames an index lookup.
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+    "username, content='user', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON user BEGIN "
+    "INSERT INTO user_fts (rowid, username) VALUES (new.id, new.username); END",
+    "CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON user BEGIN "
+    "INSERT INTO user_fts (user_fts, rowid, username) VALUES ('delete', old.id, old.username); END",
+    "CREATE TRIGGER IF NOT EXISTS user_fts_update AFTER UPDATE OF username ON user BEGIN "
+    "INSERT INTO user_fts (user_fts, rowid, username) VALUES ('delete', old.id, old.username); "
+    "INSERT INTO user_fts (rowid, username) VALUES (new.id, new.username); END",
+]
+
+@migration(4)
+# Build the message full-text index and the username trigram index (SQLite only).
+def add_search_indexes(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    has_fts5 = connection.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar()
+    if not has_fts5 or sqlite3.sqlite_version_info < (3, 34, 0):
+        # The trigram tokenizer needs SQLite 3.34; search falls back to LIKE scans.
+        log.warning("SQLite %s lacks FTS5/trigram; search indexes not built", sqlite3.sqlite_version)
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+    connection.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+    connection.execute(text("INSERT INTO user_fts (user_fts) VALUES ('rebuild')"))
+
+@migration(5)
+# Key friendships by ordered user pair, drop duplicate pairs and index the lookups.
+def add_friendship_pair_key(connection):
+    _create_model_tables(connection, Friendship)
+    columns = {c['name'] for c in inspect(connection).get_columns('friendship')}
+    for column in ('low_id', 'high_id'):
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE friendship ADD COLUMN {column} INTEGER"))
+
+    connection.execute(text(
+        "UPDATE friendship SET "
+        "low_id = CASE WHEN sender_id < receiver_id THEN sender_id ELSE receiver_id END, "
+        "high_id = CASE WHEN sender_id < receiver_id THEN receiver_id ELSE sender_id END "
+        "WHERE low_id IS NULL"
+    ))
+    # Keep one row per pair: an accepted one if any, otherwise the oldest request.
+    connection.execute(text(
+        "DELETE FROM friendship WHERE id NOT IN (SELECT id FROM ("
+        "SELECT id, ROW_NUMBER() OVER (PARTITION BY low_id, high_id "
+        "ORDER BY CASE WHEN status = 'accepted' THEN 0 ELSE 1 END, id) AS rank "
+        "FROM friendship) ranked WHERE rank = 1)"
+    ))
+    _create_model_indexes(connection, Friendship)
+
+@migration(6)
+# Seed the reaction totals from the reactions recorded so far, in first-reacted order.
+def backfill_reaction_counts(connection):
+    _create_model_tables(connection, MessageReactionCount)
+    connection.execute(text(
+        "INSERT INTO message_reaction_count (message_id, emoji, count) "
+        "SELECT message_id, emoji, COUNT(*) FROM message_reaction "
+        "GROUP BY message_id, emoji ORDER BY MIN(id)"
+    ))
+
+@migration(7)
+# Per-user display timezone.
+def add_user_timezone(connection):
+    columns = {c['name'] for c in inspect(connection).get_columns('user')}
+    if 'timezone' not in columns:
+        # "user" is a reserved word outside SQLite.
+        table = connection.dialect.identifier_preparer.quote('user')
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN timezone VARCHAR(64)"))
+
+@migration(8)
+# Start read state for existing DM threads at their newest message, with nothing unread.
+def backfill_conversation_states(connection):
+    _create_model_tables(connection, ConversationState)
+    connection.execute(text(
+        "INSERT INTO conversation_state (user_username, conversation_key, last_read_id, unread_count, "
+        "last_message_id, last_sender, last_preview, last_message_at) "
+        "SELECT p.username, m.conversation_key, m.id, 0, m.id, m.sender_username, "
+        "NULLIF(substr(COALESCE(m.content, ''), 1, 80), ''), m.timestamp "
+        "FROM (SELECT conversation_key, MAX(id) AS id FROM message "
+        "WHERE recipient_username IS NOT NULL GROUP BY conversation_key) newest "
+        "JOIN message m ON m.id = newest.id "
+        "JOIN (SELECT sender_username AS username, conversation_key FROM message WHERE recipient_username IS NOT NULL "
+        "UNION SELECT recipient_username, conversation_key FROM message WHERE recipient_username IS NOT NULL) p "
+        "ON p.conversation_key = m.conversation_key"
+    ))
+
+def run_migrations(engine):
+    """Apply pending migrations to the database behind engine, in version order."""
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, applied_at TIMESTAMP NOT NULL)"
+        ))
+        applied = {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+
+    for version, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            apply(connection)
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, applied_at) VALUES (:version, :applied_at)"),
+                {'version': version, 'applied_at': datetime.utcnow()}
+            )
+
 with app.app_context():
     db.create_all()
+    run_migrations(db.engine)
+    search_index_ready = inspect(db.engine).has_table('message_fts')
+
+# --- Message Persistence ---
+# Chat messages are written behind: a message gets its id up front, is broadcast at once,
+# and a background thread commits queued messages in batches. History reads merge in the
+# rows still queued, so they never see a gap without waiting on a commit. Handlers that
+# change a queued message flush through it first, in the io pool rather than on the loop.
+MESSAGE_FLUSH_INTERVAL = 0.05  # Seconds the writer waits to gather a batch
+MESSAGE_FLUSH_BATCH = 200  # Flush without waiting once this many messages are queued
+MESSAGE_QUEUE_LIMIT = 5000  # Past this, senders commit inline (backpressure)
+MESSAGE_REPORT_INTERVAL = 0.5  # Seconds between checks for messages the writer had to drop
+MESSAGE_RETRY_LIMIT = 5  # Attempts before a row failing with a non-lock OperationalError is dropped
+MAX_MESSAGE_LENGTH = 500  # Matches Message.content; longer text is refused before it is queued
+
+class MessageWriter:
+    ID_KEY = 'message:last_id'  # Shared id counter, so workers never hand out the same id
+
+    def __init__(self, store):
+        self.store = store
+        self._pending = []  # Row dicts, oldest first
+        self._inflight = []  # The batch being committed; still visible to readers until it lands
+        self._pending_ids = set()
+        self._origins = {}  # id -> sid of the socket that sent it, until it is written
+        self._rejected = []  # (row, sid) the DB refused, waiting to be taken back from clients
+        self._attempts = {}  # id -> failed writes that were not just a locked database
+        self._reporter = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One commit at a time
+        self._queued = threading.Event()
+        self._full = threading.Event()
+        self._stopping = False
+        self._ids_ready = False
+        self._thread = None
+        self.flushes = 0
+        self.flushed = 0
+        self.inline_flushes = 0
+        self.rejected = 0
+
+    def _next_id(self):
+        if not self._ids_ready:
+            # Make sure the counter is past every id already in the DB (first use per process).
+            last_id = max(db.session.query(func.max(Message.id)).scalar() or 0,
+                          db.session.query(func.max(MessageArchive.last_id)).scalar() or 0)
+            current = int(self.store.get(self.ID_KEY) or 0)
+            if current < last_id:
+                self.store.incr(self.ID_KEY, last_id - current)
+            self._ids_ready = True
+        return self.store.incr(self.ID_KEY)
+
+    def add(self, **fields):
+        """Queue a new message; returns an unsaved Message with its id and timestamp set."""
+        row = dict(fields, id=self._next_id(), timestamp=datetime.utcnow())
+        message = Message(**row)
+        row['conversation_key'] = _message_room(message)
+        origin = getattr(request, 'sid', None) if has_request_context() else None
+        with self._lock:
+            self._pending.append(row)
+            self._pending_ids.add(row['id'])
+            if origin:
+                self._origins[row['id']] = origin
+            queued = len(self._pending)
+        if self._reporter is None:
+            self._reporter = socketio.start_background_task(self._report)
+        if queued >= MESSAGE_QUEUE_LIMIT:
+            # The writer is falling behind; make the sender wait for a commit.
+            self.inline_flushes += 1
+            self._flush_waiting()
+        elif queued >= MESSAGE_FLUSH_BATCH:
+            self._full.set()
+        self._queued.set()
+        return message
+
+    def is_pending(self, message_id):
+        return message_id in self._pending_ids
+
+    def pending_rows(self, conversation):
+        """Rows of conversation not committed yet (queued or being written), oldest first."""
+        with self._lock:
+            rows = {row['id']: row for row in self._inflight + self._pending
+                    if row['conversation_key'] == conversation}
+        return sorted(rows.values(), key=lambda row: row['id'])
+
+    def last_pending_id(self, conversation):
+        rows = self.pending_rows(conversation)
+        return rows[-1]['id'] if rows else None
+
+    def _insert(self, rows):
+        db.session.execute(db.insert(Message), rows)
+        apply_conversation_updates(rows)
+        db.session.commit()
+
+    def _requeue(self, rows, error):
+        """Queue rows again (ahead of newer ones); returns those out of retries, now dropped."""
+        db.session.rollback()
+        message = str(getattr(error, 'orig', error)).lower()
+        if 'locked' in message or 'busy' in message:
+            # Another writer holds the database; that clears, so keep retrying.
+            log.warning("Database busy persisting %d messages, will retry: %s", len(rows), error)
+            retry, dropped = rows, []
+        else:
+            retry, dropped = [], []
+            with self._lock:
+                for row in rows:
+                    self._attempts[row['id']] = self._attempts.get(row['id'], 0) + 1
+                    (dropped if self._attempts[row['id']] >= MESSAGE_RETRY_LIMIT else retry).append(row)
+            if retry:
+                log.warning("Error persisting %d messages, will retry: %s", len(retry), error)
+            if dropped:
+                log.error("Dropping %d messages after %d failed writes: %s",
+                          len(dropped), MESSAGE_RETRY_LIMIT, error)
+        with self._lock:
+            self._pending[:0] = retry
+            self._rejected.extend((row, self._origins.get(row['id'])) for row in dropped)
+        return dropped
+
+    def _insert_each(self, batch):
+        """Write a failed batch one row per transaction; returns the rows dealt with."""
+        for i, row in enumerate(batch):
+            try:
+                self._insert([row])
+            except OperationalError as e:
+                return batch[:i] + self._requeue(batch[i:], e)
+            except Exception as e:
+                db.session.rollback()
+                log.error("Dropping message %d from %s: %s", row['id'], row['sender_username'], e)
+                with self._lock:
+                    self._rejected.append((row, self._origins.get(row['id'])))
+        return batch
+
+    def _write(self, batch):
+        """Commit a batch; returns the rows dealt with (written or dropped)."""
+        try:
+            self._insert(batch)
+        except OperationalError as e:
+            return self._requeue(batch, e)
+        except Exception as e:
+            # One bad row must not cost everyone else's messages.
+            db.session.rollback()
+            log.error("Error persisting %d messages, writing them one at a time: %s", len(batch), e)
+            return self._insert_each(batch)
+        return batch
+
+    def flush(self):
+        """Commit everything queued so far in one transaction; returns how many rows."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return 0
+            done = self._write(batch)
+            with self._lock:
+                self._inflight = []
+                for row in done:
+                    self._pending_ids.discard(row['id'])
+                    self._origins.pop(row['id'], None)
+                    self._attempts.pop(row['id'], None)
+            if not done:
+                return 0
+            self.flushes += 1
+            self.flushed += len(done)
+            return len(done)
+
+    def _flush_waiting(self):
+        # Called from handlers: the commit (and any wait for the writer thread's lock) runs in
+        # the io pool, so only the calling greenlet waits.
+        try:
+            io_pool.run(self.flush)
+        except PoolBusy:
+            self.flush()
+
+    def flush_through(self, message_id):
+        """Make sure message_id is in the DB before it is changed or referenced.
+
+        Does nothing unless that message is still queued.
+        """
+        if message_id is not None and self.is_pending(message_id):
+            self._flush_waiting()
+
+    def report_rejected(self):
+        """Take dropped messages back: clients remove them and each sender is told."""
+        with self._lock:
+            rejected, self._rejected = self._rejected, []
+        for row, origin in rejected:
+            room = row['conversation_key']
+            history_cache.remove(room, row['id'])
+            emit_room('message_deleted', {'message_id': row['id']}, room)
+            if origin:
+                socketio.emit('message_failed', {
+                    'message_id': row['id'],
+                    'error': 'Your message could not be saved.'
+                }, to=origin)
+        self.rejected += len(rejected)
+
+    def _report(self):
+        # Runs on the event loop; the writer thread only queues what it dropped.
+        while True:
+            socketio.sleep(MESSAGE_REPORT_INTERVAL)
+            try:
+                self.report_rejected()
+            except Exception:
+                log.exception("Reporting dropped messages failed")
+
+    def _run(self):
+        with app.app_context():
+            while not self._stopping:
+                self._queued.wait()
+                # Size or time trigger, whichever comes first.
+                self._full.wait(MESSAGE_FLUSH_INTERVAL)
+                self._queued.clear()
+                self._full.clear()
+                self.flush()
+                db.session.remove()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop the writer and commit whatever is still queued (runs at interpreter exit)."""
+        self._stopping = True
+        self._queued.set()
+        self._full.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        with app.app_context():
+            self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'inline_flushes': self.inline_flushes,
+            'rejected': self.rejected
+        }
+
+# Handlers check text before queueing it: the writer can only drop a row the DB refuses,
+# after everyone has already seen it.
+def rejected_content(content):
+    """Return True (and emit message_failed to the caller) when content can't be stored."""
+    if isinstance(content, str) and len(content) <= MAX_MESSAGE_LENGTH:
+        return False
+    emit('message_failed', {'error': f'Messages can be at most {MAX_MESSAGE_LENGTH} characters.'}, to=request.sid)
+    return True
+
+message_writer = MessageWriter(shared_store)
+message_writer.start()
+atexit.register(message_writer.close)
+
+# --- Read State ---
+# Unread counters and read cursors per (user, DM thread) in conversation_state. The message
+# writer applies each batch's DMs in the same transaction as the messages, so the DM
+# sidebar reads one indexed row per friend however long the threads get.
+PREVIEW_LENGTH = 80
+
+def message_preview(content):
+    """Sidebar text for a message; None for images."""
+    return content[:PREVIEW_LENGTH] if content else None
+
+def _conversation_state(username, conversation_key):
+    return and_(ConversationState.user_username == username,
+                ConversationState.conversation_key == conversation_key)
+
+def ensure_conversation_state(username, conversation_key):
+    # INSERT ... SELECT WHERE NOT EXISTS runs as one statement, so concurrent writers can't both add it.
+    missing = ~db.select(ConversationState.id).where(_conversation_state(username, conversation_key)).exists()
+    db.session.execute(db.insert(ConversationState).from_select(
+        ['user_username', 'conversation_key', 'last_read_id', 'unread_count'],
+        db.select(db.literal(username), db.literal(conversation_key), db.literal(0), db.literal(0)).where(missing)
+    ))
+
+def apply_conversation_updates(rows):
+    """Fold a batch of new message rows (oldest first) into both participants' read state."""
+    changes = OrderedDict()  # (username, conversation key) -> {'unread', 'read_through', 'last'}
+    for row in rows:
+        recipient = row.get('recipient_username')
+        if not recipient:
+            continue
+        sender, key = row['sender_username'], row['conversation_key']
+        for username in (sender, recipient):
+            changes.setdefault((username, key), {'unread': 0, 'read_through': None, 'last': None})['last'] = row
+        # Replying means the sender has read everything before it.
+        changes[(sender, key)].update(unread=0, read_through=row['id'])
+        changes[(recipient, key)]['unread'] += 1
+
+    for (username, key), change in changes.items():
+        ensure_conversation_state(username, key)
+        last = change['last']
+        values = {
+            'last_message_id': last['id'],
+            'last_sender': last['sender_username'],
+            'last_preview': message_preview(last.get('content')),
+            'last_message_at': last['timestamp'],
+        }
+        if change['read_through'] is not None:
+            values.update(last_read_id=change['read_through'], unread_count=change['unread'])
+        else:
+            values['unread_count'] = ConversationState.unread_count + change['unread']
+        db.session.execute(db.update(ConversationState).where(_conversation_state(username, key)).values(**values))
+
+def mark_conversation_read(username, conversation_key):
+    """Move username's read cursor to the thread's newest message; returns it (None if no state)."""
+    db.session.execute(
+        db.update(ConversationState)
+        .where(_conversation_state(username, conversation_key))
+        .values(unread_count=0, last_read_id=func.coalesce(ConversationState.last_message_id, 0))
+    )
+    return db.session.query(ConversationState.last_read_id)\
+        .filter(_conversation_state(username, conversation_key)).scalar()
+
+def conversation_message_edited(message):
+    # Edits only matter to the sidebar when they touch the latest message.
+    db.session.execute(
+        db.update(ConversationState)
+        .where(ConversationState.conversation_key == message.conversation_key,
+               ConversationState.last_message_id == message.id)
+        .values(last_preview=message_preview(message.content))
+    )
+
+def conversation_message_deleted(message):
+    """Keep unread counts and previews right after message (a DM) is deleted."""
+    key = message.conversation_key
+    # An unread deleted message no longer counts for the recipient.
+    db.session.execute(
+        db.update(ConversationState)
+        .where(_conversation_state(message.recipient_username, key),
+               ConversationState.last_read_id < message.id, ConversationState.unread_count > 0)
+        .values(unread_count=ConversationState.unread_count - 1)
+    )
+    # The newest message went away: show the one before it (one index lookup).
+    previous = db.session.query(Message.id, Message.sender_username, Message.content, Message.timestamp)\
+        .filter(Message.conversation_key == key, Message.id != message.id)\
+        .order_by(Message.timestamp.desc(), Message.id.desc()).first()
+    db.session.execute(
+        db.update(ConversationState)
+        .where(ConversationState.conversation_key == key, ConversationState.last_message_id == message.id)
+        .values(
+            last_message_id=previous.id if previous else None,
+            last_sender=previous.sender_username if previous else None,
+            last_preview=message_preview(previous.content) if previous else None,
+            last_message_at=previous.timestamp if previous else None
+        )
+    )
+
+# Content-hashed chat images (and their variants) never change, so let clients keep them.
+def mark_immutable(response):
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@app.after_request
+def cache_hashed_uploads(response):
+    if request.endpoint == 'static' and response.status_code == 200:
+        filename = request.view_args.get('filename', '')
+        if filename.startswith('chat_uploads/') and HASHED_UPLOAD_RE.match(os.path.basename(filename)):
+            mark_immutable(response)
+    return response
 
 # Gatekeeper decorator to ensure user is logged in before hitting a view.
 def login_required(f):
-    """Redirect anonymous users to login, otherwise proceed."""
+    """Redirect anonymous users to login, otherwise expose them to the view as g.current_user."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'username' not in session:
             return redirect(url_for('login'))
+        g.current_user = identity_cache.get(session['username'])
+        if g.current_user is None:
+            # The account no longer exists (e.g. a reset database): start over.
+            session.clear()
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Chat History ---
+# History is read into MessageView tuples, not ORM objects. A view is immutable: edits and
+# reaction changes replace it, so a payload memoized for one view can never go stale.
+MessageView = namedtuple('MessageView', 'id username msg image timestamp reactions')
+# timestamp is naive UTC; reactions is a tuple of (emoji, count) in first-reacted order.
+
+def message_view(message, reactions=()):
+    """Snapshot a (possibly unsaved) Message."""
+    return MessageView(message.id, message.sender_username, message.content or "",
+                       message.image_filename, message.timestamp, tuple(reactions))
+
+def queued_views(conversation):
+    """Messages of conversation still waiting for the writer, oldest first (no reactions yet)."""
+    return [MessageView(row['id'], row['sender_username'], row.get('content') or "",
+                        row.get('image_filename'), row['timestamp'], ())
+            for row in message_writer.pending_rows(conversation)]
+
+def get_timezone(name):
+    """ZoneInfo for name, falling back to DEFAULT_TIMEZONE and then UTC."""
+    for candidate in (name, app.config['DEFAULT_TIMEZONE']):
+        try:
+            return ZoneInfo(candidate)
+        except (ZoneInfoNotFoundError, ValueError, TypeError):
+            continue
+    return timezone.utc
+
+TIMEZONE_CHOICES = sorted(available_timezones())
+
+def viewer_timezone():
+    """Valid timezone name for the logged-in user (their choice is kept in the session)."""
+    return getattr(get_timezone(session.get('timezone')), 'key', 'UTC')
+
+def local_time(timestamp, tz_name=None, fmt='%H:%M'):
+    """Format a naive UTC timestamp in the given timezone."""
+    return timestamp.replace(tzinfo=timezone.utc).astimezone(get_timezone(tz_name)).strftime(fmt)
+
+def epoch_ms(timestamp):
+    """Milliseconds since the epoch for a naive UTC timestamp (clients format it locally)."""
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+# Per-message totals read from the counter table in first-reacted order.
+def load_reaction_counts(message_ids):
+    """Map message id -> [(emoji, count)] for the given messages, in one query."""
+    counts = {message_id: [] for message_id in message_ids}
+    if not counts:
+        return counts
+
+    rows = db.session.query(MessageReactionCount.message_id, MessageReactionCount.emoji, MessageReactionCount.count)\
+        .filter(MessageReactionCount.message_id.in_(list(counts)))\
+        .order_by(MessageReactionCount.id)\
+        .all()
+    for message_id, emoji, count in rows:
+        counts[message_id].append((emoji, count))
+    return counts
+
+# The viewer's own reactions on a page, for the highlighted pills.
+def load_own_reactions(message_ids, username):
+    """Return {(message id, emoji)} for the reactions username has left on these messages."""
+    if not message_ids:
+        return set()
+    rows = db.session.query(MessageReaction.message_id, MessageReaction.emoji)\
+        .filter(MessageReaction.message_id.in_(list(message_ids)), MessageReaction.user_username == username)\
+        .all()
+    return set(rows)
+
+def load_reaction_summaries(message_ids, current_user):
+    """Map message id -> list of {emoji, count, user_has_reacted} for the given viewer."""
+    counts = load_reaction_counts(message_ids)
+    own = load_own_reactions(list(counts), current_user)
+    return {message_id: [{
+        'emoji': emoji,
+        'count': count,
+        'user_has_reacted': (message_id, emoji) in own
+    } for emoji, count in tally] for message_id, tally in counts.items()}
+
+# Shared by every viewer in the same timezone, so callers must not mutate the result.
+@lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+def message_payload(view, tz_name):
+    """Serialize a view the way the chat templates and history endpoints expect."""
+    return {
+        'id': view.id,
+        'username': view.username,
+        'msg': view.msg,
+        'image': view.image,
+        'timestamp': local_time(view.timestamp, tz_name),
+        'ts': epoch_ms(view.timestamp),
+        'reactions': [{'emoji': emoji, 'count': count, 'user_has_reacted': False}
+                      for emoji, count in view.reactions]
+    }
+
+# Render views (oldest-first) for the logged-in viewer.
+def render_history(views, current_user):
+    tz_name = viewer_timezone()
+    # Only messages with reactions need the viewer's own reactions looked up.
+    own = load_own_reactions([v.id for v in views if v.reactions], current_user)
+    history = []
+    for view in views:
+        payload = message_payload(view, tz_name)
+        if any((view.id, emoji) in own for emoji, _ in view.reactions):
+            # The viewer's pills are highlighted: copy instead of touching the shared payload.
+            payload = dict(payload, reactions=[
+                dict(r, user_has_reacted=(view.id, r['emoji']) in own) for r in payload['reactions']
+            ])
+        history.append(payload)
+    return history
+
+# Conversation keys: the global feed or a two-way DM thread.
+def global_conversation():
+    return 'global_chat'
+
+def dm_conversation(user_a, user_b):
+    return dm_room_name(user_a, user_b)
+
+# Cursors point at the oldest message already shown: "<timestamp>_<id>".
+def encode_cursor(timestamp, message_id):
+    return f"{timestamp.strftime('%Y%m%d%H%M%S%f')}_{message_id}"
+
+def decode_cursor(cursor):
+    """Parse a history cursor; returns None when it is malformed."""
+    try:
+        stamp, message_id = cursor.split('_', 1)
+        return datetime.strptime(stamp, '%Y%m%d%H%M%S%f'), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+# Keyset pagination on (timestamp, id): newest page first, older pages via cursor.
+def fetch_history_page(conversation, before=None, limit=HISTORY_PAGE_SIZE):
+    """Return (MessageViews oldest-first, cursor for the next older page or None)."""
+    # Read the queue before the table: a row committed in between then shows up in both.
+    queued = [view for view in queued_views(conversation) if before is None or (view.timestamp, view.id) < before]
+    query = db.session.query(
+        Message.id, Message.sender_username, Message.content, Message.image_filename, Message.timestamp
+    ).filter(Message.conversation_key == conversation)
+    if before:
+        timestamp, message_id = before
+        query = query.filter(or_(
+            Message.timestamp < timestamp,
+            and_(Message.timestamp == timestamp, Message.id < message_id)
+        ))
+
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc())\
+        .limit(limit + 1).all()
+    counts = load_reaction_counts([row.id for row in rows])
+    views = [MessageView(message_id, sender, content or "", image, timestamp, tuple(counts[message_id]))
+             for message_id, sender, content, image, timestamp in rows]
+    if queued:
+        stored = {view.id for view in views}
+        views = sorted(views + [view for view in queued if view.id not in stored],
+                       key=lambda view: (view.timestamp, view.id), reverse=True)[:limit + 1]
+    if len(views) <= limit:
+        # The live table ran out; older messages may have been archived.
+        oldest = (views[-1].timestamp, views[-1].id) if views else before
+        views += fetch_archived(conversation, oldest, limit + 1 - len(views))
+
+    has_more = len(views) > limit
+    views = views[:limit][::-1]
+    next_cursor = encode_cursor(views[0].timestamp, views[0].id) if has_more else None
+    return views, next_cursor
+
+# Archive chunks never change, so decoded ones are kept for scroll-back reads.
+@lru_cache(maxsize=ARCHIVE_CHUNK_CACHE)
+def load_archive_chunk(chunk_id):
+    """MessageViews of one archive chunk, oldest first."""
+    payload = db.session.query(MessageArchive.payload).filter_by(id=chunk_id).scalar()
+    return tuple(
+        MessageView(message_id, sender, content or "", image, datetime.fromisoformat(timestamp),
+                    tuple(tuple(r) for r in reactions))
+        for message_id, sender, _, content, image, timestamp, reactions in json.loads(zlib.decompress(payload))
+    )
+
+def fetch_archived(conversation, before, limit):
+    """Up to limit archived views of a conversation older than before (or the newest), newest first."""
+    query = db.session.query(MessageArchive.id).filter(MessageArchive.conversation_key == conversation)
+    if before:
+        timestamp, message_id = before
+        query = query.filter(or_(
+            MessageArchive.first_timestamp < timestamp,
+            and_(MessageArchive.first_timestamp == timestamp, MessageArchive.first_id < message_id)
+        ))
+
+    views = []
+    for (chunk_id,) in query.order_by(MessageArchive.last_timestamp.desc(), MessageArchive.last_id.desc()):
+        for view in reversed(load_archive_chunk(chunk_id)):
+            if before is None or (view.timestamp, view.id) < before:
+                views.append(view)
+                if len(views) == limit:
+                    return views
+    return views
+
+# JSON body for the scroll-back endpoints.
+def history_page_response(conversation, current_user):
+    before = None
+    if request.args.get('before'):
+        before = decode_cursor(request.args['before'])
+        if before is None:
+            abort(400)
+
+    views, next_cursor = fetch_history_page(conversation, before=before)
+    return jsonify({
+        'messages': render_history(views, current_user),
+        'next_cursor': next_cursor
+    })
+
+# --- Recent History Cache ---
+# Newest messages per room (global_chat and each dm_ room) kept in memory as MessageViews so
+# page loads skip SQLite. Rooms are warmed from the DB on first read and kept current by
+# the send/edit/delete/reaction handlers; least recently used rooms are evicted.
+class RoomHistoryCache:
+    def __init__(self, max_rooms=HISTORY_CACHE_ROOMS, per_room=HISTORY_CACHE_PER_ROOM):
+        self.max_rooms = max_rooms
+        self.per_room = per_room
+        self._rooms = OrderedDict()  # room -> {'entries': deque of views oldest-first, 'has_older': bool}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _find(self, room, message_id):
+        """Return (entries, index) of a cached message, or (None, None)."""
+        cached = self._rooms.get(room)
+        if cached:
+            for i, view in enumerate(cached['entries']):
+                if view.id == message_id:
+                    return cached['entries'], i
+        return None, None
+
+    def _warm(self, room, conversation):
+        views, next_cursor = fetch_history_page(conversation, limit=self.per_room)
+        cached = {
+            'entries': deque(views, maxlen=self.per_room),
+            'has_older': next_cursor is not None
+        }
+        self._rooms[room] = cached
+        while len(self._rooms) > self.max_rooms:
+            self._rooms.popitem(last=False)
+            self.evictions += 1
+        return cached
+
+    def page(self, room, conversation, limit=HISTORY_PAGE_SIZE):
+        """Return (newest views oldest-first, cursor for older history or None)."""
+        if not self.max_rooms:
+            # Cache disabled: read straight through to the DB.
+            self.misses += 1
+            return fetch_history_page(conversation, limit=limit)
+
+        cached = self._rooms.get(room)
+        # Deletes can leave a room with less than a page buffered; refill it from the DB.
+        if cached is None or (cached['has_older'] and len(cached['entries']) < limit):
+            self.misses += 1
+            cached = self._warm(room, conversation)
+        else:
+            self.hits += 1
+            self._rooms.move_to_end(room)
+
+        entries = list(cached['entries'])[-limit:]
+        has_more = len(cached['entries']) > len(entries) or cached['has_older']
+        next_cursor = None
+        if has_more and entries:
+            next_cursor = encode_cursor(entries[0].timestamp, entries[0].id)
+        return entries, next_cursor
+
+    def append(self, room, message):
+        # Rooms that are not cached will pick the message up when they are warmed.
+        cached = self._rooms.get(room)
+        if cached is None:
+            return
+        # Warming while the sender waited on a full queue may already have picked it up.
+        if cached['entries'] and cached['entries'][-1].id >= message.id:
+            return
+        if len(cached['entries']) == cached['entries'].maxlen:
+            cached['has_older'] = True
+        cached['entries'].append(message_view(message))
+
+    def update_content(self, room, message_id, content):
+        entries, i = self._find(room, message_id)
+        if entries is not None:
+            entries[i] = entries[i]._replace(msg=content)
+
+    def set_reaction_count(self, room, message_id, emoji, count):
+        # Apply one toggle's new total; a pill that drops to zero goes away.
+        entries, i = self._find(room, message_id)
+        if entries is None:
+            return
+        reactions = [(e, c) for e, c in entries[i].reactions if e != emoji or count > 0]
+        if count > 0:
+            if any(e == emoji for e, _ in reactions):
+                reactions = [(e, count if e == emoji else c) for e, c in reactions]
+            else:
+                reactions.append((emoji, count))
+        entries[i] = entries[i]._replace(reactions=tuple(reactions))
+
+    def remove(self, room, message_id):
+        entries, i = self._find(room, message_id)
+        if entries is not None:
+            del entries[i]
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'rooms': len(self._rooms),
+            'messages': sum(len(c['entries']) for c in self._rooms.values()),
+            'max_rooms': self.max_rooms,
+            'per_room': self.per_room
+        }
+
+history_cache = RoomHistoryCache()
+
+# --- Friend Graph ---
+# Accepted friends per user, kept in memory so the DM sidebar and relationship checks
+# are dict lookups. Each user has a generation counter in the shared store; changing a
+# friendship bumps it for both users, which invalidates their cached sets on every worker.
+class FriendGraph:
+    def __init__(self, store, max_users=FRIEND_CACHE_USERS):
+        self.store = store
+        self.max_users = max_users
+        self._users = OrderedDict()  # user id -> (generation, {friend id: username})
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _generation_key(user_id):
+        return f"friends:gen:{user_id}"
+
+    def _load(self, user_id):
+        rows = db.session.query(User.id, User.username).join(Friendship, or_(
+            and_(Friendship.low_id == user_id, Friendship.high_id == User.id),
+            and_(Friendship.high_id == user_id, Friendship.low_id == User.id)
+        )).filter(Friendship.status == 'accepted').all()
+        return dict(rows)
+
+    def friends(self, user_id):
+        """Return {friend id: username} for user_id's accepted friendships."""
+        generation = self.store.get(self._generation_key(user_id)) or 0
+        cached = self._users.get(user_id)
+        if cached and cached[0] == generation:
+            self.hits += 1
+            self._users.move_to_end(user_id)
+            return cached[1]
+
+        self.misses += 1
+        friends = self._load(user_id)
+        self._users[user_id] = (generation, friends)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return friends
+
+    def are_friends(self, user_id, other_id):
+        return other_id in self.friends(user_id)
+
+    def invalidate(self, *user_ids):
+        """Call after committing a friendship change that involves these users."""
+        for user_id in user_ids:
+            self.store.incr(self._generation_key(user_id))
+            self._users.pop(user_id, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'users': len(self._users),
+            'max_users': self.max_users
+        }
+
+friend_graph = FriendGraph(shared_store)
+
+# --- Identity Cache ---
+# The columns a request needs to know who is logged in, kept for IDENTITY_CACHE_TTL seconds
+# so login_required does not query the user table on every request. account() invalidates
+# its own entry; other workers pick up the change when their copy expires.
+Identity = namedtuple('Identity', 'id username profile_pic timezone')
+
+class IdentityCache:
+    def __init__(self, max_users=IDENTITY_CACHE_USERS, ttl=IDENTITY_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._by_name = OrderedDict()  # username -> (expires at, Identity)
+        self._by_id = {}  # user id -> username
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, condition):
+        row = db.session.query(User.id, User.username, User.profile_pic, User.timezone)\
+            .filter(condition).first()
+        return Identity(*row) if row else None
+
+    def _lookup(self, username, condition):
+        cached = self._by_name.get(username) if username is not None else None
+        if cached and cached[0] > time.monotonic():
+            self.hits += 1
+            self._by_name.move_to_end(username)
+            return cached[1]
+
+        self.misses += 1
+        identity = self._load(condition)
+        if identity is None:
+            return None
+        self._by_name[identity.username] = (time.monotonic() + self.ttl, identity)
+        self._by_name.move_to_end(identity.username)
+        self._by_id[identity.id] = identity.username
+        while len(self._by_name) > self.max_users:
+            _, (_, evicted) = self._by_name.popitem(last=False)
+            self._by_id.pop(evicted.id, None)
+        return identity
+
+    def get(self, username):
+        """Identity for username, or None when there is no such user."""
+        return self._lookup(username, User.username == username)
+
+    def get_by_id(self, user_id):
+        return self._lookup(self._by_id.get(user_id), User.id == user_id)
+
+    def invalidate(self, username):
+        """Call after committing a change to this user's row."""
+        cached = self._by_name.pop(username, None)
+        if cached:
+            self._by_id.pop(cached[1].id, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'users': len(self._by_name),
+            'max_users': self.max_users,
+            'ttl': self.ttl
+        }
+
+identity_cache = IdentityCache()
+
+# --- Maintenance ---
+# Keeps a long-running database and upload folders from growing forever:
+#   1. messages past RETENTION_DAYS move into MessageArchive chunks (history still pages into them),
+#   2. upload files no row refers to are deleted,
+#   3. SQLite free pages are handed back with incremental VACUUM.
+# Work is done in small batches with pauses in between so a live server keeps serving.
+ARCHIVE_BATCH = 500  # Messages archived per transaction
+MAINTENANCE_MAX_BATCHES = 100  # Per room type and run; the rest waits for the next run
+MAINTENANCE_PAUSE = 0.2  # Seconds between batches
+SWEEP_BATCH = 100  # Files removed between pauses
+ORPHAN_GRACE_SECONDS = 3600  # Newer files are never swept (uploads in flight, uncommitted avatars)
+VACUUM_PAGES = 1000  # Pages freed per incremental VACUUM step
+VACUUM_MAX_STEPS = 100
+
+# Conversation key ranges per room type (index range scans on the conversation key).
+ROOM_TYPES = {
+    'global': ('global_chat', 'global_chat'),
+    'dm': ('dm_', 'dm_\U0010ffff'),
+}
+
+metrics.counter('pychat_maintenance_archived_messages_total', 'Messages moved into archive chunks.')
+metrics.counter('pychat_maintenance_removed_files_total', 'Orphaned upload files deleted.')
+metrics.counter('pychat_maintenance_vacuumed_pages_total', 'SQLite pages released by incremental VACUUM.')
+
+class Maintenance:
+    RUN_KEY = 'maintenance:run'  # Token bucket that lets one worker per interval do the work
+
+    def __init__(self, store):
+        self.store = store
+        self._stopping = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.last_run = None
+
+    def _pause(self):
+        self._stopping.wait(MAINTENANCE_PAUSE)
+
+    def _archive_batch(self, room_type, cutoff):
+        low, high = ROOM_TYPES[room_type]
+        rows = db.session.query(
+            Message.id, Message.conversation_key, Message.sender_username, Message.recipient_username,
+            Message.content, Message.image_filename, Message.timestamp
+        ).filter(Message.conversation_key.between(low, high), Message.timestamp < cutoff)\
+            .order_by(Message.conversation_key, Message.timestamp, Message.id)\
+            .limit(ARCHIVE_BATCH).all()
+        if not rows:
+            return 0
+
+        # Reaction totals are frozen into the archive; the reaction rows go with the message.
+        ids = [row.id for row in rows]
+        counts = load_reaction_counts(ids)
+        chunks = OrderedDict()
+        for row in rows:
+            chunks.setdefault((row.conversation_key, row.timestamp.strftime('%Y-%m')), []).append(row)
+        for (conversation_key, period), chunk in chunks.items():
+            payload = [[r.id, r.sender_username, r.recipient_username, r.content, r.image_filename,
+                        r.timestamp.isoformat(), counts[r.id]] for r in chunk]
+            db.session.add(MessageArchive(
+                conversation_key=conversation_key,
+                period=period,
+                first_timestamp=chunk[0].timestamp,
+                first_id=chunk[0].id,
+                last_timestamp=chunk[-1].timestamp,
+                last_id=chunk[-1].id,
+                message_count=len(chunk),
+                payload=zlib.compress(json.dumps(payload).encode())
+            ))
+        # Stored images keep their references: archived messages still show them.
+        db.session.execute(db.delete(MessageReaction).where(MessageReaction.message_id.in_(ids)))
+        db.session.execute(db.delete(MessageReactionCount).where(MessageReactionCount.message_id.in_(ids)))
+        db.session.execute(db.delete(Message).where(Message.id.in_(ids)))
+        db.session.commit()
+        return len(rows)
+
+    def archive_expired(self):
+        """Move messages past their room type's retention into archive chunks."""
+        archived = 0
+        for room_type, days in app.config['RETENTION_DAYS'].items():
+            if not days:
+                continue
+            cutoff = datetime.utcnow() - timedelta(days=days)
+            for _ in range(MAINTENANCE_MAX_BATCHES):
+                moved = self._archive_batch(room_type, cutoff)
+                archived += moved
+                if moved < ARCHIVE_BATCH or self._stopping.is_set():
+                    break
+                self._pause()
+        metrics.inc('pychat_maintenance_archived_messages_total', amount=archived)
+        return archived
+
+    def _sweep_folder(self, folder, keep):
+        removed = 0
+        now = time.time()
+        for directory in [folder] + [os.path.join(folder, variant) for variant in IMAGE_VARIANTS]:
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.startswith('.') or name in keep or not os.path.isfile(path):
+                    continue
+                # A .pending upload can still be claimed until its token expires.
+                grace = ORPHAN_GRACE_SECONDS + (UPLOAD_TOKEN_MAX_AGE if name.endswith('.pending') else 0)
+                if os.path.getmtime(path) > now - grace:
+                    continue
+                os.remove(path)
+                removed += 1
+                if removed % SWEEP_BATCH == 0:
+                    self._pause()
+        return removed
+
+    def sweep_orphans(self):
+        """Delete chat images and avatars (and their variants) that nothing refers to."""
+        stored = {filename for (filename,) in db.session.query(StoredImage.filename)}
+        avatars = {pic for (pic,) in db.session.query(User.profile_pic).filter(User.profile_pic.isnot(None))}
+        # Don't hold a read transaction open while walking the folders.
+        db.session.remove()
+        removed = self._sweep_folder(app.config['CHAT_UPLOAD_FOLDER'], stored)
+        removed += self._sweep_folder(app.config['UPLOAD_FOLDER'], avatars)
+        metrics.inc('pychat_maintenance_removed_files_total', amount=removed)
+        return removed
+
+    def vacuum(self, full=False):
+        """Release free SQLite pages; full=True first switches an old database to incremental mode."""
+        if db.engine.dialect.name != 'sqlite':
+            return 0
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if full:
+                # Rewrites the whole file and blocks writers meanwhile; run it off-peak, once.
+                connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                connection.exec_driver_sql("VACUUM")
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                log.info("Database is not in incremental auto_vacuum mode; run 'flask maintenance --full-vacuum'")
+                return 0
+            released = 0
+            for _ in range(VACUUM_MAX_STEPS):
+                free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+                if not free or self._stopping.is_set():
+                    break
+                connection.exec_driver_sql(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+                released += min(free, VACUUM_PAGES)
+                self._pause()
+        metrics.inc('pychat_maintenance_vacuumed_pages_total', amount=released)
+        return released
+
+    def run_once(self, full_vacuum=False):
+        """Archive, sweep and vacuum once; returns what was done."""
+        started = time.monotonic()
+        result = {
+            'archived_messages': self.archive_expired(),
+            'removed_files': self.sweep_orphans(),
+            'vacuumed_pages': self.vacuum(full=full_vacuum),
+        }
+        result['seconds'] = round(time.monotonic() - started, 3)
+        result['finished_at'] = datetime.utcnow().isoformat()
+        self.runs += 1
+        self.last_run = result
+        log.info("Maintenance: %s", result)
+        return result
+
+    def _run(self):
+        interval = app.config['MAINTENANCE_INTERVAL']
+        with app.app_context():
+            while not self._stopping.wait(interval):
+                # With several workers sharing the store, only the first one each interval runs.
+                if self.store.take_token(self.RUN_KEY, 1, 1 / interval):
+                    continue
+                try:
+                    self.run_once()
+                except Exception:
+                    db.session.rollback()
+                    log.exception("Maintenance run failed")
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        if self._thread is None and app.config['MAINTENANCE_INTERVAL'] > 0:
+            self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def stats(self):
+        return {'runs': self.runs, 'last_run': self.last_run,
+                'interval': app.config['MAINTENANCE_INTERVAL'],
+                'retention_days': app.config['RETENTION_DAYS']}
+
+maintenance = Maintenance(shared_store)
+maintenance.start()
+atexit.register(maintenance.stop)
+
+@app.cli.command('maintenance')
+@click.option('--full-vacuum', is_flag=True,
+              help='Rewrite the database once to enable incremental VACUUM (blocks writers while it runs).')
+# Run one maintenance pass now, e.g. from cron: flask --app app maintenance
+def maintenance_command(full_vacuum):
+    """Archive expired messages, delete orphaned uploads and release free database pages."""
+    click.echo(json.dumps(maintenance.run_once(full_vacuum=full_vacuum)))
+
+# --- Search ---
+SEARCH_PAGE_SIZE = 20
+USER_SEARCH_LIMIT = 50
+USER_SEARCH_MIN_SUBSTRING = 3  # Trigram lookups need at least three characters
+SNIPPET_OPEN, SNIPPET_CLOSE = '\x02', '\x03'  # Match markers, swapped for <mark> after escaping
+
+def fts_query(raw_query):
+    """Turn free text into an FTS5 query: every word must appear, as a word prefix."""
+    return ' '.join(f'"{term}"*' for term in re.findall(r'\w+', raw_query))
+
+def highlight_snippet(snippet):
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>'))
+
+# Ranked message search over the global chat and the viewer's own DMs.
+def search_messages(username, raw_query, page=1):
+    """Return (results best-first, has_more) for one page of matches visible to username."""
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    visible = "(m.conversation_key = 'global_chat' OR m.sender_username = :user OR m.recipient_username = :user)"
+    if search_index_ready:
+        match = fts_query(raw_query)
+        if not match:
+            return [], False
+        rows = db.session.execute(text(
+            "SELECT m.id, m.sender_username, m.recipient_username, m.timestamp, "
+            "snippet(message_fts, 0, :open, :close, '…', 12) "
+            "FROM message_fts JOIN message m ON m.id = message_fts.rowid "
+            f"WHERE message_fts MATCH :match AND {visible} "
+            "ORDER BY bm25(message_fts), m.id DESC LIMIT :limit OFFSET :offset"
+        ), {'match': match, 'user': username, 'open': SNIPPET_OPEN, 'close': SNIPPET_CLOSE,
+            'limit': SEARCH_PAGE_SIZE + 1, 'offset': offset}).all()
+    else:
+        # No FTS5 (e.g. a server database): unranked substring scan, newest first.
+        rows = db.session.execute(text(
+            "SELECT m.id, m.sender_username, m.recipient_username, m.timestamp, m.content "
+            f"FROM message m WHERE lower(m.content) LIKE :pattern AND {visible} "
+            "ORDER BY m.timestamp DESC, m.id DESC LIMIT :limit OFFSET :offset"
+        ), {'pattern': f"%{raw_query.lower()}%", 'user': username,
+            'limit': SEARCH_PAGE_SIZE + 1, 'offset': offset}).all()
+
+    results = []
+    for message_id, sender, recipient, timestamp, snippet in rows[:SEARCH_PAGE_SIZE]:
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        results.append({
+            'id': message_id,
+            'username': sender,
+            # The other side of a DM, None for the global chat.
+            'partner': (recipient if sender == username else sender) if recipient else None,
+            'timestamp': local_time(timestamp, viewer_timezone(), '%d %b %Y %H:%M'),
+            'snippet': highlight_snippet(snippet or '')
+        })
+    return results, len(rows) > SEARCH_PAGE_SIZE
+
+# Username search for the DM sidebar.
+def search_users(raw_query, exclude_username):
+    """Users whose name contains raw_query (shortest names first), without exclude_username."""
+    query = db.session.query(User.id, User.username).filter(User.username != exclude_username)
+    if search_index_ready and len(raw_query) >= USER_SEARCH_MIN_SUBSTRING:
+        phrase = '"' + raw_query.replace('"', '""') + '"'
+        ids = text("SELECT rowid FROM user_fts WHERE user_fts MATCH :phrase").bindparams(phrase=phrase)
+        query = query.filter(User.id.in_(ids.columns(rowid=db.Integer)))
+    else:
+        # Too short for trigrams (or no index): a case-insensitive scan, cut off by the limit.
+        query = query.filter(User.username.ilike(f"%{raw_query}%"))
+    return query.order_by(func.length(User.username), User.username).limit(USER_SEARCH_LIMIT).all()
+
 # --- Routes ---
 
 @app.route('/')
 @login_required
+@read_only_db
 # Home feed showing recent global chat history.
 def index():
-    # Global Chat History: pull latest 50 messages and fan them out to the template.
-    messages = Message.query.filter_by(recipient_username=None)\
-        .order_by(Message.timestamp.desc())\
-        .limit(50).all()
-    messages = messages[::-1]
-    
-    history = []
+    # Global Chat History: newest page from the hot cache; older pages load on scroll via global_history.
+    # The event log position is read first, so a reconnect replays anything newer than the page.
+    event_epoch, event_seq = event_log.position('global_chat')
+    entries, next_cursor = history_cache.page('global_chat', global_conversation())
+
     current_user = session.get('username')
+    history = render_history(entries, current_user)
 
-    for m in messages:
-        reactions = MessageReaction.query.filter_by(message_id=m.id).all()
-        # Collapse reactions into counts plus who reacted for tooltip rendering.
-        reactions_map = {}
-        for r in reactions:
-            if r.emoji not in reactions_map:
-                reactions_map[r.emoji] = {'count': 0, 'users': []}
-            reactions_map[r.emoji]['count'] += 1
-            reactions_map[r.emoji]['users'].append(r.user_username)
-        
-        reactions_list = []
-        for emoji, data in reactions_map.items():
-            reactions_list.append({
-                'emoji': emoji,
-                'count': data['count'],
-                'user_has_reacted': current_user in data['users']
-            })
-
-        history.append({
-            'id': m.id, 
-            'username': m.sender_username, 
-            'msg': m.content if m.content else "", 
-            'image': m.image_filename,
-            'timestamp': m.timestamp.strftime('%H:%M'),
-            'reactions': reactions_list
-        })
-    
-    return render_template('index.html', username=current_user, history=history)
+    return render_template('index.html', username=current_user, history=history, next_cursor=next_cursor,
+                           event_epoch=event_epoch, event_seq=event_seq, user_timezone=viewer_timezone())
 
 @app.route('/dms', methods=['GET', 'POST'])
 @app.route('/dms/<username>', methods=['GET', 'POST'])
 @login_required
+@read_only_db
 # search friends and load a conversation thread when selected.
 def dms(username=None):
     current_username = session.get('username')
-    current_user_obj = User.query.filter_by(username=current_username).first()
     
     # Optional search box to find people to message.
     search_results = []
     if request.method == 'POST':
         search_query = request.form.get('search_username', '').strip()
         if search_query:
-            results = User.query.filter(User.username.ilike(f"%{search_query}%"), User.username != current_username).all()
-            search_results = results
-
-    # Build accepted friendships in both directions to show the sidebar list.
-    friends_sent = Friendship.query.filter_by(sender_id=current_user_obj.id, status='accepted').all()
-    friends_received = Friendship.query.filter_by(receiver_id=current_user_obj.id, status='accepted').all()
-    
+            search_results = search_users(search_query, current_username)
+
+    # Accepted friends for the sidebar, straight from the friend graph cache, with each
+    # thread's unread count and latest message from the user's read state rows.
+    states = {state.conversation_key: state for state in db.session.query(
+        ConversationState.conversation_key, ConversationState.unread_count,
+        ConversationState.last_sender, ConversationState.last_preview, ConversationState.last_message_id
+    ).filter(ConversationState.user_username == current_username)}
     friends = []
-    for f in friends_sent:
-        friends.append(f.receiver)
-    for f in friends_received:
-        friends.append(f.sender)
+    for friend_id, friend_username in friend_graph.friends(g.current_user.id).items():
+        state = states.get(dm_room_name(current_username, friend_username))
+        friends.append({
+            'id': friend_id,
+            'username': friend_username,
+            'unread': state.unread_count if state else 0,
+            'has_messages': bool(state and state.last_message_id),
+            'last_sender': state.last_sender if state else None,
+            'preview': state.last_preview if state else None
+        })
+    friends.sort(key=lambda f: f['username'].lower())
 
     history = []
+    next_cursor = None
+    seen_through = 0
+    event_epoch, event_seq = None, 0
     if username:
-        # Fetch the thread between the two users, sorted oldest-first.
-        messages = Message.query.filter(
-            or_(
-                (Message.sender_username == current_username) & (Message.recipient_username == username),
-                (Message.sender_username == username) & (Message.recipient_username == current_username)
-            )
-        ).order_by(Message.timestamp.asc()).all()
-        
-        for m in messages:
-            # Reactions logic
-            reactions = MessageReaction.query.filter_by(message_id=m.id).all()
-            reactions_map = {}
-            for r in reactions:
-                if r.emoji not in reactions_map:
-                    reactions_map[r.emoji] = {'count': 0, 'users': []}
-                reactions_map[r.emoji]['count'] += 1
-                reactions_map[r.emoji]['users'].append(r.user_username)
-            
-            reactions_list = []
-            for emoji, data in reactions_map.items():
-                reactions_list.append({
-                    'emoji': emoji,
-                    'count': data['count'],
-                    'user_has_reacted': current_username in data['users']
-                })
-
-            romania_tz = timezone(timedelta(hours=2))
-            current_time = datetime.now(romania_tz).strftime('%H:%M')
-            history.append({
-                'id': m.id,
-                'sender_username': m.sender_username,
-                'content': m.content,
-                'image_filename': m.image_filename,
-                'timestamp': current_time,
-                'reactions': reactions_list
-            })
+        event_epoch, event_seq = event_log.position(dm_room_name(current_username, username))
+        # How far the other side has read, for the "Seen" marker.
+        seen_through = db.session.query(ConversationState.last_read_id)\
+            .filter(_conversation_state(username, dm_room_name(current_username, username))).scalar() or 0
+        # Newest page of the thread from the hot cache; older pages load on scroll via dm_history.
+        entries, next_cursor = history_cache.page(dm_room_name(current_username, username),
+                                                  dm_conversation(current_username, username))
+        history = render_history(entries, current_username)
 
     return render_template('dms.html', 
                          users_list=friends,
                          search_results=search_results,
                          active_recipient=username, 
-                         history=history)
+                         history=history,
+                         next_cursor=next_cursor,
+                         seen_through=seen_through,
+                         event_epoch=event_epoch,
+                         event_seq=event_seq,
+                         user_timezone=viewer_timezone())
+
+@app.route('/search')
+@login_required
+@read_only_db
+# Full-text search over the global chat and your own DMs.
+def search():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, has_more = search_messages(session['username'], query, page) if query else ([], False)
+    return render_template('search.html', query=query, results=results, page=page, has_more=has_more)
+
+@app.route('/history/global')
+@login_required
+@read_only_db
+# Older pages of the global feed, before the given cursor.
+def global_history():
+    return history_page_response(global_conversation(), session.get('username'))
+
+@app.route('/history/dm/<username>')
+@login_required
+@read_only_db
+# Older pages of a DM thread with the logged-in user, before the given cursor.
+def dm_history(username):
+    current_username = session.get('username')
+    return history_page_response(dm_conversation(current_username, username), current_username)
+
+@app.route('/media/<kind>/<variant>/<path:filename>')
+# Serve a resized variant of an upload, falling back to the original until it exists.
+def media(kind, variant, filename):
+    if kind not in MEDIA_FOLDERS or variant not in IMAGE_VARIANTS:
+        abort(404)
+    folder = app.config[MEDIA_FOLDERS[kind]]
+    try:
+        response = send_from_directory(os.path.join(folder, variant), filename)
+    except NotFound:
+        # The variant may show up moments later; the fallback stays uncacheable (no-cache).
+        return send_from_directory(folder, filename)
+
+    if kind == 'chat' and HASHED_UPLOAD_RE.match(filename):
+        mark_immutable(response)
+    return response
+
+@app.route('/upload', methods=['POST'])
+@login_required
+# Stream a chat image to disk; the returned token is then sent over the socket.
+def upload_chat_image():
+    retry_after = rate_limiter.hit('upload', session['username'])
+    if retry_after > 0:
+        return jsonify({'error': f'Too many uploads. Try again in {ceil(retry_after)}s.'}), 429
+
+    file_name = request.args.get('name') or request.headers.get('X-File-Name')
+    try:
+        pending_name, sha256, ext = save_chat_upload(request.stream, file_name)
+    except UploadRejected as e:
+        return jsonify({'error': str(e)}), e.status
+
+    token = upload_tokens.dumps({
+        'pending': pending_name,
+        'sha256': sha256,
+        'ext': ext,
+        'user': session['username']
+    })
+    return jsonify({'token': token})
+
+@app.route('/stats/history_cache')
+@login_required
+# Hit/miss/eviction counters for sizing the recent-history cache.
+def history_cache_stats():
+    return jsonify(history_cache.stats())
+
+@app.route('/stats/message_writer')
+@login_required
+# Queue depth and batch counters for the write-behind message writer.
+def message_writer_stats():
+    return jsonify(message_writer.stats())
+
+# Point-in-time values for /metrics: connections, room sizes and queue/cache depths.
+def runtime_gauges():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    dm_sizes = [len(members) for room, members in rooms.items() if isinstance(room, str) and room.startswith('dm_')]
+    return [
+        ('pychat_connected_clients', 'Socket.IO clients connected to this process.',
+         [({}, len(rooms.get(None, {})))]),
+        ('pychat_room_members', 'Clients in the global chat room.',
+         [({'room': 'global_chat'}, len(rooms.get('global_chat', {})))]),
+        ('pychat_dm_rooms_active', 'DM rooms with at least one connected client.', [({}, len(dm_sizes))]),
+        ('pychat_dm_room_members', 'Clients across all DM rooms.', [({}, sum(dm_sizes))]),
+        ('pychat_history_cache_rooms', 'Rooms held in the recent-history cache.',
+         [({}, history_cache.stats()['rooms'])]),
+        ('pychat_message_writer_pending', 'Messages queued for the write-behind writer.',
+         [({}, message_writer.stats()['pending'])]),
+        ('pychat_friend_graph_users', 'Users with a cached friend list.', [({}, friend_graph.stats()['users'])]),
+        ('pychat_identity_cache_users', 'Logged-in users with a cached identity.',
+         [({}, identity_cache.stats()['users'])]),
+        ('pychat_fanout_pending', 'Room events held for the next batch.', [({}, fanout.pending())]),
+        ('pychat_event_log_events', 'Broadcasts held for reconnect replay.', [({}, event_log.stats()['events'])]),
+        ('pychat_pool_pending', 'Calls running or waiting in each worker pool.',
+         [({'pool': pool.name}, pool.stats()['pending']) for pool in (cpu_pool, io_pool, image_pool)]),
+        ('pychat_presence_sockets', 'Sockets tracked by the presence registry.', [({}, presence.stats()['sockets'])]),
+    ]
+
+@app.route('/metrics')
+# Prometheus scrape endpoint for this process.
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    if token and not secrets.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+        abort(401)
+    return Response(metrics.render(runtime_gauges()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats/maintenance')
+@login_required
+# Last maintenance run (archived messages, swept files, vacuumed pages).
+def maintenance_stats():
+    return jsonify(maintenance.stats())
+
+@app.route('/stats/event_log')
+@login_required
+# Rooms and events held for reconnect replay.
+def event_log_stats():
+    return jsonify(event_log.stats())
+
+@app.route('/stats/presence')
+@login_required
+# Sizes of the in-memory presence registry.
+def presence_stats():
+    return jsonify(presence.stats())
+
+@app.route('/stats/friend_graph')
+@login_required
+# Hit/miss counters for the cached friend lists.
+def friend_graph_stats():
+    return jsonify(friend_graph.stats())
 
 @app.route('/send_request/<username>')
 @login_required
 # Send a friend request to another user if none exists.
 def send_request(username):
-    sender = User.query.filter_by(username=session['username']).first()
-    receiver = User.query.filter_by(username=username).first()
+    sender = g.current_user
+    receiver = identity_cache.get(username)
     
     if not receiver:
         flash('User not found.')
         return redirect(url_for('dms'))
     
-    # Stop duplicate or crossed requests between the same pair.
-    existing = Friendship.query.filter(
-        or_(
-            (Friendship.sender_id == sender.id) & (Friendship.receiver_id == receiver.id),
-            (Friendship.sender_id == receiver.id) & (Friendship.receiver_id == sender.id)
-        )
-    ).first()
+    # One row per pair (unique pair key) stops duplicate or crossed requests.
+    low_id, high_id = friendship_pair(sender.id, receiver.id)
+    existing = Friendship.query.filter_by(low_id=low_id, high_id=high_id).first()
     
-    if existing:
+    if existing or sender.id == receiver.id:
         flash('Friendship or request already exists.')
     else:
         req = Friendship(sender_id=sender.id, receiver_id=receiver.id, status='pending')
         db.session.add(req)
-        db.session.commit()
-        flash(f'Friend request sent to {username}!')
+        try:
+            commit_session()
+        except IntegrityError:
+            # The other user asked at the same moment.
+            db.session.rollback()
+            flash('Friendship or request already exists.')
+        else:
+            friend_graph.invalidate(sender.id, receiver.id)
+            flash(f'Friend request sent to {username}!')
         
     if request.referrer and 'profile' in request.referrer:
         return redirect(request.referrer)
@@ -268,14 +2614,16 @@ def send_request(username):
 # Accept an incoming friend request.
 def accept_request(request_id):
     req = Friendship.query.get_or_404(request_id)
-    current_user = User.query.filter_by(username=session['username']).first()
     
-    if req.receiver_id != current_user.id:
+    if req.receiver_id != g.current_user.id:
         abort(403)
     # Flip to accepted; one row represents the friendship.
     req.status = 'accepted'
-    db.session.commit()
-    flash(f'You are now friends with {req.sender.username}!')
+    commit_session()
+    friend_graph.invalidate(req.sender_id, req.receiver_id)
+    sender = identity_cache.get_by_id(req.sender_id)
+    # The sender's account may have been deleted since they sent the request.
+    flash(f'You are now friends with {sender.username}!' if sender else 'Friend request accepted.')
     return redirect(url_for('account'))
 
 @app.route('/reject_request/<int:request_id>')
@@ -283,43 +2631,41 @@ def accept_request(request_id):
 # Reject (delete) an incoming friend request.
 def reject_request(request_id):
     req = Friendship.query.get_or_404(request_id)
-    current_user = User.query.filter_by(username=session['username']).first()
     
-    if req.receiver_id != current_user.id:
+    if req.receiver_id != g.current_user.id:
         abort(403)
     # Reject by deleting the pending record entirely.
     db.session.delete(req)
-    db.session.commit()
+    commit_session()
+    friend_graph.invalidate(req.sender_id, req.receiver_id)
     flash('Friend request removed.')
     return redirect(url_for('account'))
 
 @app.route('/profile/<username>')
 @login_required
+@read_only_db
 # View a user's profile and the relationship status with them.
 def profile(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.query.options(db.load_only(User.id, User.username, User.email, User.bio, User.profile_pic))\
+        .filter_by(username=username).first_or_404()
     
     current_username = session.get('username')
-    current_user = User.query.filter_by(username=current_username).first()
+    current_user = g.current_user
     
     # Compute friendship status so the template can show the right buttons.
     friendship_status = 'none' # Default: no relationship
     
     if current_username == username:
         friendship_status = 'self'
+    elif friend_graph.are_friends(current_user.id, user.id):
+        friendship_status = 'friends'
     else:
-        # Check database for any existing friendship record
-        friendship = Friendship.query.filter(
-            or_(
-                (Friendship.sender_id == current_user.id) & (Friendship.receiver_id == user.id),
-                (Friendship.sender_id == user.id) & (Friendship.receiver_id == current_user.id)
-            )
-        ).first()
+        # Not friends: one pair-key lookup tells whether a request is pending.
+        low_id, high_id = friendship_pair(current_user.id, user.id)
+        friendship = Friendship.query.filter_by(low_id=low_id, high_id=high_id).first()
 
         if friendship:
-            if friendship.status == 'accepted':
-                friendship_status = 'friends'
-            elif friendship.status == 'pending':
+            if friendship.status == 'pending':
                 if friendship.sender_id == current_user.id:
                     friendship_status = 'pending_sent'     # You sent the request
                 else:
@@ -332,34 +2678,46 @@ def profile(username):
 # Manage your own profile info and see pending requests.
 def account():
     username = session.get('username')
-    user = User.query.filter_by(username=username).first()
+    user = User.query.options(db.load_only(
+        User.id, User.username, User.email, User.bio, User.profile_pic, User.timezone
+    )).filter_by(username=username).first()
 
     # Basic profile edit (email/bio) plus optional profile picture upload.
     if request.method == 'POST':
         email = request.form.get('email', '').strip()
         bio = request.form.get('bio', '').strip()
+        tz_name = request.form.get('timezone', '').strip() or None
         
         if not email:
             flash('Email is required.')
+        elif tz_name and tz_name not in TIMEZONE_CHOICES:
+            flash('Unknown timezone.')
         else:
             user.email = email
             user.bio = bio
+            user.timezone = tz_name
+            session['timezone'] = tz_name
             if 'profile_pic' in request.files:
                 file = request.files['profile_pic']
                 if file and file.filename != '' and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     unique_filename = f"{user.id}_{filename}"
                     file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                    file.save(file_path)
+                    io_pool.run(file.save, file_path)
                     user.profile_pic = unique_filename
-            db.session.commit()
+                    schedule_image_variants(app.config['UPLOAD_FOLDER'], unique_filename)
+            commit_session()
+            identity_cache.invalidate(username)
             flash('Profile updated successfully!')
             return redirect(url_for('account'))
 
     # Show pending incoming requests on the account page.
-    pending_requests = Friendship.query.filter_by(receiver_id=user.id, status='pending').all()
+    pending_requests = Friendship.query.options(
+        db.joinedload(Friendship.sender).load_only(User.username, User.profile_pic))\
+        .filter_by(receiver_id=user.id, status='pending').all()
 
-    return render_template('account.html', user=user, pending_requests=pending_requests)
+    return render_template('account.html', user=user, pending_requests=pending_requests,
+                           timezones=TIMEZONE_CHOICES, default_timezone=app.config['DEFAULT_TIMEZONE'])
 
 @app.route('/login', methods=['GET', 'POST'])
 # Log a user in by checking username/password.
@@ -369,8 +2727,10 @@ def login():
         password = request.form.get('password', '')
         user = User.query.filter_by(username=username).first()
         # Check the hashed password and, if valid, stash the username in session.
-        if user and check_password_hash(user.password, password):
+        # Hashing is deliberately slow; it runs in the cpu pool so the event loop keeps going.
+        if user and cpu_pool.run(check_password_hash, user.password, password):
             session['username'] = user.username
+            session['timezone'] = user.timezone
             return redirect(url_for('index'))
         flash('Invalid username or password')
     return render_template('login.html')
@@ -386,7 +2746,7 @@ def register():
 
         if not username or not password or not email:
             flash('All fields (Username, Password, Email) are mandatory.')
-        elif User.query.filter_by(username=username).first():
+        elif db.session.query(User.id).filter_by(username=username).first():
             flash('Username already exists')
         else:
             # Save an optional profile picture; name is prefixed for uniqueness.
@@ -399,14 +2759,15 @@ def register():
                         unique_filename = f"{username}_{int(datetime.utcnow().timestamp())}_{filename}"
                         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
                         try:
-                            file.save(file_path)
+                            io_pool.run(file.save, file_path)
                             profile_pic_filename = unique_filename
+                            schedule_image_variants(app.config['UPLOAD_FOLDER'], unique_filename)
                         except Exception as e:
-                            print(f"Error saving profile pic: {e}")
+                            log.error("Error saving profile pic: %s", e)
                     else:
                         flash('Invalid file type. Allowed: png, jpg, jpeg, gif')
             
-            pw_hash = generate_password_hash(password)
+            pw_hash = cpu_pool.run(generate_password_hash, password)
             new_user = User(
                 username=username, 
                 password=pw_hash, 
@@ -416,7 +2777,7 @@ def register():
             )
             
             db.session.add(new_user)
-            db.session.commit()
+            commit_session()
             flash('Registration successful. Please log in.')
             return redirect(url_for('login'))
             
@@ -428,174 +2789,594 @@ def logout():
     session.pop('username', None)
     return redirect(url_for('login'))
 
+# --- Wire Format ---
+# Room broadcasts are sent once per member, so their size is multiplied by the room size.
+# With COMPACT_PAYLOADS their keys are swapped for the short codes below before they are
+# queued, and 'timestamp' is dropped because clients format 'ts' themselves. Pages hand the
+# table to the clients, which expand the keys before any handler runs. Replies to a single
+# socket keep their full keys.
+FIELD_CODES = {
+    'id': 'i',
+    'username': 'u',
+    'sender': 's',
+    'msg': 'm',
+    'image': 'f',
+    'ts': 't',
+    'message_id': 'x',
+    'content': 'c',
+    'emoji': 'e',
+    'delta': 'd',
+    'count': 'n',
+    'last_read_id': 'r',
+    'online': 'on',
+    'offline': 'off',
+    'typing': 'ty',
+    'stopped': 'st',
+    'seq': 'q',
+}
+
+def compact_payload(data):
+    """Return data with its keys replaced by FIELD_CODES."""
+    if not isinstance(data, dict):
+        return data
+    return {FIELD_CODES.get(key, key): value for key, value in data.items()
+            if not (key == 'timestamp' and 'ts' in data)}
+
+class WebSocketDeflateFilter:
+    """WSGI middleware that hides the client's websocket extension offer, so frames go uncompressed."""
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ.pop('HTTP_SEC_WEBSOCKET_EXTENSIONS', None)
+        return self.wsgi_app(environ, start_response)
+
+# Eventlet compresses every frame separately for each socket whenever the browser offers
+# permessage-deflate. That saves bandwidth but costs CPU per recipient.
+if not app.config['WEBSOCKET_DEFLATE']:
+    app.wsgi_app = WebSocketDeflateFilter(app.wsgi_app)
+
+@app.context_processor
+# Which Socket.IO client build and field code table the pages' scripts need.
+def inject_wire_format():
+    msgpack_client = app.config['SOCKETIO_SERIALIZER'] == 'msgpack'
+    return {
+        'socketio_client_url': 'https://cdn.socket.io/4.7.2/socket.io.msgpack.min.js' if msgpack_client
+        else 'https://cdn.socket.io/4.7.2/socket.io.min.js',
+        'field_codes': FIELD_CODES if app.config['COMPACT_PAYLOADS'] else {}
+    }
+
+# --- Event Log ---
+# The last EVENT_LOG_PER_ROOM broadcasts of each room, each with a per-room sequence number
+# ('seq') stamped on the payload as it is sent. A client that reconnects sends back the
+# room's epoch and the last seq it saw when it rejoins. If the log still covers the gap,
+# the missed events are replayed from memory. Otherwise (gap too old, room evicted,
+# restarted or multi-worker process) the new messages are read from the DB by id instead.
+# Both paths replace a full page reload.
+class RoomEventLog:
+    EPHEMERAL = {'presence'}  # Not replayed: rejoining sends a fresh presence snapshot
+
+    def __init__(self, max_rooms=EVENT_LOG_ROOMS, per_room=EVENT_LOG_PER_ROOM):
+        self.max_rooms = max_rooms
+        self.per_room = per_room
+        self._rooms = OrderedDict()  # room -> [epoch, last seq, deque of (seq, event, data)]
+
+    def _room(self, room):
+        entry = self._rooms.get(room)
+        if entry is None:
+            # A fresh epoch tells clients that sequence numbers from before do not apply.
+            entry = self._rooms[room] = [secrets.token_hex(4), 0, deque(maxlen=self.per_room)]
+            while len(self._rooms) > self.max_rooms:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room)
+        return entry
+
+    def position(self, room):
+        """(epoch, last seq) for room; a client resumes from here."""
+        if not self.max_rooms:
+            return None, 0
+        entry = self._room(room)
+        return entry[0], entry[1]
+
+    def record(self, room, event, data):
+        """Stamp data with the room's next seq and log it; returns the payload to send."""
+        if not self.max_rooms or event in self.EPHEMERAL or not isinstance(data, dict):
+            return data
+        entry = self._room(room)
+        entry[1] += 1
+        stamp = {'seq': entry[1]}
+        data = dict(data, **(compact_payload(stamp) if app.config['COMPACT_PAYLOADS'] else stamp))
+        entry[2].append((entry[1], event, data))
+        return data
+
+    def since(self, room, epoch, seq):
+        """[event, data] pairs sent after seq, or None when the log no longer covers the gap."""
+        entry = self._rooms.get(room)
+        if entry is None or entry[0] != epoch or not 0 <= seq <= entry[1]:
+            return None
+        events = entry[2]
+        if events and events[0][0] > seq + 1:
+            return None
+        return [[event, data] for event_seq, event, data in events if event_seq > seq]
+
+    def stats(self):
+        return {
+            'rooms': len(self._rooms),
+            'events': sum(len(entry[2]) for entry in self._rooms.values()),
+            'max_rooms': self.max_rooms,
+            'per_room': self.per_room
+        }
+
+event_log = RoomEventLog()
+metrics.counter('pychat_resume_total', 'Reconnect catch-ups by how the gap was filled.', ('source',))
+
+def fetch_messages_after(conversation, after_id, limit=RESUME_MESSAGE_LIMIT):
+    """Return (MessageViews newer than after_id oldest-first, whether that is all of them)."""
+    queued = [view for view in queued_views(conversation) if view.id > after_id]
+    rows = db.session.query(
+        Message.id, Message.sender_username, Message.content, Message.image_filename, Message.timestamp
+    ).filter(Message.conversation_key == conversation, Message.id > after_id)\
+        .order_by(Message.id).limit(limit + 1).all()
+    counts = load_reaction_counts([row.id for row in rows])
+    views = [MessageView(message_id, sender, content or "", image, timestamp, tuple(counts[message_id]))
+             for message_id, sender, content, image, timestamp in rows]
+    stored = {view.id for view in views}
+    views = sorted(views + [view for view in queued if view.id not in stored], key=lambda view: view.id)
+    return views[:limit], len(views) <= limit
+
+# Answer a rejoin's resume point with what the socket missed in room.
+def resume_room(room, conversation, username, resume):
+    if not isinstance(resume, dict):
+        return
+    try:
+        seq = int(resume.get('seq') or 0)
+        last_id = int(resume.get('last_id') or 0)
+    except (TypeError, ValueError):
+        return
+
+    events = event_log.since(room, resume.get('epoch'), seq)
+    epoch, current = event_log.position(room)
+    reply = {'epoch': epoch, 'seq': current, 'complete': True}
+    if events is not None:
+        reply['events'] = events
+        metrics.inc('pychat_resume_total', 'log')
+    else:
+        # Only new messages can be recovered this way; edits, deletes and reactions to
+        # messages the client already has are not.
+        views, reply['complete'] = fetch_messages_after(conversation, last_id)
+        reply['messages'] = render_history(views, username)
+        metrics.inc('pychat_resume_total', 'db' if reply['complete'] else 'truncated')
+    emit('resume', reply, to=request.sid)
+
+# --- Broadcast Fan-out ---
+# Every room broadcast goes through emit_room(). With a fan-out window set, reactions, edits
+# and deletes for a room are held for that long and sent as one 'batch' frame of
+# [event, data] pairs, which the clients unpack in order. New messages are urgent: they
+# flush anything held for the room first (to keep ordering) and go out immediately.
+metrics.counter('pychat_fanout_events_total', 'Room broadcasts by event.', ('event',))
+metrics.counter('pychat_fanout_frames_total', 'Frames sent to rooms (a batch counts once).')
+metrics.counter('pychat_fanout_frames_saved_total',
+                'Per-client frames avoided by batching (events folded into a batch x room members).')
+
+def room_size(room):
+    """Clients in room connected to this process."""
+    return len(socketio.server.manager.rooms.get('/', {}).get(room, {}))
+
+class FanoutBatcher:
+    def __init__(self, window):
+        self.window = window
+        self._pending = {}  # room -> [(event, data)], oldest first
+
+    def emit(self, event, data, room, urgent=False):
+        if urgent or not self.window:
+            self.flush(room)
+            self._send(room, [(event, data)])
+            return
+        queued = self._pending.setdefault(room, [])
+        queued.append((event, data))
+        if len(queued) == 1:
+            socketio.start_background_task(self._flush_later, room)
+
+    def _flush_later(self, room):
+        socketio.sleep(self.window)
+        self.flush(room)
+
+    def flush(self, room):
+        events = self._pending.pop(room, None)
+        if events:
+            self._send(room, events)
+
+    def _send(self, room, events):
+        # Sequence numbers are assigned as events go out, so the log only holds what was sent.
+        events = [(event, event_log.record(room, event, data)) for event, data in events]
+        if len(events) == 1:
+            socketio.emit(events[0][0], events[0][1], to=room)
+        else:
+            socketio.emit('batch', {'events': [[event, data] for event, data in events]}, to=room)
+            metrics.inc('pychat_fanout_frames_saved_total', amount=(len(events) - 1) * room_size(room))
+        metrics.inc('pychat_fanout_frames_total')
+        for event, _ in events:
+            metrics.inc('pychat_fanout_events_total', event)
+
+    def pending(self):
+        return sum(len(events) for events in self._pending.values())
+
+fanout = FanoutBatcher(app.config['FANOUT_WINDOW_SECONDS'])
+
+# The single choke point for room broadcasts.
+def emit_room(event, data, room, urgent=False):
+    if app.config['COMPACT_PAYLOADS']:
+        data = compact_payload(data)
+    fanout.emit(event, data, room, urgent=urgent)
+
+# --- Presence ---
+# Who is in each room, kept in memory per process. Sockets count per user, so a second tab
+# changes nothing. Joins and leaves are not broadcast one by one: a background task sends
+# each room one 'presence' diff per PRESENCE_TICK ({online, offline, typing, stopped}).
+# A user who leaves and comes back within a tick (a page reload) cancels out. Joiners get a
+# 'presence_snapshot' from memory. Sockets that stop sending heartbeats for PRESENCE_TTL
+# drop out until their next heartbeat. With several workers each one knows only its own
+# sockets, so snapshots list only local users while diffs reach everyone.
+class PresenceRegistry:
+    def __init__(self, ttl=PRESENCE_TTL, typing_ttl=TYPING_TTL):
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self._sids = {}  # sid -> [username, last heartbeat, rooms joined, counted in rooms]
+        self._rooms = {}  # room -> {username: sockets}
+        self._typing = {}  # (room, username) -> expires at
+        self._pending = {}  # room -> {'presence': {username: online}, 'typing': {username: typing}}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(PRESENCE_TICK)
+            try:
+                self.expire(time.monotonic())
+                self.flush()
+            except Exception:
+                log.exception('Presence flush failed')
+
+    def _mark(self, room, kind, username, value):
+        # Opposite changes inside one tick cancel out; clients never saw the first one.
+        changes = self._pending.setdefault(room, {'presence': {}, 'typing': {}})[kind]
+        if changes.get(username) is (not value):
+            del changes[username]
+        else:
+            changes[username] = value
+
+    def _count(self, room, username):
+        members = self._rooms.setdefault(room, {})
+        members[username] = members.get(username, 0) + 1
+        if members[username] == 1:
+            self._mark(room, 'presence', username, True)
+
+    def _uncount(self, room, username):
+        members = self._rooms.get(room, {})
+        remaining = members.get(username, 0) - 1
+        if remaining > 0:
+            members[username] = remaining
+            return
+        members.pop(username, None)
+        if not members:
+            self._rooms.pop(room, None)
+        self._mark(room, 'presence', username, False)
+        self.stop_typing(room, username)
+
+    def connect(self, sid, username):
+        self._sids[sid] = [username, time.monotonic(), set(), True]
+
+    def join(self, sid, room):
+        entry = self._sids.get(sid)
+        if entry and room not in entry[2]:
+            entry[2].add(room)
+            if entry[3]:
+                self._count(room, entry[0])
+
+    def disconnect(self, sid):
+        entry = self._sids.pop(sid, None)
+        if entry and entry[3]:
+            for room in entry[2]:
+                self._uncount(room, entry[0])
+
+    def heartbeat(self, sid):
+        entry = self._sids.get(sid)
+        if not entry:
+            return
+        entry[1] = time.monotonic()
+        if not entry[3]:
+            entry[3] = True
+            for room in entry[2]:
+                self._count(room, entry[0])
+
+    def in_room(self, sid, room):
+        entry = self._sids.get(sid)
+        return bool(entry) and room in entry[2]
+
+    def expire(self, now):
+        """Drop sockets past their heartbeat deadline and typing indicators past theirs."""
+        for entry in self._sids.values():
+            if entry[3] and now - entry[1] > self.ttl:
+                entry[3] = False
+                for room in entry[2]:
+                    self._uncount(room, entry[0])
+        for (room, username), expires in list(self._typing.items()):
+            if expires <= now:
+                self.stop_typing(room, username)
+
+    def start_typing(self, room, username):
+        # Refreshing an active indicator only moves its deadline; nothing is re-broadcast.
+        if (room, username) not in self._typing:
+            self._mark(room, 'typing', username, True)
+        self._typing[(room, username)] = time.monotonic() + self.typing_ttl
+
+    def stop_typing(self, room, username, announce=True):
+        if self._typing.pop((room, username), None) is None:
+            return
+        if announce:
+            self._mark(room, 'typing', username, False)
+        else:
+            # The message that ended it already tells clients; just drop any pending start.
+            self._pending.get(room, {}).get('typing', {}).pop(username, None)
+
+    def snapshot(self, room, limit=PRESENCE_SNAPSHOT_LIMIT):
+        members = self._rooms.get(room, {})
+        typing = [username for (typing_room, username) in self._typing if typing_room == room]
+        return {'users': sorted(members)[:limit], 'total': len(members), 'typing': typing}
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        for room, changes in pending.items():
+            diff = {}
+            for kind, on_key, off_key in (('presence', 'online', 'offline'), ('typing', 'typing', 'stopped')):
+                on = [username for username, value in changes[kind].items() if value]
+                off = [username for username, value in changes[kind].items() if not value]
+                if on:
+                    diff[on_key] = on
+                if off:
+                    diff[off_key] = off
+            if diff:
+                emit_room('presence', diff, room)
+                metrics.inc('pychat_presence_diffs_total')
+
+    def stats(self):
+        return {
+            'sockets': len(self._sids),
+            'rooms': len(self._rooms),
+            'present': sum(len(members) for members in self._rooms.values()),
+            'typing': len(self._typing),
+            'pending_rooms': len(self._pending)
+        }
+
+metrics.counter('pychat_presence_diffs_total', 'Presence/typing diff frames sent to rooms.')
+presence = PresenceRegistry()
+
+# Enter room and send the caller its presence snapshot (which already lists them).
+def join_presence_room(room):
+    join_room(room)
+    presence.join(request.sid, room)
+    emit('presence_snapshot', presence.snapshot(room), to=request.sid)
+
 # --- SocketIO ---
+@socketio.on('connect')
+@instrumented_event
+# Register the socket with the presence registry.
+def handle_connect(auth=None):
+    username = session.get('username')
+    if not username:
+        return
+    presence.start()
+    presence.connect(request.sid, username)
+
+@socketio.on('disconnect')
+@instrumented_event
+# Forget the socket; its rooms announce the user offline if it was their last tab.
+def handle_disconnect(*args):
+    presence.disconnect(request.sid)
+
+@socketio.on('heartbeat')
+# Keep the socket counted as present.
+def handle_heartbeat(data=None):
+    presence.heartbeat(request.sid)
+
+@socketio.on('typing')
+@instrumented_event
+# Start or stop the typing indicator in the global chat or a DM.
+def handle_typing(data):
+    username = session.get('username')
+    if not username or not isinstance(data, dict):
+        return
+    recipient = data.get('recipient')
+    room = dm_room_name(username, recipient) if recipient else 'global_chat'
+    if not presence.in_room(request.sid, room):
+        return
+    if data.get('typing', True):
+        # Clients resend while typing; extra ones are dropped quietly.
+        if rate_limiter.hit('typing', username):
+            return
+        presence.start_typing(room, username)
+    else:
+        presence.stop_typing(room, username)
+
 @socketio.on('join')
-# Put a socket into the global chat room on connect.
+@instrumented_event
+# Put a socket into the global chat room on connect, and catch it up after a reconnect.
 def handle_join(data):
     # Everyone sits in the global room when the socket connects.
-    username = data.get('username', 'Anonymous')
-    join_room('global_chat')
+    username = session.get('username')
+    join_presence_room('global_chat')
+    if username and data.get('resume'):
+        resume_room('global_chat', global_conversation(), username, data['resume'])
     
 @socketio.on('send_message')
+@instrumented_event
 # Handle a text message to the global chat with cooldown checks.
 def handle_message(data):
-    username = data.get('username', 'Anonymous')
+    # The sender comes from the session, never from the client payload.
+    username = session.get('username')
     msg = data.get('msg', '')
-    if not msg:
+    if not username or not msg or rejected_content(msg):
         return
 
     # Per-user cooldown for global text messages.
-    remaining = check_global_cooldown(username)
-    if remaining > 0:
-        emit('rate_limited', {'remaining': ceil(remaining)}, to=request.sid)
+    if throttled('send', username):
         return
 
-    new_msg = Message(sender_username=username, content=msg)
-    db.session.add(new_msg)
-    db.session.commit()
-    
-    romania_tz = timezone(timedelta(hours=2))
-    current_time = datetime.now(romania_tz).strftime('%H:%M')
+    new_msg = message_writer.add(sender_username=username, content=msg)
+    history_cache.append('global_chat', new_msg)
+    # Clients clear the sender's typing indicator when the message arrives.
+    presence.stop_typing('global_chat', username, announce=False)
     
     emit('cooldown_started', {'seconds': COOLDOWN_SECONDS}, to=request.sid)
-    emit('receive_message', {
+    emit_room('receive_message', {
         'id': new_msg.id, # IMPORTANT for reactions
         'username': username, 
         'msg': msg,
-        'timestamp': current_time 
-    }, room='global_chat')
+        'timestamp': local_time(new_msg.timestamp),
+        'ts': epoch_ms(new_msg.timestamp)
+    }, 'global_chat', urgent=True)
 
 @socketio.on('upload_image')
-# Handle a global image upload and broadcast.
+@instrumented_event
+# Post an image uploaded through /upload to the global chat and broadcast.
 def handle_image(data):
-    username = data.get('username', 'Anonymous')
-    file_data = data.get('image')
-    file_name = data.get('fileName')
+    username = session.get('username')
+    token = data.get('token')
     
-    if file_data and file_name:
+    if token and username:
         # Image uploads share the same cooldown as text.
-        remaining = check_global_cooldown(username)
-        if remaining > 0:
-            emit('rate_limited', {'remaining': ceil(remaining)}, to=request.sid)
+        if throttled('send', username):
             return
 
-        try:
-            if "," in file_data:
-                _, encoded = file_data.split(",", 1)
-            else:
-                encoded = file_data
-                
-            data_bytes = base64.b64decode(encoded)
-            safe_name = secure_filename(file_name)
-            unique_name = f"{int(datetime.now(timezone.utc).timestamp())}_{safe_name}"
-            file_path = os.path.join(app.config['CHAT_UPLOAD_FOLDER'], unique_name)
-            
-            with open(file_path, "wb") as f:
-                f.write(data_bytes)
-                
-            new_msg = Message(
-                sender_username=username, 
-                content="", 
-                image_filename=unique_name
-            )
-            db.session.add(new_msg)
-            db.session.commit()
-            
-            romania_tz = timezone(timedelta(hours=2))
-            current_time = datetime.now(romania_tz).strftime('%H:%M')
-
-            emit('cooldown_started', {'seconds': COOLDOWN_SECONDS}, to=request.sid)
-            emit('receive_message', {
-                'id': new_msg.id,
-                'username': username, 
-                'msg': "", 
-                'image': unique_name,
-                'timestamp': current_time
-            }, room='global_chat')
-            
-        except Exception as e:
-            print(f"Error saving image: {e}")
+        image_filename = claim_chat_upload(token, username)
+        if not image_filename:
+            log.warning("Rejected chat image from %s: invalid or already used upload token", username)
+            return
+        commit_session()
+
+        new_msg = message_writer.add(
+            sender_username=username, 
+            content="", 
+            image_filename=image_filename
+        )
+        history_cache.append('global_chat', new_msg)
+        
+        emit('cooldown_started', {'seconds': COOLDOWN_SECONDS}, to=request.sid)
+        emit_room('receive_message', {
+            'id': new_msg.id,
+            'username': username, 
+            'msg': "", 
+            'image': image_filename,
+            'timestamp': local_time(new_msg.timestamp),
+            'ts': epoch_ms(new_msg.timestamp)
+        }, 'global_chat', urgent=True)
 
 @socketio.on('join_dm')
-# Join the DM room for two participants.
+@instrumented_event
+# Join the DM room between the session user and the recipient.
 def handle_join_dm(data):
-    username = data.get('username')
-    recipient = data.get('recipient')
+    # The client only names the other side; the caller is always one of the two participants.
+    username = session.get('username')
+    recipient = data.get('recipient') if isinstance(data, dict) else None
+    if not username or not isinstance(recipient, str) or not recipient or recipient == username:
+        return
     # Room name is deterministic dm_userA-userB to keep both sides synced.
-    room = f"dm_{'-'.join(sorted([username, recipient]))}"
-    join_room(room)
+    room = dm_room_name(username, recipient)
+    join_presence_room(room)
+    if data.get('resume'):
+        resume_room(room, dm_conversation(username, recipient), username, data['resume'])
+
+@socketio.on('mark_read')
+@instrumented_event
+# Reset the unread counter for a DM thread and tell the other side how far it has been read.
+def handle_mark_read(data):
+    username = session.get('username')
+    recipient = data.get('recipient') if isinstance(data, dict) else None
+    if not username or not recipient:
+        return
+
+    # Clients send this as messages arrive; extra ones are dropped quietly.
+    if rate_limiter.hit('read', username):
+        return
+
+    room = dm_room_name(username, recipient)
+    # Queued messages would count as unread again once written.
+    message_writer.flush_through(message_writer.last_pending_id(room))
+    last_read_id = mark_conversation_read(username, room)
+    commit_session()
+    if last_read_id:
+        emit_room('conversation_read', {'username': username, 'last_read_id': last_read_id}, room)
 
 @socketio.on('send_private_message')
+@instrumented_event
 # Handle a DM text message and emit to both users.
 def handle_private_message(data):
     sender = session.get('username')
     recipient = data.get('recipient')
     msg = data.get('msg')
-    if msg and recipient:
+    if msg and recipient and sender:
+        if rejected_content(msg) or throttled('dm', sender):
+            return
         # Store the DM and push it to the shared room for both users.
-        new_msg = Message(sender_username=sender, recipient_username=recipient, content=msg)
-        db.session.add(new_msg)
-        db.session.commit()
-        
-        romania_tz = timezone(timedelta(hours=2))
-        current_time = datetime.now(romania_tz).strftime('%H:%M')
+        new_msg = message_writer.add(sender_username=sender, recipient_username=recipient, content=msg)
 
-        room = f"dm_{'-'.join(sorted([sender, recipient]))}"
-        emit('receive_private_message', {
+        room = dm_room_name(sender, recipient)
+        history_cache.append(room, new_msg)
+        presence.stop_typing(room, sender, announce=False)
+        
+        emit_room('receive_private_message', {
             'id': new_msg.id,
             'sender': sender, 
             'msg': msg,
-            'timestamp': current_time
-        }, room=room)
+            'timestamp': local_time(new_msg.timestamp),
+            'ts': epoch_ms(new_msg.timestamp)
+        }, room, urgent=True)
 
 @socketio.on('upload_private_image')
-# Handle a DM image upload and emit to the DM room.
+@instrumented_event
+# Post an image uploaded through /upload to a DM and emit to the DM room.
 def handle_private_image(data):
     sender = session.get('username') 
     recipient = data.get('recipient')
-    file_data = data.get('image')
-    file_name = data.get('fileName')
+    token = data.get('token')
 
-    if file_data and file_name and sender and recipient:
-        try:
-            if "," in file_data:
-                header, encoded = file_data.split(",", 1)
-            else:
-                encoded = file_data
-                
-            data_bytes = base64.b64decode(encoded)
-            safe_name = secure_filename(file_name)
-            unique_name = f"{int(datetime.utcnow().timestamp())}_{safe_name}"
-            file_path = os.path.join(app.config['CHAT_UPLOAD_FOLDER'], unique_name)
-            
-            with open(file_path, "wb") as f:
-                f.write(data_bytes)
-                
-            new_msg = Message(
-                sender_username=sender, 
-                recipient_username=recipient,
-                content="", 
-                image_filename=unique_name
-            )
-            db.session.add(new_msg)
-            db.session.commit()
-            
-            room = f"dm_{'-'.join(sorted([sender, recipient]))}"
-            
-            emit('receive_private_message', {
-                'id': new_msg.id,
-                'sender': sender, 
-                'msg': "", 
-                'image': unique_name
-            }, room=room)
-            
-        except Exception as e:
-            print(f"Error saving private image: {e}")
+    if token and sender and recipient:
+        if throttled('dm', sender):
+            return
+        image_filename = claim_chat_upload(token, sender)
+        if not image_filename:
+            log.warning("Rejected DM image from %s: invalid or already used upload token", sender)
+            return
+        commit_session()
+
+        new_msg = message_writer.add(
+            sender_username=sender, 
+            recipient_username=recipient,
+            content="", 
+            image_filename=image_filename
+        )
+        
+        room = dm_room_name(sender, recipient)
+        history_cache.append(room, new_msg)
+        
+        emit_room('receive_private_message', {
+            'id': new_msg.id,
+            'sender': sender, 
+            'msg': "", 
+            'image': image_filename,
+            'timestamp': local_time(new_msg.timestamp),
+            'ts': epoch_ms(new_msg.timestamp)
+        }, room, urgent=True)
 
 @socketio.on('react_to_message')
-# Toggle an emoji reaction and broadcast updated counts.
+@instrumented_event
+# Toggle an emoji reaction and broadcast the one-pill change.
 def handle_reaction(data):
-    username = data.get('username')
+    username = session.get('username')
     msg_id = data.get('message_id')
     emoji = data.get('emoji')
 
@@ -607,56 +3388,76 @@ def handle_reaction(data):
     if not username or not msg_id or not emoji:
         return
 
+    # Throttle before touching the DB; reaction spam was unbounded.
+    if throttled('react', username):
+        return
+
     # Find the message to decide which room should get the reaction update.
+    message_writer.flush_through(msg_id)
     message = Message.query.get(msg_id)
     if not message:
         return
 
     existing = MessageReaction.query.filter_by(message_id=msg_id, user_username=username, emoji=emoji).first()
     
-    if existing:
-        db.session.delete(existing)
-    else:
-        new_r = MessageReaction(message_id=msg_id, user_username=username, emoji=emoji)
-        db.session.add(new_r)
-    
-    db.session.commit()
-    
-    # Recompute reactions to send a fresh tally.
-    all_reactions = MessageReaction.query.filter_by(message_id=msg_id).all()
-    
-    reactions_map = {}
-    for r in all_reactions:
-        if r.emoji not in reactions_map:
-            reactions_map[r.emoji] = {'count': 0, 'users': []}
-        reactions_map[r.emoji]['count'] += 1
-        reactions_map[r.emoji]['users'].append(r.user_username)
-        
-    reactions_list = []
-    for emoji, r_data in reactions_map.items():
-        reactions_list.append({
-            'emoji': emoji,
-            'count': r_data['count'],
-            'users': r_data['users']
-        })
-        
-    response_data = {
+    # The counter update autoflushes the reaction row, so a duplicate surfaces there or at commit.
+    try:
+        if existing:
+            db.session.delete(existing)
+            delta = -1
+        else:
+            new_r = MessageReaction(message_id=msg_id, user_username=username, emoji=emoji)
+            db.session.add(new_r)
+            delta = 1
+        count = adjust_reaction_count(msg_id, emoji, delta)
+        commit_session()
+    except IntegrityError:
+        # A concurrent click on another worker won; resend this client the stored totals.
+        db.session.rollback()
+        emit('reaction_sync', {'reactions': load_reaction_summaries([msg_id], username)})
+        return
+
+    # Broadcast only the change (DM vs global room); clients adjust the one pill.
+    room = _message_room(message)
+    history_cache.set_reaction_count(room, msg_id, emoji, count)
+    emit_room('reaction_delta', {
         'message_id': msg_id,
-        'reactions': reactions_list
-    }
+        'emoji': emoji,
+        'delta': delta,
+        'count': count,
+        'username': username
+    }, room)
+
+@socketio.on('sync_reactions')
+@instrumented_event
+# Full reaction state for messages on screen; clients ask after a reconnect in case they missed deltas.
+def handle_sync_reactions(data):
+    username = session.get('username')
+    if not username or not isinstance(data, dict):
+        return
 
-    # Broadcast to the right room (DM vs global).
-    if message.recipient_username:
-        # Private message: rebuild dm_user1-user2 room name.
-        participants = sorted([message.sender_username, message.recipient_username])
-        room_name = f"dm_{'-'.join(participants)}"
-        emit('update_message_reactions', response_data, room=room_name)
-    else:
-        # Global message.
-        emit('update_message_reactions', response_data, room='global_chat')
+    try:
+        message_ids = {int(m) for m in (data.get('message_ids') or [])[:REACTION_SYNC_LIMIT]}
+    except (TypeError, ValueError):
+        return
+
+    if throttled('react', username) or not message_ids:
+        return
+
+    # Only messages this user can see: the global feed and their own DMs.
+    visible = [row[0] for row in db.session.query(Message.id).filter(
+        Message.id.in_(message_ids),
+        or_(
+            Message.recipient_username.is_(None),
+            Message.sender_username == username,
+            Message.recipient_username == username
+        )
+    )]
+    emit('reaction_sync', {'reactions': load_reaction_summaries(visible, username)})
 
 
 @socketio.on('edit_message')
+@instrumented_event
 # Allow senders to edit their own message and notify the room.
 def handle_edit_message(data):
     username = session.get('username')
@@ -668,24 +3469,33 @@ def handle_edit_message(data):
     except (TypeError, ValueError):
         return
 
-    if not username or not msg_id or not new_content:
+    if not username or not msg_id or not new_content or rejected_content(new_content):
         return
 
+    if throttled('edit', username):
+        return
+
+    # A message sent moments ago may still be queued for the writer.
+    message_writer.flush_through(msg_id)
     message = Message.query.get(msg_id)
     if not message or message.sender_username != username:
         return
 
     message.content = new_content
-    db.session.commit()
+    if message.recipient_username:
+        conversation_message_edited(message)
+    commit_session()
 
     room = _message_room(message)
-    emit('message_updated', {
+    history_cache.update_content(room, message.id, new_content)
+    emit_room('message_updated', {
         'message_id': message.id,
         'content': new_content
-    }, room=room)
+    }, room)
 
 
 @socketio.on('delete_message')
+@instrumented_event
 # Allow senders to delete their message (and attachments/reactions) and notify the room.
 def handle_delete_message(data):
     username = session.get('username')
@@ -699,6 +3509,11 @@ def handle_delete_message(data):
     if not username or not msg_id:
         return
 
+    if throttled('edit', username):
+        return
+
+    # A message sent moments ago may still be queued for the writer.
+    message_writer.flush_through(msg_id)
     message = Message.query.get(msg_id)
     if not message or message.sender_username != username:
         return
@@ -707,19 +3522,31 @@ def handle_delete_message(data):
 
     # Clean up reactions tied to this message before deleting it.
     MessageReaction.query.filter_by(message_id=msg_id).delete()
+    MessageReactionCount.query.filter_by(message_id=msg_id).delete()
 
-    if message.image_filename:
-        try:
-            image_path = os.path.join(app.config['CHAT_UPLOAD_FOLDER'], message.image_filename)
-            if os.path.exists(image_path):
-                os.remove(image_path)
-        except Exception:
-            pass
+    # Identical images are stored once; only the last message using one removes the file.
+    image_filename = message.image_filename
+    unlink_image = image_filename and release_image(image_filename)
 
+    if message.recipient_username:
+        conversation_message_deleted(message)
     db.session.delete(message)
-    db.session.commit()
+    commit_session()
+
+    if unlink_image:
+        try:
+            try:
+                io_pool.run(remove_chat_image, image_filename)
+            except PoolBusy:
+                remove_chat_image(image_filename)
+        except Exception:
+            log.exception("Could not remove chat image %s", image_filename)
+    history_cache.remove(room, msg_id)
 
-    emit('message_deleted', {'message_id': msg_id}, room=room)
+    emit_room('message_deleted', {'message_id': msg_id}, room)
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Exit normally on SIGTERM so atexit handlers commit queued messages.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    socketio.run(app, host='0.0.0.0', port=app.config['PORT'], debug=True)
\ No newline at end of file
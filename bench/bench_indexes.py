@@ -0,0 +1,187 @@
+"""Query plans and timings for the chat history queries, before and after the schema migrations.
+
+Seeds a throwaway SQLite database with the pre-index schema, times the real query
+shapes from app.py, applies app.run_migrations() to the same file and times them again.
+
+    python bench/bench_indexes.py                  # 1M messages (default)
+    python bench/bench_indexes.py --messages 200000 --repeat 5
+
+Run from the repository root so app.py is importable.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Schema as it existed before the migrations: no secondary indexes at all.
+LEGACY_SCHEMA = '''
+CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80) UNIQUE NOT NULL,
+    password VARCHAR(120) NOT NULL, email VARCHAR(120) NOT NULL, bio VARCHAR(200), profile_pic VARCHAR(150));
+CREATE TABLE friendship (id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL,
+    receiver_id INTEGER NOT NULL, status VARCHAR(20));
+CREATE TABLE message (id INTEGER PRIMARY KEY, sender_username VARCHAR(80) NOT NULL,
+    recipient_username VARCHAR(80), content VARCHAR(500), image_filename VARCHAR(200), timestamp DATETIME);
+CREATE TABLE message_reaction (id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL,
+    user_username VARCHAR(80) NOT NULL, emoji VARCHAR(10) NOT NULL);
+'''
+
+EMOJIS = ['👍', '❤️', '😂', '😮', '😢', '😡']
+
+# Query shapes issued by app.py before the migrations.
+LEGACY_QUERIES = {
+    'global feed page': (
+        "SELECT * FROM message WHERE recipient_username IS NULL "
+        "ORDER BY timestamp DESC, id DESC LIMIT 51", ()),
+    'dm thread page': (
+        "SELECT * FROM message WHERE (sender_username = :a AND recipient_username = :b) "
+        "OR (sender_username = :b AND recipient_username = :a) "
+        "ORDER BY timestamp DESC, id DESC LIMIT 51", ('a', 'b')),
+    # Before the reaction counters every page load re-counted its reactions.
+    'reaction page summary': (
+        "SELECT message_id, emoji, count(id), max(user_username = :user) FROM message_reaction "
+        "WHERE message_id IN ({ids}) GROUP BY message_id, emoji ORDER BY message_id, min(id)",
+        ('user',)),
+}
+
+# Query shapes issued by app.py after the migrations (conversation_key + indexes).
+MIGRATED_QUERIES = {
+    'global feed page': (
+        "SELECT * FROM message WHERE conversation_key = 'global_chat' "
+        "ORDER BY timestamp DESC, id DESC LIMIT 51", ()),
+    'dm thread page': (
+        "SELECT * FROM message WHERE conversation_key = :room "
+        "ORDER BY timestamp DESC, id DESC LIMIT 51", ('room',)),
+    # load_reaction_counts + load_own_reactions: stored totals, then the viewer's own pills.
+    'reaction page summary': (
+        "SELECT message_id, emoji, count FROM message_reaction_count "
+        "WHERE message_id IN ({ids}) ORDER BY id", ()),
+    'reaction page own': (
+        "SELECT message_id, emoji FROM message_reaction "
+        "WHERE message_id IN ({ids}) AND user_username = :user", ('user',)),
+}
+
+# The toggle lookup keeps the same SQL; only the indexes change.
+REACTION_QUERIES = {
+    'reaction toggle lookup': (
+        "SELECT id FROM message_reaction WHERE message_id = :mid AND user_username = :user AND emoji = :emoji",
+        ('mid', 'user', 'emoji')),
+}
+
+
+def seed(path, n_messages, n_reactions, n_users, global_share):
+    rng = random.Random(42)
+    users = [f"user{i}" for i in range(n_users)]
+    pairs = [tuple(rng.sample(users, 2)) for _ in range(n_users * 2)]
+    start = datetime(2023, 1, 1)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany(
+        "INSERT INTO user (id, username, password, email) VALUES (?, ?, 'x', 'x')",
+        ((i + 1, u) for i, u in enumerate(users))
+    )
+
+    def messages():
+        for i in range(n_messages):
+            stamp = (start + timedelta(seconds=i * 3)).strftime('%Y-%m-%d %H:%M:%S.%f')
+            if rng.random() < global_share:
+                yield (rng.choice(users), None, f"global message {i}", stamp)
+            else:
+                sender, recipient = rng.choice(pairs)
+                if rng.random() < 0.5:
+                    sender, recipient = recipient, sender
+                yield (sender, recipient, f"direct message {i}", stamp)
+
+    conn.executemany(
+        "INSERT INTO message (sender_username, recipient_username, content, timestamp) VALUES (?, ?, ?, ?)",
+        messages()
+    )
+    conn.executemany(
+        "INSERT INTO message_reaction (message_id, user_username, emoji) VALUES (?, ?, ?)",
+        ((rng.randint(1, n_messages), rng.choice(users), rng.choice(EMOJIS)) for _ in range(n_reactions))
+    )
+    conn.commit()
+    conn.close()
+    return pairs
+
+
+def sample_params(conn, pair):
+    a, b = pair
+    mid, user, emoji = conn.execute(
+        "SELECT message_id, user_username, emoji FROM message_reaction ORDER BY id DESC LIMIT 1").fetchone()
+    newest = [r[0] for r in conn.execute("SELECT id FROM message ORDER BY id DESC LIMIT 50")]
+    return {
+        'a': a, 'b': b, 'room': f"dm_{'-'.join(sorted([a, b]))}",
+        'mid': mid, 'user': user, 'emoji': emoji,
+        'ids': ','.join(str(i) for i in newest),
+    }
+
+
+def run_queries(conn, queries, params, repeat):
+    results = []
+    for name, (sql, keys) in queries.items():
+        sql = sql.replace('{ids}', params['ids'])
+        bound = {k: params[k] for k in keys}
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, bound)]
+        timings = []
+        for _ in range(repeat):
+            began = time.perf_counter()
+            conn.execute(sql, bound).fetchall()
+            timings.append((time.perf_counter() - began) * 1000)
+        results.append((name, plan, statistics.median(timings)))
+    return results
+
+
+def report(title, results):
+    print(f"\n== {title} ==")
+    for name, plan, median_ms in results:
+        print(f"{name:<24} {median_ms:10.3f} ms (median)")
+        for step in plan:
+            print(f"    plan: {step}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--reactions', type=int, default=300_000)
+    parser.add_argument('--users', type=int, default=2_000)
+    parser.add_argument('--global-share', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    from sqlalchemy import create_engine
+    from app import run_migrations
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        began = time.perf_counter()
+        pairs = seed(path, args.messages, args.reactions, args.users, args.global_share)
+        print(f"Seeded {args.messages:,} messages and {args.reactions:,} reactions "
+              f"in {time.perf_counter() - began:.1f}s")
+
+        conn = sqlite3.connect(path)
+        params = sample_params(conn, pairs[0])
+        report('before migrations', run_queries(conn, {**LEGACY_QUERIES, **REACTION_QUERIES}, params, args.repeat))
+        conn.close()
+
+        engine = create_engine(f"sqlite:///{path}")
+        began = time.perf_counter()
+        run_migrations(engine)
+        engine.dispose()
+        print(f"\nMigrations applied in {time.perf_counter() - began:.1f}s")
+
+        conn = sqlite3.connect(path)
+        conn.execute("ANALYZE")
+        report('after migrations', run_queries(conn, {**MIGRATED_QUERIES, **REACTION_QUERIES}, params, args.repeat))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
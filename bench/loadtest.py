@@ -0,0 +1,506 @@
+"""Load test for the realtime and HTTP paths, run entirely on this machine.
+
+Starts app.py in a subprocess against a freshly seeded SQLite database, then drives
+simulated users over real Socket.IO connections: each joins global_chat and a DM room
+with its partner, sends messages, reacts, uploads images and loads / and /dms/<partner>.
+Reports p50/p95/p99 latency for message fan-out and page renders, throughput and the
+server's memory, and exits non-zero when a --max-p95 budget is exceeded.
+
+    pip install "python-socketio[client]"        # requests + websocket-client for the simulated users
+    python bench/loadtest.py                       # 50 users for 30s
+    python bench/loadtest.py --users 200 --duration 60 --json results.json
+    python bench/loadtest.py --max-p95 fanout_global=100 --max-p95 page_index=250
+
+Run from the repository root so app.py is importable.
+"""
+import argparse
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'loadtest'
+
+# Relative weights of what a simulated user does between think-time pauses.
+ACTIONS = {
+    'global_message': 30,
+    'dm_message': 30,
+    'react': 20,
+    'page_index': 6,
+    'page_dms': 6,
+    'global_image': 4,
+    'dm_image': 4,
+}
+
+EMOJIS = ['👍', '❤️', '😂', '😮', '😢', '😡']
+
+# Latency metrics in report order.
+METRICS = [
+    'fanout_global', 'fanout_dm', 'fanout_image', 'reaction',
+    'page_index', 'page_dms', 'upload', 'connect',
+]
+
+
+def user_name(i):
+    return f"lt{i:05d}"
+
+
+def partner_of(i):
+    # Users are paired (0, 1), (2, 3), ...: friends with each other and each other's DM partner.
+    return i ^ 1
+
+
+# --- Server side ---
+
+def seed(pychat, n_users, n_messages, global_share):
+    """Insert users, partner friendships and message history straight through SQLAlchemy."""
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(42)
+    db = pychat.db
+    # Cheap hash: logins are not what is measured, and full-strength checks for every
+    # simulated user at once would queue behind each other in the server's cpu pool.
+    password = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1000')
+    db.session.execute(insert(pychat.User), [
+        {'id': i + 1, 'username': user_name(i), 'password': password, 'email': f"{user_name(i)}@loadtest.local"}
+        for i in range(n_users)
+    ])
+    db.session.execute(insert(pychat.Friendship), [
+        {'sender_id': i + 1, 'receiver_id': partner_of(i) + 1, 'status': 'accepted',
+         'low_id': i + 1, 'high_id': partner_of(i) + 1}
+        for i in range(0, n_users, 2)
+    ])
+
+    start = datetime.utcnow() - timedelta(seconds=n_messages)
+    rows = []
+    for i in range(n_messages):
+        sender = rng.randrange(n_users)
+        recipient = None if rng.random() < global_share else user_name(partner_of(sender))
+        rows.append({
+            'sender_username': user_name(sender),
+            'recipient_username': recipient,
+            'content': f"seed message {i}",
+            'timestamp': start + timedelta(seconds=i),
+            'conversation_key': pychat.dm_room_name(user_name(sender), recipient) if recipient else 'global_chat',
+        })
+        if len(rows) == 10_000:
+            db.session.execute(insert(pychat.Message), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(pychat.Message), rows)
+    db.session.commit()
+
+
+def serve(args):
+    """Child process: seed the database named by PYCHAT_DATABASE_URL and run the app."""
+    import app as pychat
+
+    pychat.app.config['CHAT_UPLOAD_FOLDER'] = args.uploads
+    if not args.rate_limits:
+        # The limits would cap every simulated user at one global post per cooldown.
+        pychat.app.config['RATE_LIMITS'].clear()
+
+    with pychat.app.app_context():
+        seed(pychat, args.users, args.messages, args.global_share)
+    print('seeded', flush=True)
+    pychat.socketio.run(pychat.app, host='127.0.0.1', port=args.port, debug=False,
+                        use_reloader=False, log_output=False)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, workdir):
+    port = free_port()
+    uploads = os.path.join(workdir, 'chat_uploads')
+    os.makedirs(uploads)
+    env = dict(os.environ, PYCHAT_DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'loadtest.db')}")
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--serve',
+        '--port', str(port), '--uploads', uploads,
+        '--users', str(args.users), '--messages', str(args.messages),
+        '--global-share', str(args.global_share),
+    ]
+    if args.rate_limits:
+        command.append('--rate-limits')
+    proc = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, f"http://127.0.0.1:{port}", log.name
+
+
+def wait_until_ready(proc, base_url, log_path, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if requests.get(f"{base_url}/login", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    with open(log_path) as log:
+        sys.exit(f"Server did not start:\n{log.read()[-2000:]}")
+
+
+def rss_bytes(pid):
+    """Resident set size of pid from /proc (Linux); None elsewhere."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# --- Client side ---
+
+class Stats:
+    """Thread-safe latency samples and counters shared by all simulated users."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {metric: [] for metric in METRICS}
+        self.counters = {}
+        self.sent = {}  # message text or image filename -> send time
+
+    def record(self, metric, seconds):
+        with self._lock:
+            self.samples[metric].append(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def mark_sent(self, key):
+        with self._lock:
+            self.sent[key] = time.perf_counter()
+
+    def delivered(self, metric, key):
+        received = time.perf_counter()
+        with self._lock:
+            began = self.sent.get(key)
+            if began is not None:
+                self.samples[metric].append(received - began)
+                self.counters['deliveries'] = self.counters.get('deliveries', 0) + 1
+
+
+def random_png(rng):
+    """A small PNG with random pixels, so every upload is new content to the server."""
+    from PIL import Image
+
+    image = Image.frombytes('RGB', (32, 32), bytes(rng.getrandbits(8) for _ in range(32 * 32 * 3)))
+    buf = io.BytesIO()
+    image.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class SimulatedUser(threading.Thread):
+    def __init__(self, index, base_url, stats, start_barrier, args):
+        super().__init__(daemon=True)
+        self.username = user_name(index)
+        self.partner = user_name(partner_of(index))
+        self.base_url = base_url
+        self.stats = stats
+        self.start_barrier = start_barrier
+        self.args = args
+        self.rng = random.Random(index)
+        self.seen = []  # ids of recent messages this user could react to
+        self.pending_reactions = {}
+        self.sequence = 0
+        self.measuring = False
+
+    def connect(self):
+        self.http = requests.Session()
+        self.http.post(f"{self.base_url}/login", data={'username': self.username, 'password': PASSWORD},
+                       allow_redirects=False)
+        cookies = '; '.join(f"{c.name}={c.value}" for c in self.http.cookies)
+
+        self.sio = socketio.Client(reconnection=False, request_timeout=30)
+        self.sio.on('receive_message', self.on_message)
+        self.sio.on('receive_private_message', self.on_private_message)
+        self.sio.on('reaction_delta', self.on_reactions)
+        self.sio.on('batch', self.on_batch)
+        self.sio.on('rate_limited', lambda data: self.stats.count('rate_limited'))
+
+        began = time.perf_counter()
+        self.sio.connect(self.base_url, headers={'Cookie': cookies}, transports=['websocket'], wait_timeout=30)
+        self.stats.record('connect', time.perf_counter() - began)
+        self.sio.emit('join', {'username': self.username})
+        self.sio.emit('join_dm', {'username': self.username, 'recipient': self.partner})
+
+    # Receipts count as fan-out only for messages sent during the measured window.
+    def on_message(self, data):
+        self.remember(data)
+        if data.get('image'):
+            self.stats.delivered('fanout_image', data['image'])
+        else:
+            self.stats.delivered('fanout_global', data.get('msg'))
+
+    def on_private_message(self, data):
+        self.remember(data)
+        if data.get('image'):
+            self.stats.delivered('fanout_image', data['image'])
+        else:
+            self.stats.delivered('fanout_dm', data.get('msg'))
+
+    def on_reactions(self, data):
+        began = self.pending_reactions.pop(data.get('message_id'), None)
+        if began is not None:
+            self.stats.record('reaction', time.perf_counter() - began)
+
+    # Room events coalesced by the server (PYCHAT_FANOUT_WINDOW_MS), handled one by one.
+    def on_batch(self, data):
+        handlers = self.sio.handlers.get('/', {})
+        for event, payload in data['events']:
+            if event in handlers:
+                handlers[event](payload)
+
+    def remember(self, data):
+        if data.get('id'):
+            self.seen.append(data['id'])
+            del self.seen[:-20]
+
+    def next_text(self):
+        self.sequence += 1
+        return f"{self.username} load {self.sequence}"
+
+    def timed_get(self, metric, path):
+        began = time.perf_counter()
+        response = self.http.get(f"{self.base_url}{path}")
+        self.stats.record(metric, time.perf_counter() - began)
+        self.stats.count('http_requests')
+        if response.status_code >= 400:
+            self.stats.count('http_errors')
+
+    def send_image(self, private):
+        data = random_png(self.rng)
+        began = time.perf_counter()
+        response = self.http.post(f"{self.base_url}/upload?name=load.png", data=data,
+                                  headers={'Content-Type': 'image/png'})
+        self.stats.record('upload', time.perf_counter() - began)
+        self.stats.count('http_requests')
+        if response.status_code != 200:
+            self.stats.count('http_errors')
+            return
+        self.stats.mark_sent(f"{hashlib.sha256(data).hexdigest()}.png")
+        self.stats.count('messages_sent')
+        if private:
+            self.sio.emit('upload_private_image', {'token': response.json()['token'], 'recipient': self.partner})
+        else:
+            self.sio.emit('upload_image', {'token': response.json()['token']})
+
+    def act(self, action):
+        if action == 'global_message':
+            text = self.next_text()
+            self.stats.mark_sent(text)
+            self.stats.count('messages_sent')
+            self.sio.emit('send_message', {'msg': text})
+        elif action == 'dm_message':
+            text = self.next_text()
+            self.stats.mark_sent(text)
+            self.stats.count('messages_sent')
+            self.sio.emit('send_private_message', {'recipient': self.partner, 'msg': text})
+        elif action == 'react' and self.seen:
+            message_id = self.rng.choice(self.seen)
+            self.pending_reactions[message_id] = time.perf_counter()
+            self.stats.count('reactions_sent')
+            self.sio.emit('react_to_message', {'message_id': message_id, 'emoji': self.rng.choice(EMOJIS)})
+        elif action == 'page_index':
+            self.timed_get('page_index', '/')
+        elif action == 'page_dms':
+            self.timed_get('page_dms', f"/dms/{self.partner}")
+        elif action == 'global_image':
+            self.send_image(private=False)
+        elif action == 'dm_image':
+            self.send_image(private=True)
+
+    def run(self):
+        try:
+            self.connect()
+        except Exception as exc:
+            self.stats.count('connect_errors')
+            print(f"{self.username}: connect failed: {exc}", file=sys.stderr)
+            self.start_barrier.abort()
+            return
+
+        try:
+            self.start_barrier.wait()
+        except threading.BrokenBarrierError:
+            self.sio.disconnect()
+            return
+
+        deadline = time.monotonic() + self.args.duration
+        actions, weights = list(ACTIONS), list(ACTIONS.values())
+        while time.monotonic() < deadline:
+            self.act(self.rng.choices(actions, weights)[0])
+            time.sleep(min(self.rng.expovariate(1 / self.args.think), max(0, deadline - time.monotonic())))
+        # Let in-flight deliveries land before hanging up.
+        time.sleep(self.args.drain)
+        self.sio.disconnect()
+
+
+# --- Reporting ---
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def summarize(stats, elapsed, memory):
+    latency = {}
+    for metric in METRICS:
+        values = sorted(stats.samples[metric])
+        if not values:
+            continue
+        latency[metric] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    counters = dict(stats.counters)
+    return {
+        'elapsed_s': elapsed,
+        'latency': latency,
+        'counters': counters,
+        'throughput': {
+            'messages_sent_per_s': counters.get('messages_sent', 0) / elapsed,
+            'deliveries_per_s': counters.get('deliveries', 0) / elapsed,
+            'http_requests_per_s': counters.get('http_requests', 0) / elapsed,
+        },
+        'server_memory': memory,
+    }
+
+
+def report(args, result):
+    print(f"\n== PyChat load test: {args.users} users, {args.duration}s, "
+          f"{args.messages:,} seeded messages ==")
+    print(f"{'metric':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for metric, row in result['latency'].items():
+        print(f"{metric:<16}{row['count']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+    throughput = result['throughput']
+    print(f"\nthroughput: {throughput['messages_sent_per_s']:.1f} messages sent/s, "
+          f"{throughput['deliveries_per_s']:.1f} deliveries/s, "
+          f"{throughput['http_requests_per_s']:.1f} HTTP requests/s")
+    memory = result['server_memory']
+    if memory['peak_rss_mib'] is not None:
+        print(f"server RSS: {memory['start_rss_mib']:.1f} MiB at start, "
+              f"{memory['peak_rss_mib']:.1f} MiB peak, {memory['end_rss_mib']:.1f} MiB at end")
+    problems = {k: v for k, v in result['counters'].items()
+                if k in ('http_errors', 'connect_errors', 'rate_limited')}
+    if problems:
+        print('counters:', ', '.join(f"{k}={v}" for k, v in sorted(problems.items())))
+
+
+def check_budgets(result, budgets):
+    """Return a list of failed --max-p95 budgets."""
+    failures = []
+    for budget in budgets:
+        metric, _, limit = budget.partition('=')
+        row = result['latency'].get(metric)
+        if row is None:
+            failures.append(f"{metric}: no samples")
+        elif row['p95_ms'] > float(limit):
+            failures.append(f"{metric}: p95 {row['p95_ms']:.1f} ms > {float(limit):.1f} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='simulated users (rounded up to an even number)')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--think', type=float, default=1.0, help='mean seconds between a user\'s actions')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for in-flight deliveries')
+    parser.add_argument('--messages', type=int, default=100_000, help='seeded message history')
+    parser.add_argument('--global-share', type=float, default=0.3)
+    parser.add_argument('--rate-limits', action='store_true', help='keep the app\'s rate limits enabled')
+    parser.add_argument('--max-p95', action='append', default=[], metavar='METRIC=MS',
+                        help='fail when a metric\'s p95 exceeds MS (repeatable)')
+    parser.add_argument('--json', help='also write the results to this file')
+    # Internal: the server subprocess.
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--uploads', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.users += args.users % 2
+
+    if args.serve:
+        serve(args)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        began = time.perf_counter()
+        proc, base_url, log_path = start_server(args, workdir)
+        try:
+            wait_until_ready(proc, base_url, log_path)
+            print(f"Server up at {base_url} with {args.users} users and {args.messages:,} messages "
+                  f"in {time.perf_counter() - began:.1f}s")
+
+            stats = Stats()
+            barrier = threading.Barrier(args.users + 1)
+            users = [SimulatedUser(i, base_url, stats, barrier, args) for i in range(args.users)]
+            for user in users:
+                user.start()
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                with open(log_path) as log:
+                    sys.exit(f"Some simulated users could not connect. Server log:\n{log.read()[-2000:]}")
+
+            start_rss = rss_bytes(proc.pid)
+            peak_rss = start_rss
+            started = time.perf_counter()
+            while any(user.is_alive() for user in users):
+                time.sleep(0.5)
+                rss = rss_bytes(proc.pid)
+                if rss is not None:
+                    peak_rss = max(peak_rss or 0, rss)
+            elapsed = min(time.perf_counter() - started, args.duration)
+            end_rss = rss_bytes(proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    mib = lambda n: n / (1024 * 1024) if n is not None else None
+    result = summarize(stats, elapsed, {
+        'start_rss_mib': mib(start_rss), 'peak_rss_mib': mib(peak_rss), 'end_rss_mib': mib(end_rss),
+    })
+    report(args, result)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(result, out, indent=2)
+
+    failures = check_budgets(result, args.max_p95)
+    if failures:
+        print('\nFAILED budgets:\n  ' + '\n  '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
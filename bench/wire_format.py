@@ -0,0 +1,178 @@
+"""Bytes on the wire and CPU per room broadcast for each Socket.IO wire format.
+
+Builds a realistic stream of room events (new messages, reaction deltas, edits, deletes,
+presence diffs and batches) and encodes it the way the server does:
+
+- once per event with python-socketio's JSON or MessagePack packet class, with full keys
+  or with app.compact_payload() applied;
+- then, with permessage-deflate, once more per recipient. Eventlet keeps one deflate
+  context per socket. Every member of a room gets the same frames, so the benchmark
+  compresses the stream once and counts that CPU once per member.
+
+The report shows bytes per event as framed on the websocket, bytes/s for the whole room,
+and CPU ms per second of traffic.
+
+    python bench/wire_format.py                          # 500 members, 20 events/s
+    python bench/wire_format.py --members 5000 --rate 50
+
+Run from the repository root so app.py is importable. msgpack rows need the msgpack package.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMOJIS = ['👍', '❤️', '😂', '😮', '😢', '😡']
+WORDS = ('hey', 'lol', 'anyone', 'around', 'tonight', 'the', 'build', 'is', 'green', 'again',
+         'did', 'you', 'see', 'that', 'meeting', 'notes', 'ok', 'thanks', 'nice', 'pushed')
+
+
+def user_name(i):
+    return f"user{i:04d}"
+
+
+def event_stream(n_events, seed=7):
+    """Room events in the shapes app.py broadcasts, roughly in production proportions."""
+    rng = random.Random(seed)
+    message_id = 100_000
+    ts = 1_760_000_000_000
+    events = []
+    while len(events) < n_events:
+        ts += rng.randint(200, 4000)
+        roll = rng.random()
+        if roll < 0.5:
+            message_id += 1
+            events.append(('receive_message', {
+                'id': message_id,
+                'username': user_name(rng.randrange(500)),
+                'msg': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 18))),
+                'timestamp': time.strftime('%H:%M', time.gmtime(ts / 1000)),
+                'ts': ts
+            }))
+        elif roll < 0.75:
+            events.append(('reaction_delta', {
+                'message_id': message_id - rng.randrange(20),
+                'emoji': rng.choice(EMOJIS),
+                'delta': rng.choice((1, 1, 1, -1)),
+                'count': rng.randint(1, 40),
+                'username': user_name(rng.randrange(500))
+            }))
+        elif roll < 0.82:
+            events.append(('message_updated', {
+                'message_id': message_id - rng.randrange(5),
+                'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+            }))
+        elif roll < 0.85:
+            events.append(('message_deleted', {'message_id': message_id - rng.randrange(5)}))
+        else:
+            events.append(('presence', rng.choice((
+                {'online': [user_name(rng.randrange(500))]},
+                {'offline': [user_name(rng.randrange(500))]},
+                {'typing': [user_name(rng.randrange(500))]},
+                {'online': [user_name(rng.randrange(500))], 'stopped': [user_name(rng.randrange(500))]},
+            ))))
+    # A fan-out window folds bursts of non-urgent events into one 'batch' frame.
+    batched = []
+    for event in events:
+        if batched and event[0] == 'reaction_delta' and batched[-1][0] == 'reaction_delta' and rng.random() < 0.5:
+            batched[-1] = ('batch', {'events': [list(batched[-1]), list(event)]})
+        else:
+            batched.append(event)
+    return batched
+
+
+def frame_size(payload):
+    """Websocket frame bytes for a server-to-client payload (no mask)."""
+    length = len(payload)
+    return length + (2 if length < 126 else 4 if length < 65536 else 10)
+
+
+def encode(events, packet_class, compact):
+    """Engine.IO messages for each event, encoded once per event as Server.emit does."""
+    from socketio import packet
+    from app import compact_payload
+
+    encoded = []
+    for event, data in events:
+        if compact:
+            if event == 'batch':
+                data = {'events': [[name, compact_payload(payload)] for name, payload in data['events']]}
+            else:
+                data = compact_payload(data)
+        pkt = packet_class(packet.EVENT, data=[event, data], namespace='/')
+        body = pkt.encode()
+        # Text packets travel as Engine.IO "4<packet>"; binary ones as a bare binary message.
+        encoded.append(b'4' + body.encode() if isinstance(body, str) else body)
+    return encoded
+
+
+def deflate(messages):
+    """Compress like eventlet's permessage-deflate: one context, sync flush, tail stripped."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return [(compressor.compress(m) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4] for m in messages]
+
+
+def measure(events, packet_class, compact, use_deflate, repeat):
+    encode_seconds = deflate_seconds = float('inf')
+    for _ in range(repeat):
+        began = time.perf_counter()
+        messages = encode(events, packet_class, compact)
+        encode_seconds = min(encode_seconds, time.perf_counter() - began)
+        if use_deflate:
+            began = time.perf_counter()
+            messages = deflate(messages)
+            deflate_seconds = min(deflate_seconds, time.perf_counter() - began)
+    return {
+        'bytes': sum(frame_size(m) for m in messages) / len(events),
+        'encode_us': encode_seconds / len(events) * 1e6,
+        'deflate_us': deflate_seconds / len(events) * 1e6 if use_deflate else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=5_000)
+    parser.add_argument('--members', type=int, default=500, help='clients in the room')
+    parser.add_argument('--rate', type=float, default=20, help='room events per second')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # app.py is imported only for compact_payload(); keep its database out of instance/.
+    tmp = tempfile.mkdtemp()
+    os.environ.setdefault('PYCHAT_DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+    from socketio.packet import Packet
+    try:
+        from socketio.msgpack_packet import MsgPackPacket
+        import msgpack  # noqa: F401  (MsgPackPacket imports it lazily)
+    except ImportError:
+        MsgPackPacket = None
+
+    events = event_stream(args.events)
+    formats = [('json', Packet)] + ([('msgpack', MsgPackPacket)] if MsgPackPacket else [])
+
+    print(f"{len(events):,} room frames, {args.members:,} members, {args.rate:g} events/s")
+    print(f"\n{'format':<10} {'keys':<8} {'deflate':<8} {'B/event':>8} {'room KB/s':>10} "
+          f"{'encode us':>10} {'deflate us':>11} {'CPU ms/s':>9}")
+    baseline = None
+    for name, packet_class in formats:
+        for compact in (False, True):
+            for use_deflate in (False, True):
+                result = measure(events, packet_class, compact, use_deflate, args.repeat)
+                room_bytes = result['bytes'] * args.rate * args.members
+                # Encoded once per event, compressed once per member.
+                cpu_ms = args.rate * (result['encode_us'] + result['deflate_us'] * args.members) / 1000
+                baseline = baseline or room_bytes
+                print(f"{name:<10} {'short' if compact else 'full':<8} {'on' if use_deflate else 'off':<8} "
+                      f"{result['bytes']:8.1f} {room_bytes / 1024:10.1f} {result['encode_us']:10.2f} "
+                      f"{result['deflate_us']:11.2f} {cpu_ms:9.1f}   {room_bytes / baseline:5.0%} of JSON")
+    if not MsgPackPacket:
+        print("\nmsgpack is not installed; pip install msgpack to include it.")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,44 @@ const msgInput = document.getElementById('dm-input');
 const sendBtn = document.getElementById('dm-send-btn');
 const imageInput = document.getElementById('dm-image-input');
 
+// expands the server's short field codes (compact payloads) back to full keys, in place,
+// before any event handler runs; batches carry payloads of their own
+const fieldNames = Object.fromEntries(Object.entries(window.fieldCodes || {}).map(([name, code]) => [code, name]));
+
+function expandFields(data) {
+    if (!data || typeof data !== 'object' || Array.isArray(data)) return;
+    Object.keys(data).forEach(key => {
+        if (key in fieldNames) {
+            data[fieldNames[key]] = data[key];
+            delete data[key];
+        }
+    });
+}
+
+// where this page is in the room's event stream; sent back on rejoin to catch up
+let resumeEpoch = window.resumeEpoch;
+let resumeSeq = window.resumeSeq || 0;
+
+function trackEvent(data) {
+    expandFields(data);
+    if (data && data.seq > resumeSeq) resumeSeq = data.seq;
+}
+
+socket.onAny((event, data) => {
+    if (event === 'batch') data.events.forEach(([, payload]) => trackEvent(payload));
+    else if (event !== 'resume') trackEvent(data);
+});
+
+// the newest message on screen, for a catch-up from the database
+function lastMessageId() {
+    return Array.from(document.querySelectorAll('.msg-bubble[data-msg-id]'))
+        .reduce((max, bubble) => Math.max(max, Number(bubble.dataset.msgId) || 0), 0);
+}
+
+function resumePoint() {
+    return { epoch: resumeEpoch, seq: resumeSeq, last_id: lastMessageId() };
+}
+
 // closes all open message menus except the one passed as argument
 function closeAllMenus(exceptMenu) {
     document.querySelectorAll('.msg-menu').forEach(menu => {
@@ -238,12 +276,41 @@ if (chatContainer) {
 // Socket Event Listeners
 
 socket.on('connect', () => {
-    // joins the specific DM room based on recipient and username
+    // joins the DM room with the recipient (the server knows who we are)
     if (window.activeRecipient) {
         socket.emit('join_dm', { 
             recipient: window.activeRecipient,
-            username: window.currentUser 
+            resume: resumePoint()
         });
+        markRead();
+    }
+});
+
+// unpacks a batch of room events the server coalesced, handling each in order
+socket.on('batch', data => {
+    data.events.forEach(([event, payload]) => {
+        socket.listeners(event).forEach(handler => handler(payload));
+    });
+});
+
+// replays what the room sent while this socket was away: logged events when the server
+// still has them, otherwise the newer messages (reactions are then re-synced)
+socket.on('resume', data => {
+    resumeEpoch = data.epoch;
+    (data.events || []).forEach(([event, payload]) => {
+        expandFields(payload);
+        socket.listeners(event).forEach(handler => handler(payload));
+    });
+    resumeSeq = Math.max(resumeSeq, data.seq);
+
+    if (data.messages) {
+        if (!data.complete) {
+            // too much was missed to patch in; start over from a fresh page
+            window.location.reload();
+            return;
+        }
+        data.messages.forEach(m => appendMessage(m, m.username === window.currentUser));
+        syncReactions();
     }
 });
 
@@ -270,31 +337,68 @@ window.sendReaction = function(arg1, arg2) {
     }
 };
 
-// updates reaction counts/state when notified by the server
-socket.on('update_message_reactions', data => {
-    const msgId = data.message_id;
-    const reactions = data.reactions; 
-    const reactionList = document.getElementById(`reactions-${msgId}`);
-
-    if (reactionList) {
-        let html = '';
-        reactions.forEach(r => {
-            const isMe = r.users.includes(window.currentUser);
-            html += `<span class="reaction-tag ${isMe ? 'active' : ''}" 
-                           onclick="sendReaction(this)"
-                           data-id="${msgId}"
-                           data-emoji="${r.emoji}">
-                       ${r.emoji} ${r.count}
-                     </span>`;
-        });
-        reactionList.innerHTML = html;
+// builds one reaction pill
+function makeReactionTag(msgId, emoji, count, active) {
+    const tag = document.createElement('span');
+    tag.className = `reaction-tag ${active ? 'active' : ''}`;
+    tag.setAttribute('onclick', 'sendReaction(this)');
+    tag.setAttribute('data-id', msgId);
+    tag.setAttribute('data-emoji', emoji);
+    tag.innerText = `${emoji} ${count}`;
+    return tag;
+}
+
+// applies a single toggle ("+1 👍 by alice") to the pill it touches
+socket.on('reaction_delta', data => {
+    const reactionList = document.getElementById(`reactions-${data.message_id}`);
+    if (!reactionList) return;
+
+    const tag = Array.from(reactionList.children)
+        .find(t => t.getAttribute('data-emoji') === data.emoji);
+    const isMe = data.username === window.currentUser;
+
+    if (data.count <= 0) {
+        if (tag) tag.remove();
+    } else if (tag) {
+        tag.innerText = `${data.emoji} ${data.count}`;
+        if (isMe) tag.classList.toggle('active', data.delta > 0);
+    } else {
+        reactionList.appendChild(makeReactionTag(data.message_id, data.emoji, data.count, isMe && data.delta > 0));
     }
 });
 
-// appends a new message to the chat container
-function appendMessage(data, isSentByMe) {
-    if (!chatContainer) return;
-    
+// replaces the pills with the server's totals (after a reconnect or a lost race)
+socket.on('reaction_sync', data => {
+    Object.entries(data.reactions).forEach(([msgId, reactions]) => {
+        const reactionList = document.getElementById(`reactions-${msgId}`);
+        if (!reactionList) return;
+        reactionList.replaceChildren(...reactions.map(r =>
+            makeReactionTag(msgId, r.emoji, r.count, r.user_has_reacted)));
+    });
+});
+
+// asks for fresh totals for the messages on screen (newest first, capped server-side)
+function syncReactions() {
+    const ids = Array.from(document.querySelectorAll('.reaction-list[id^="reactions-"]'))
+        .map(list => list.id.slice('reactions-'.length))
+        .reverse()
+        .slice(0, 200);
+    if (ids.length > 0) {
+        socket.emit('sync_reactions', { message_ids: ids });
+    }
+}
+
+// formats message times in the viewer's timezone; the server's string is the fallback
+const timeFormat = new Intl.DateTimeFormat([], {
+    hour: '2-digit', minute: '2-digit', hourCycle: 'h23', timeZone: window.userTimezone || undefined
+});
+
+function messageTime(data) {
+    return data.ts ? timeFormat.format(new Date(data.ts)) : data.timestamp;
+}
+
+// builds the DOM row for a single message
+function buildMessageRow(data, isSentByMe) {
     const rowDiv = document.createElement('div');
     rowDiv.className = isSentByMe ? 'msg-row sent' : 'msg-row received';
 
@@ -324,16 +428,19 @@ function appendMessage(data, isSentByMe) {
     bubbleDiv.className = isSentByMe ? 'msg-bubble msg-sent' : 'msg-bubble msg-received';
     if(data.id) bubbleDiv.setAttribute('data-msg-id', data.id);
 
-    // handles image content
+    // handles image content: preview size, full size on click
     if (data.image) {
+        const link = document.createElement('a');
+        link.href = '/media/chat/display/' + data.image;
+        link.target = '_blank';
+
         const img = document.createElement('img');
-        if (data.image.startsWith('data:')) {
-             img.src = data.image; 
-        } else {
-             img.src = '/static/chat_uploads/' + data.image;
-        }
+        img.src = '/media/chat/preview/' + data.image;
         img.className = 'chat-image';
-        bubbleDiv.appendChild(img);
+        img.loading = 'lazy';
+
+        link.appendChild(img);
+        bubbleDiv.appendChild(link);
     }
 
     // handles text content
@@ -353,15 +460,28 @@ function appendMessage(data, isSentByMe) {
         listDiv.className = 'reaction-list';
         listDiv.id = `reactions-${data.id}`;
 
+        // renders existing reactions (present on history pages)
+        if (data.reactions && data.reactions.length > 0) {
+            data.reactions.forEach(r => {
+                const tag = document.createElement('span');
+                tag.className = `reaction-tag ${r.user_has_reacted ? 'active' : ''}`;
+                tag.setAttribute('onclick', 'sendReaction(this)');
+                tag.setAttribute('data-id', data.id);
+                tag.setAttribute('data-emoji', r.emoji);
+                tag.innerText = `${r.emoji} ${r.count}`;
+                listDiv.appendChild(tag);
+            });
+        }
+
         reactDiv.appendChild(listDiv);
         bubbleDiv.appendChild(reactDiv);
     }
 
     // adds timestamp
-    if (data.timestamp) {
+    if (data.ts || data.timestamp) {
         const timeDiv = document.createElement('div');
         timeDiv.className = 'msg-time';
-        timeDiv.innerText = data.timestamp;
+        timeDiv.innerText = messageTime(data);
         bubbleDiv.appendChild(timeDiv);
     }
 
@@ -373,11 +493,58 @@ function appendMessage(data, isSentByMe) {
         temp.innerHTML = reactionPickerHTML;
         rowDiv.appendChild(temp.firstElementChild);        
     }
-    
-    chatContainer.appendChild(rowDiv);
+
+    return rowDiv;
+}
+
+// appends a new message to the chat container
+function appendMessage(data, isSentByMe) {
+    if (!chatContainer) return;
+    // a catch-up and the live event can both deliver the same message
+    if (data.id && chatContainer.querySelector(`.msg-bubble[data-msg-id="${data.id}"]`)) return;
+
+    chatContainer.appendChild(buildMessageRow(data, isSentByMe));
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
 
+// History Pagination
+
+let nextCursor = chatContainer ? chatContainer.dataset.nextCursor : '';
+let loadingHistory = false;
+
+// fetches the page of messages older than the current cursor and prepends it
+function loadOlderMessages() {
+    if (!chatContainer || !nextCursor || loadingHistory) return;
+    loadingHistory = true;
+
+    const url = `${chatContainer.dataset.historyUrl}?before=${encodeURIComponent(nextCursor)}`;
+    fetch(url, { credentials: 'same-origin' })
+        .then(res => res.ok ? res.json() : Promise.reject(res.status))
+        .then(page => {
+            // keeps the viewport anchored on the message the user was looking at
+            const previousHeight = chatContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            page.messages.forEach(m => {
+                fragment.appendChild(buildMessageRow(m, m.username === window.currentUser));
+            });
+            chatContainer.insertBefore(fragment, chatContainer.firstChild);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+
+            nextCursor = page.next_cursor || '';
+        })
+        .catch(err => console.error("Failed to load older messages:", err))
+        .finally(() => { loadingHistory = false; });
+}
+
+// loads older history when the user scrolls near the top
+if (chatContainer) {
+    chatContainer.addEventListener('scroll', () => {
+        if (chatContainer.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+}
+
 // Core Socket Listeners
 
 socket.on('receive_private_message', data => {
@@ -389,11 +556,115 @@ socket.on('receive_private_message', data => {
             id: data.id, 
             msg: data.msg,
             image: data.image,
-            timestamp: data.timestamp
+            timestamp: data.timestamp,
+            ts: data.ts
         }, isMe);
+
+        if (!isMe) {
+            scheduleMarkRead();
+            // a message ends its sender's typing indicator
+            recipientTyping = false;
+            renderPresence();
+        }
+    }
+});
+
+// Read Receipts
+
+let markReadTimer = null;
+
+// tells the server this thread has been read up to the newest message
+function markRead() {
+    if (!window.activeRecipient || document.visibilityState !== 'visible') return;
+    socket.emit('mark_read', { recipient: window.activeRecipient });
+}
+
+// collapses a burst of incoming messages into one mark_read
+function scheduleMarkRead() {
+    clearTimeout(markReadTimer);
+    markReadTimer = setTimeout(markRead, 1000);
+}
+
+// marks the last own message the other side has read with "Seen"
+function showSeen(lastReadId) {
+    if (!chatContainer || !lastReadId) return;
+    chatContainer.querySelectorAll('.msg-seen').forEach(el => el.remove());
+
+    const sent = Array.from(chatContainer.querySelectorAll('.msg-bubble.msg-sent[data-msg-id]'))
+        .filter(bubble => Number(bubble.dataset.msgId) <= lastReadId);
+    if (!sent.length) return;
+
+    const seen = document.createElement('div');
+    seen.className = 'msg-seen';
+    seen.textContent = 'Seen';
+    sent[sent.length - 1].closest('.msg-row').after(seen);
+}
+
+socket.on('conversation_read', data => {
+    if (data && data.username === window.activeRecipient) {
+        showSeen(data.last_read_id);
     }
 });
 
+// catches up on messages that arrived while the tab was hidden
+document.addEventListener('visibilitychange', scheduleMarkRead);
+
+showSeen(window.seenThrough);
+
+// Presence & Typing
+
+const dmPresence = document.getElementById('dm-presence');
+let recipientHere = false;
+let recipientTyping = false;
+
+function renderPresence() {
+    if (!dmPresence) return;
+    dmPresence.classList.toggle('here', recipientHere);
+    dmPresence.textContent = recipientTyping ? 'typing…' : (recipientHere ? 'in this chat' : '');
+}
+
+// full room state, sent once after joining
+socket.on('presence_snapshot', data => {
+    recipientHere = data.users.includes(window.activeRecipient);
+    recipientTyping = data.typing.includes(window.activeRecipient);
+    renderPresence();
+});
+
+// changes since the last diff; the server coalesces them per room
+socket.on('presence', data => {
+    const recipient = window.activeRecipient;
+    if ((data.online || []).includes(recipient)) recipientHere = true;
+    if ((data.offline || []).includes(recipient)) recipientHere = recipientTyping = false;
+    if ((data.typing || []).includes(recipient)) recipientTyping = true;
+    if ((data.stopped || []).includes(recipient)) recipientTyping = false;
+    renderPresence();
+});
+
+// tells the server we are still here; sockets that go quiet drop out of presence
+setInterval(() => socket.emit('heartbeat'), 25000);
+
+const TYPING_RESEND_MS = 3000; // the server forgets an indicator after 6s without a refresh
+let typingSentAt = 0;
+
+// reports typing at most every few seconds, and a stop when the box is cleared
+function reportTyping() {
+    if (!msgInput || !window.activeRecipient) return;
+    const now = Date.now();
+    if (msgInput.value.trim()) {
+        if (now - typingSentAt > TYPING_RESEND_MS) {
+            typingSentAt = now;
+            socket.emit('typing', { recipient: window.activeRecipient, typing: true });
+        }
+    } else if (typingSentAt) {
+        typingSentAt = 0;
+        socket.emit('typing', { recipient: window.activeRecipient, typing: false });
+    }
+}
+
+if (msgInput) {
+    msgInput.addEventListener('input', reportTyping);
+}
+
 socket.on('message_updated', data => {
     if (!data || !data.message_id) return;
     applyMessageUpdate(data.message_id, data.content || '');
@@ -404,6 +675,21 @@ socket.on('message_deleted', data => {
     applyMessageDelete(data.message_id);
 });
 
+// the server refused a message, or could not store one that was already shown
+socket.on('message_failed', data => {
+    alert((data && data.error) || 'Your message could not be sent.');
+});
+
+// server-side throttle; pause the send button until the bucket refills
+socket.on('rate_limited', data => {
+    const seconds = Math.max(1, Math.ceil((data && data.remaining) ? data.remaining : 1));
+    if (sendBtn && data && data.event === 'dm') {
+        sendBtn.disabled = true;
+        setTimeout(() => { sendBtn.disabled = false; }, seconds * 1000);
+    }
+    alert(`You're doing that too fast. Try again in ${seconds}s.`);
+});
+
 // Message Sending Logic
 
 function sendMessage() {
@@ -416,8 +702,10 @@ function sendMessage() {
         msg: msg
     });
     
+    // the server ends our typing indicator with the message
     msgInput.value = '';
     msgInput.style.height = '50px'; 
+    typingSentAt = 0;
 }
 
 // Image Upload Logic
@@ -428,21 +716,34 @@ if (imageInput) {
 
         const file = this.files[0];
         if (file) {
-            const reader = new FileReader();
-            reader.onload = function(evt) {
-                socket.emit('upload_private_image', {
-                    recipient: window.activeRecipient,
-                    username: window.currentUser,
-                    image: evt.target.result, 
-                    fileName: file.name
-                });
-            };
-            reader.readAsDataURL(file);
+            // streams the file over HTTP, then posts the returned token over the socket
+            uploadImage(file)
+                .then(token => {
+                    socket.emit('upload_private_image', {
+                        recipient: window.activeRecipient,
+                        username: window.currentUser,
+                        token: token
+                    });
+                })
+                .catch(err => alert(err));
             this.value = ''; 
         }
     });
 }
 
+// uploads the raw file to the server and resolves with its upload token
+function uploadImage(file) {
+    return fetch(`/upload?name=${encodeURIComponent(file.name)}`, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: { 'Content-Type': file.type || 'application/octet-stream' },
+        body: file
+    })
+        .then(res => res.json()
+            .catch(() => ({}))
+            .then(body => res.ok ? body.token : Promise.reject(body.error || 'Image upload failed.')));
+}
+
 // binds Send button and Enter key
 if (sendBtn) {
     sendBtn.addEventListener('click', sendMessage);
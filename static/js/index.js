@@ -5,6 +5,44 @@ const msgInput = document.getElementById('message');
 const sendBtn = document.getElementById('send');       
 const imageInput = document.getElementById('image-input');
 
+// expands the server's short field codes (compact payloads) back to full keys, in place,
+// before any event handler runs; batches carry payloads of their own
+const fieldNames = Object.fromEntries(Object.entries(window.fieldCodes || {}).map(([name, code]) => [code, name]));
+
+function expandFields(data) {
+    if (!data || typeof data !== 'object' || Array.isArray(data)) return;
+    Object.keys(data).forEach(key => {
+        if (key in fieldNames) {
+            data[fieldNames[key]] = data[key];
+            delete data[key];
+        }
+    });
+}
+
+// where this page is in the room's event stream; sent back on rejoin to catch up
+let resumeEpoch = window.resumeEpoch;
+let resumeSeq = window.resumeSeq || 0;
+
+function trackEvent(data) {
+    expandFields(data);
+    if (data && data.seq > resumeSeq) resumeSeq = data.seq;
+}
+
+socket.onAny((event, data) => {
+    if (event === 'batch') data.events.forEach(([, payload]) => trackEvent(payload));
+    else if (event !== 'resume') trackEvent(data);
+});
+
+// the newest message on screen, for a catch-up from the database
+function lastMessageId() {
+    return Array.from(document.querySelectorAll('.msg-bubble[data-msg-id]'))
+        .reduce((max, bubble) => Math.max(max, Number(bubble.dataset.msgId) || 0), 0);
+}
+
+function resumePoint() {
+    return { epoch: resumeEpoch, seq: resumeSeq, last_id: lastMessageId() };
+}
+
 // adds the cooldown configuration settings
 const COOLDOWN_SECONDS = 10; 
 let cooldownUntil = 0;       
@@ -329,7 +367,35 @@ if (chatContainer) {
 socket.on('connect', () => {
     // rejoins the global chat channel on connection
     if (window.currentUsername) {
-        socket.emit('join', { username: window.currentUsername });
+        socket.emit('join', { username: window.currentUsername, resume: resumePoint() });
+    }
+});
+
+// unpacks a batch of room events the server coalesced, handling each in order
+socket.on('batch', data => {
+    data.events.forEach(([event, payload]) => {
+        socket.listeners(event).forEach(handler => handler(payload));
+    });
+});
+
+// replays what the room sent while this socket was away: logged events when the server
+// still has them, otherwise the newer messages (reactions are then re-synced)
+socket.on('resume', data => {
+    resumeEpoch = data.epoch;
+    (data.events || []).forEach(([event, payload]) => {
+        expandFields(payload);
+        socket.listeners(event).forEach(handler => handler(payload));
+    });
+    resumeSeq = Math.max(resumeSeq, data.seq);
+
+    if (data.messages) {
+        if (!data.complete) {
+            // too much was missed to patch in; start over from a fresh page
+            window.location.reload();
+            return;
+        }
+        data.messages.forEach(m => appendMessage(m, m.username === window.currentUsername));
+        syncReactions();
     }
 });
 
@@ -361,32 +427,68 @@ window.sendReaction = function(arg1, arg2) {
     }
 };
 
-// listens for the updated reaction counts from the server
-socket.on('update_message_reactions', data => {
-    const msgId = data.message_id;
-    const reactions = data.reactions; 
-    const reactionList = document.getElementById(`reactions-${msgId}`);
-
-    // re-renders the reaction pills
-    if (reactionList) {
-        let html = '';
-        reactions.forEach(r => {
-            const isMe = r.users.includes(window.currentUsername);
-            html += `<span class="reaction-tag ${isMe ? 'active' : ''}" 
-                           onclick="sendReaction(this)"
-                           data-id="${msgId}"
-                           data-emoji="${r.emoji}">
-                       ${r.emoji} ${r.count}
-                     </span>`;
-        });
-        reactionList.innerHTML = html;
+// builds one reaction pill
+function makeReactionTag(msgId, emoji, count, active) {
+    const tag = document.createElement('span');
+    tag.className = `reaction-tag ${active ? 'active' : ''}`;
+    tag.setAttribute('onclick', 'sendReaction(this)');
+    tag.setAttribute('data-id', msgId);
+    tag.setAttribute('data-emoji', emoji);
+    tag.innerText = `${emoji} ${count}`;
+    return tag;
+}
+
+// applies a single toggle ("+1 👍 by alice") to the pill it touches
+socket.on('reaction_delta', data => {
+    const reactionList = document.getElementById(`reactions-${data.message_id}`);
+    if (!reactionList) return;
+
+    const tag = Array.from(reactionList.children)
+        .find(t => t.getAttribute('data-emoji') === data.emoji);
+    const isMe = data.username === window.currentUsername;
+
+    if (data.count <= 0) {
+        if (tag) tag.remove();
+    } else if (tag) {
+        tag.innerText = `${data.emoji} ${data.count}`;
+        if (isMe) tag.classList.toggle('active', data.delta > 0);
+    } else {
+        reactionList.appendChild(makeReactionTag(data.message_id, data.emoji, data.count, isMe && data.delta > 0));
     }
 });
 
-// appends a new message to the chat view
-function appendMessage(data) {
-    if (!chatContainer) return;
-    
+// replaces the pills with the server's totals (after a reconnect or a lost race)
+socket.on('reaction_sync', data => {
+    Object.entries(data.reactions).forEach(([msgId, reactions]) => {
+        const reactionList = document.getElementById(`reactions-${msgId}`);
+        if (!reactionList) return;
+        reactionList.replaceChildren(...reactions.map(r =>
+            makeReactionTag(msgId, r.emoji, r.count, r.user_has_reacted)));
+    });
+});
+
+// asks for fresh totals for the messages on screen (newest first, capped server-side)
+function syncReactions() {
+    const ids = Array.from(document.querySelectorAll('.reaction-list[id^="reactions-"]'))
+        .map(list => list.id.slice('reactions-'.length))
+        .reverse()
+        .slice(0, 200);
+    if (ids.length > 0) {
+        socket.emit('sync_reactions', { message_ids: ids });
+    }
+}
+
+// formats message times in the viewer's timezone; the server's string is the fallback
+const timeFormat = new Intl.DateTimeFormat([], {
+    hour: '2-digit', minute: '2-digit', hourCycle: 'h23', timeZone: window.userTimezone || undefined
+});
+
+function messageTime(data) {
+    return data.ts ? timeFormat.format(new Date(data.ts)) : data.timestamp;
+}
+
+// builds the DOM row for a single message
+function buildMessageRow(data) {
     const isMe = data.username === window.currentUsername;    
 	const rowDiv = document.createElement('div');
     rowDiv.className = `msg-row ${isMe ? 'sent' : 'received'}`;
@@ -434,12 +536,19 @@ function appendMessage(data) {
         bubbleDiv.appendChild(nameDiv);
     }
 
-    // renders image content (if it exists)
+    // renders image content (if it exists): preview size, full size on click
     if (data.image) {
+        const link = document.createElement('a');
+        link.href = '/media/chat/display/' + data.image;
+        link.target = '_blank';
+
         const img = document.createElement('img');
-        img.src = '/static/chat_uploads/' + data.image;
+        img.src = '/media/chat/preview/' + data.image;
         img.className = 'chat-image';
-        bubbleDiv.appendChild(img);
+        img.loading = 'lazy';
+
+        link.appendChild(img);
+        bubbleDiv.appendChild(link);
     }
 
     // renders text content (if it exists)
@@ -476,10 +585,10 @@ function appendMessage(data) {
     }
 
     // renders timestamp
-    if (data.timestamp) {
+    if (data.ts || data.timestamp) {
         const timeDiv = document.createElement('div');
         timeDiv.className = 'msg-time';
-        timeDiv.innerText = data.timestamp;
+        timeDiv.innerText = messageTime(data);
         bubbleDiv.appendChild(timeDiv);
     }
 
@@ -491,26 +600,152 @@ function appendMessage(data) {
         tempDiv.innerHTML = reactionPickerHTML;
         rowDiv.appendChild(tempDiv.firstElementChild);        
     }
-    
-    chatContainer.appendChild(rowDiv);
+
+    return rowDiv;
+}
+
+// appends a new message to the chat view
+function appendMessage(data) {
+    if (!chatContainer) return;
+    // a catch-up and the live event can both deliver the same message
+    if (data.id && chatContainer.querySelector(`.msg-bubble[data-msg-id="${data.id}"]`)) return;
+
+    chatContainer.appendChild(buildMessageRow(data));
     chatContainer.scrollTop = chatContainer.scrollHeight;
 }
 
+// History Pagination
+
+let nextCursor = chatContainer ? chatContainer.dataset.nextCursor : '';
+let loadingHistory = false;
+
+// fetches the page of messages older than the current cursor and prepends it
+function loadOlderMessages() {
+    if (!chatContainer || !nextCursor || loadingHistory) return;
+    loadingHistory = true;
+
+    const url = `${chatContainer.dataset.historyUrl}?before=${encodeURIComponent(nextCursor)}`;
+    fetch(url, { credentials: 'same-origin' })
+        .then(res => res.ok ? res.json() : Promise.reject(res.status))
+        .then(page => {
+            // keeps the viewport anchored on the message the user was looking at
+            const previousHeight = chatContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            page.messages.forEach(m => fragment.appendChild(buildMessageRow(m)));
+            chatContainer.insertBefore(fragment, chatContainer.firstChild);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+
+            nextCursor = page.next_cursor || '';
+        })
+        .catch(err => console.error("Failed to load older messages:", err))
+        .finally(() => { loadingHistory = false; });
+}
+
+// loads older history when the user scrolls near the top
+if (chatContainer) {
+    chatContainer.addEventListener('scroll', () => {
+        if (chatContainer.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+}
+
 // Socket Event Handlers
 
 // handles receiving a standard chat message
 socket.on('receive_message', data => {
     appendMessage(data);
+    // a message ends its sender's typing indicator
+    if (typingUsers.delete(data.username)) renderTyping();
 });
 
+// Presence & Typing
+
+const onlineUsers = new Set();
+let unlistedOnline = 0; // users counted in the snapshot total but not named in it
+const typingUsers = new Set();
+const onlineCount = document.getElementById('online-count');
+const typingIndicator = document.getElementById('typing-indicator');
+
+function renderPresence() {
+    if (onlineCount) onlineCount.textContent = onlineUsers.size + unlistedOnline;
+}
+
+function renderTyping() {
+    if (!typingIndicator) return;
+    const names = Array.from(typingUsers);
+    if (!names.length) typingIndicator.textContent = '';
+    else if (names.length === 1) typingIndicator.textContent = `${names[0]} is typing…`;
+    else if (names.length === 2) typingIndicator.textContent = `${names[0]} and ${names[1]} are typing…`;
+    else typingIndicator.textContent = 'Several people are typing…';
+}
+
+// full room state, sent once after joining
+socket.on('presence_snapshot', data => {
+    onlineUsers.clear();
+    data.users.forEach(u => onlineUsers.add(u));
+    unlistedOnline = Math.max(0, data.total - data.users.length);
+    typingUsers.clear();
+    data.typing.filter(u => u !== window.currentUsername).forEach(u => typingUsers.add(u));
+    renderPresence();
+    renderTyping();
+});
+
+// changes since the last diff; the server coalesces them per room
+socket.on('presence', data => {
+    (data.online || []).forEach(u => onlineUsers.add(u));
+    (data.offline || []).forEach(u => {
+        if (!onlineUsers.delete(u)) unlistedOnline = Math.max(0, unlistedOnline - 1);
+    });
+    (data.typing || []).filter(u => u !== window.currentUsername).forEach(u => typingUsers.add(u));
+    (data.stopped || []).forEach(u => typingUsers.delete(u));
+    renderPresence();
+    renderTyping();
+});
+
+// tells the server we are still here; sockets that go quiet drop out of presence
+setInterval(() => socket.emit('heartbeat'), 25000);
+
+const TYPING_RESEND_MS = 3000; // the server forgets an indicator after 6s without a refresh
+let typingSentAt = 0;
+
+// reports typing at most every few seconds, and a stop when the box is cleared
+function reportTyping() {
+    if (!msgInput) return;
+    const now = Date.now();
+    if (msgInput.value.trim()) {
+        if (now - typingSentAt > TYPING_RESEND_MS) {
+            typingSentAt = now;
+            socket.emit('typing', { typing: true });
+        }
+    } else if (typingSentAt) {
+        typingSentAt = 0;
+        socket.emit('typing', { typing: false });
+    }
+}
+
+if (msgInput) {
+    msgInput.addEventListener('input', reportTyping);
+}
+
 // handles system messages
 socket.on('system_message', data => {
     showSystemMessage(data.msg);
 });
 
+// the server refused a message, or could not store one that was already shown
+socket.on('message_failed', data => {
+    showSystemMessage((data && data.error) || 'Your message could not be sent.');
+});
+
 // hadnles the rate limiting
 socket.on('rate_limited', data => {
     const seconds = Math.max(1, Math.ceil((data && data.remaining) ? data.remaining : COOLDOWN_SECONDS));
+    // only the send limit drives the composer cooldown; reactions/edits just get a notice
+    if (data && data.event && data.event !== 'send') {
+        showSystemMessage(`You're doing that too fast. Try again in ${seconds}s.`);
+        return;
+    }
     startCooldown(seconds);
     showSystemMessage(`Please wait ${seconds}s before sending another global message.`);
 });
@@ -553,9 +788,10 @@ function sendMessage() {
         msg: msg
     });
     
-    // clears the input
+    // clears the input; the server ends our typing indicator with the message
     msgInput.value = '';
     msgInput.style.height = '50px'; 
+    typingSentAt = 0;
 }
 
 // Image Upload Logic
@@ -572,20 +808,33 @@ if (imageInput) {
 
         const file = this.files[0];
         if (file) {
-            const reader = new FileReader();
-            reader.onload = function(evt) {
-                socket.emit('upload_image', {
-                    username: window.currentUsername,
-                    image: evt.target.result, 
-                    fileName: file.name
-                });
-            };
-            reader.readAsDataURL(file);
+            // streams the file over HTTP, then posts the returned token over the socket
+            uploadImage(file)
+                .then(token => {
+                    socket.emit('upload_image', {
+                        username: window.currentUsername,
+                        token: token
+                    });
+                })
+                .catch(err => showSystemMessage(err));
             this.value = '';
         }
     });
 }
 
+// uploads the raw file to the server and resolves with its upload token
+function uploadImage(file) {
+    return fetch(`/upload?name=${encodeURIComponent(file.name)}`, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: { 'Content-Type': file.type || 'application/octet-stream' },
+        body: file
+    })
+        .then(res => res.json()
+            .catch(() => ({}))
+            .then(body => res.ok ? body.token : Promise.reject(body.error || 'Image upload failed.')));
+}
+
 // binds Send Button and Enter Key
 if (sendBtn) {
     sendBtn.addEventListener('click', sendMessage);
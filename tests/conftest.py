@@ -0,0 +1,24 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py configures itself at import time, so point it at a scratch database first.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ['PYCHAT_DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import app as pychat  # noqa: E402
+
+
+@pytest.fixture
+def login():
+    """Register and log in a user; returns (HTTP test client, Socket.IO test client)."""
+    def _login(username):
+        http = pychat.app.test_client()
+        http.post('/register', data={'username': username, 'password': 'pw', 'email': f'{username}@example.com'})
+        http.post('/login', data={'username': username, 'password': 'pw'})
+        return http, pychat.socketio.test_client(pychat.app, flask_test_client=http)
+    return _login
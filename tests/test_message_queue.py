@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_check_message_queue_delivers_over_local_queue(tmp_path):
+    # The Socket.IO test client refuses a message queue, so the app gets its own process.
+    env = dict(os.environ,
+               PYCHAT_DATABASE_URL=f"sqlite:///{tmp_path / 'queue.db'}",
+               PYCHAT_MESSAGE_QUEUE='local://')
+    result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'check-message-queue'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert 'Delivered through local://' in result.stdout
@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import app as pychat
+
+
+@pytest.fixture
+def writer():
+    """A writer with no thread of its own, so the test decides when it flushes."""
+    with pychat.app.app_context():
+        yield pychat.MessageWriter(pychat.shared_store)
+
+
+def failing_insert(reason):
+    def _insert(rows):
+        raise OperationalError('INSERT INTO message', {}, Exception(reason))
+    return _insert
+
+
+def test_failing_rows_are_dropped_after_retry_limit(writer, monkeypatch):
+    writer.add(content='never stored', sender_username='writer_a')
+    monkeypatch.setattr(writer, '_insert', failing_insert('disk I/O error'))
+
+    for _ in range(pychat.MESSAGE_RETRY_LIMIT - 1):
+        assert writer.flush() == 0
+    assert writer.flush() == 1
+    assert writer.pending_rows('global_chat') == []
+    assert [row['content'] for row, _ in writer._rejected] == ['never stored']
+
+
+def test_locked_database_retries_without_limit(writer, monkeypatch):
+    writer.add(content='eventually stored', sender_username='writer_b')
+    monkeypatch.setattr(writer, '_insert', failing_insert('database is locked'))
+
+    for _ in range(pychat.MESSAGE_RETRY_LIMIT * 2):
+        assert writer.flush() == 0
+    assert [row['content'] for row in writer.pending_rows('global_chat')] == ['eventually stored']
+    assert writer._rejected == []
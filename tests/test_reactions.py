@@ -0,0 +1,25 @@
+import app as pychat
+
+
+def test_concurrent_duplicate_reaction_resyncs_client(login, monkeypatch):
+    _, socket = login('reaction_racer')
+    socket.emit('join', {})
+    socket.emit('send_message', {'msg': 'react to me'})
+    message_id = next(packet['args'][0]['id'] for packet in socket.get_received()
+                      if packet['name'] == 'receive_message')
+
+    original = pychat.adjust_reaction_count
+
+    def concurrent_click(message_id, emoji, delta):
+        # Another worker stores the same reaction between this handler's lookup and its insert.
+        with pychat.db.engine.begin() as connection:
+            connection.execute(pychat.MessageReaction.__table__.insert().values(
+                message_id=message_id, user_username='reaction_racer', emoji=emoji))
+        return original(message_id, emoji, delta)
+
+    monkeypatch.setattr(pychat, 'adjust_reaction_count', concurrent_click)
+    socket.emit('react_to_message', {'message_id': message_id, 'emoji': '👍'})
+
+    events = [packet['name'] for packet in socket.get_received()]
+    assert 'reaction_sync' in events
+    assert 'reaction_delta' not in events